@@ -0,0 +1,191 @@
+"""
+User accounts for the Home Expense Tracker
+
+The login, signup and OTP pages only need to look up and register users, so
+this module keeps that path free of pandas (and of the rest of storage.py):
+it renders without paying for the data stack's import. The expense storage
+backends reuse the same user stores.
+
+- UserDirectory: users.csv (plus password_updates.csv) for the CSV backend
+- SQLiteUsers: the users table of the SQLite backend's database
+
+open_user_store() picks one from EXPENSE_STORAGE / EXPENSE_DATA_DIR /
+EXPENSE_DB like storage.open_storage() does.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+
+from csvfiles import append_rows_unlocked, file_lock, read_appended_rows
+
+# File paths
+USERS_FILE = "users.csv"
+PASSWORD_UPDATES_FILE = "password_updates.csv"
+DEFAULT_DB_FILE = "expenses.db"
+
+# Column layout of the user files (and of the users table)
+USER_COLUMNS = ['mobile', 'password', 'name', 'created_at']
+PASSWORD_UPDATE_COLUMNS = ['mobile', 'password']
+
+USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    mobile TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    name TEXT,
+    created_at TEXT
+);
+"""
+
+# ============================================
+# CSV USERS
+# ============================================
+
+class UserDirectory:
+    """
+    In-memory mobile -> user record index over users.csv
+    The file is parsed once per process; rows appended later (by this or any
+    other process) are picked up by reading only the bytes past the last offset.
+    Password changes are appended to a separate file and indexed the same way
+    """
+
+    def __init__(self, filename, updates_filename):
+        self.filename = filename
+        self.updates_filename = updates_filename
+        self._lock = threading.Lock()
+        self._users = {}
+        self._offset = 0
+        self._passwords = {}
+        self._updates_offset = 0
+
+    def _refresh(self):
+        """Index any complete rows added to the files since the last read"""
+        for filename, offset in ((self.filename, self._offset), (self.updates_filename, self._updates_offset)):
+            if os.path.exists(filename) and os.path.getsize(filename) < offset:
+                # File was replaced or truncated - start over
+                self._users, self._offset = {}, 0
+                self._passwords, self._updates_offset = {}, 0
+
+        rows, self._offset = read_appended_rows(self.filename, self._offset)
+        for row in rows:
+            record = dict(zip(USER_COLUMNS, row))
+            # The first registration of a mobile number wins
+            self._users.setdefault(record['mobile'], record)
+        rows, self._updates_offset = read_appended_rows(self.updates_filename, self._updates_offset)
+        for mobile, password in rows:
+            # The latest password change wins
+            self._passwords[mobile] = password
+
+    def _record(self, mobile):
+        record = self._users.get(mobile)
+        if record is not None and mobile in self._passwords:
+            record = dict(record, password=self._passwords[mobile])
+        return record
+
+    def get(self, mobile):
+        """Return the user record for a mobile number, or None"""
+        with self._lock:
+            self._refresh()
+            return self._record(mobile)
+
+    def add(self, record):
+        """Append a new user record; returns False if the mobile is taken"""
+        with self._lock, file_lock(self.filename):
+            # Refresh under the file lock so that two processes cannot both
+            # register the same mobile number
+            self._refresh()
+            if record['mobile'] in self._users:
+                return False
+            append_rows_unlocked(self.filename, USER_COLUMNS, [[record[column] for column in USER_COLUMNS]])
+            self._refresh()
+            return True
+
+    def update_password(self, mobile, old_password, new_password):
+        """Replace a user's password hash if it is still old_password; returns success"""
+        with self._lock, file_lock(self.updates_filename):
+            self._refresh()
+            record = self._record(mobile)
+            if record is None or record['password'] != old_password:
+                return False
+            append_rows_unlocked(self.updates_filename, PASSWORD_UPDATE_COLUMNS, [[mobile, new_password]])
+            self._refresh()
+            return True
+
+    def records(self):
+        """Return a list of all user records"""
+        with self._lock:
+            self._refresh()
+            return [self._record(mobile) for mobile in self._users]
+
+# ============================================
+# SQLITE USERS
+# ============================================
+
+class SQLiteUsers:
+    """
+    The users table of a SQLite database, with the same interface as UserDirectory
+    connection is a context manager factory lending a connection (the SQLite
+    backend passes its pool); by default one shared connection is used
+    """
+
+    def __init__(self, path=DEFAULT_DB_FILE, connection=None):
+        self.path = path
+        self.connection = connection or self._shared_connection
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self.connection() as conn:
+            conn.executescript(USERS_SCHEMA)
+
+    @contextlib.contextmanager
+    def _shared_connection(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections must not be shared with a forked child
+                self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._pid = os.getpid()
+            yield self._conn
+
+    def get(self, mobile):
+        """Return the user record for a mobile number, or None"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT mobile, password, name, created_at FROM users WHERE mobile = ?", (mobile,)
+            ).fetchone()
+        return dict(zip(USER_COLUMNS, row)) if row else None
+
+    def add(self, record):
+        """Insert a new user record; returns False if the mobile is taken"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (mobile, password, name, created_at) VALUES (?, ?, ?, ?)",
+                [record[column] for column in USER_COLUMNS]
+            )
+        return cursor.rowcount == 1
+
+    def update_password(self, mobile, old_password, new_password):
+        """Replace a user's password hash if it is still old_password; returns success"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET password = ? WHERE mobile = ? AND password = ?", (new_password, mobile, old_password)
+            )
+        return cursor.rowcount == 1
+
+    def records(self):
+        """Return a list of all user records"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT mobile, password, name, created_at FROM users ORDER BY rowid").fetchall()
+        return [dict(zip(USER_COLUMNS, row)) for row in rows]
+
+
+def open_user_store(kind=None, root=None, path=None):
+    """Create the user store of the backend named by kind (default: $EXPENSE_STORAGE or "csv")"""
+    kind = kind or os.environ.get('EXPENSE_STORAGE', 'csv')
+    if kind == 'csv':
+        root = root or os.environ.get('EXPENSE_DATA_DIR', '.')
+        return UserDirectory(os.path.join(root, USERS_FILE), os.path.join(root, PASSWORD_UPDATES_FILE))
+    if kind == 'sqlite':
+        return SQLiteUsers(path or os.environ.get('EXPENSE_DB', DEFAULT_DB_FILE))
+    raise ValueError(f"Unknown storage backend: {kind!r}")
@@ -0,0 +1,341 @@
+"""
+Platform-wide expense statistics for operators
+
+Scans every user's ledger and reports registered and active users, spend per
+month and category, and month-over-month growth:
+    python analytics.py scan --csv-dir . --output stats.json
+
+CSV ledgers are scanned in a process pool. Users are handed to the workers
+in batches; a worker streams each monthly file record by record and returns
+only a small partial aggregate per (user, month), which the parent merges,
+so the work scales with the number of cores and memory stays flat however
+large the ledgers are. With --state, the partials are saved together with the (mtime, size)
+of the files they came from, and the next run only rescans months whose
+files changed. The scan only reads: users whose files are still in an older
+layout (see storage.CSVStorage) are left out and counted in
+"unmigrated_users" until their next visit to the app migrates them (or, for
+the flat layout, "python storage.py shard").
+
+With --db the same statistics come from one GROUP BY over the SQLite backend.
+
+Spend is in the base currency: amounts in other currencies are converted
+with the rate table (--rates, default the one in the data root, see
+currency.py), and saved partials are only reused while that table is
+unchanged. Expenses in a currency without any rate are left out of spend and
+counted in "unconverted_expenses".
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+import accounts
+import currency
+import storage
+from csvfiles import iter_csv_records
+from schema import AMOUNT_SCALE, BASE_CURRENCY, CATEGORIES, from_minor, to_minor
+
+STATE_VERSION = 3
+# Users per task handed to a worker
+BATCH_SIZE = 64
+# Field positions in the expense files; files from before expenses had a
+# currency end after Note
+ID, DATE, CATEGORY, AMOUNT, CURRENCY = (
+    storage.EXPENSE_COLUMNS.index(column) for column in ('ID', 'Date', 'Category', 'Amount', 'Currency')
+)
+
+_worker_store = None
+_worker_rates = None
+
+
+def _init_worker(root, rates_file):
+    global _worker_store, _worker_rates
+    _worker_store = storage.CSVStorage(root)
+    _worker_rates = rates_file
+
+
+def _scan_partition(store, mobile, period):
+    """Partial aggregate of one user's month: {'count', 'total', 'categories': {name: [total, count]}}"""
+    # Most monthly files hold a few dozen rows, where parsing them with pandas
+    # costs far more than the rows themselves; the csv module streams them
+    # at a fraction of that and keeps memory flat for the large ones
+    deleted = {row[0] for row in iter_csv_records(store.deleted_file(mobile, period))}
+    known = set(CATEGORIES)
+    partial = {'count': 0, 'total': 0, 'categories': {}}
+    # Rows in other currencies are set aside and converted together at the end
+    foreign = []
+    for row in iter_csv_records(store.expense_file(mobile, period)):
+        if row[ID] in deleted:
+            continue
+        category = row[CATEGORY] if row[CATEGORY] in known else 'Other'
+        code = row[CURRENCY] if len(row) > CURRENCY and row[CURRENCY] else BASE_CURRENCY
+        if code != BASE_CURRENCY:
+            foreign.append((category, to_minor(row[AMOUNT]), code, row[DATE]))
+            continue
+        _account(partial, category, to_minor(row[AMOUNT]))
+    if foreign:
+        rates = currency.get_rates(_worker_rates)
+        convertible = rates.convertible([row[2] for row in foreign])
+        partial['unconverted'] = int((~convertible).sum())
+        foreign = [row for row, keep in zip(foreign, convertible) if keep]
+    if foreign:
+        categories, amounts, codes, days = zip(*foreign)
+        for category, minor in zip(categories, rates.to_base(amounts, codes, days)):
+            _account(partial, category, int(minor))
+    return partial
+
+
+def _account(partial, category, minor):
+    entry = partial['categories'].setdefault(category, [0, 0])
+    entry[0] += minor
+    entry[1] += 1
+    partial['count'] += 1
+    partial['total'] += minor
+
+
+def scan_users(mobiles, known):
+    """
+    Worker task: the partials of every month of mobiles
+    known maps "mobile|period" to the file signature of a saved partial; those
+    months are skipped when their files are unchanged
+    Returns (a list of (key, signature, partial or None when unchanged),
+    the mobiles left out because their files are in an older layout)
+    """
+    results, unmigrated = [], []
+    for mobile in mobiles:
+        periods = _worker_store.stored_periods(mobile)
+        if periods is None:
+            unmigrated.append(mobile)
+            continue
+        for period in periods:
+            key = f"{mobile}|{period}"
+            signature = json.loads(json.dumps(_worker_store.partition_signature(mobile, period)))
+            if known.get(key) == signature:
+                results.append((key, signature, None))
+            else:
+                results.append((key, signature, _scan_partition(_worker_store, mobile, period)))
+    return results, unmigrated
+
+
+def load_state(path, rates):
+    """Saved partials ({key: {'signature', 'partial'}}) of an earlier run with the same rates, or {}"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('version') != STATE_VERSION or state.get('rates') != json.loads(json.dumps(rates)):
+        return {}
+    return state['partitions']
+
+
+def save_state(path, partitions, rates):
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump({'version': STATE_VERSION, 'rates': rates, 'partitions': partitions}, f)
+    os.replace(temp, path)
+
+
+def scan_csv(root, workers=None, state_path=None, progress=None, rates_file=None):
+    """
+    Partials of every user's months in a CSV data directory, scanned in parallel
+    Returns (users, partials by "mobile|period", number of months rescanned,
+    mobiles left out because their files are in an older layout)
+    """
+    users = accounts.open_user_store('csv', root=root).records()
+    rates = currency.get_rates(rates_file).version
+    previous = load_state(state_path, rates)
+    batches = [[user['mobile'] for user in users[n:n + BATCH_SIZE]] for n in range(0, len(users), BATCH_SIZE)]
+
+    signatures = {}
+    for key, entry in previous.items():
+        signatures.setdefault(key.split('|', 1)[0], {})[key] = entry['signature']
+
+    partitions, unmigrated, rescanned, done = {}, [], 0, 0
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(root, rates_file)) as pool:
+        futures = {}
+        for batch in batches:
+            known = {key: signature for mobile in batch for key, signature in signatures.get(mobile, {}).items()}
+            futures[pool.submit(scan_users, batch, known)] = len(batch)
+        for future in concurrent.futures.as_completed(futures):
+            results, left_out = future.result()
+            unmigrated += left_out
+            for key, signature, partial in results:
+                if partial is None:
+                    partial = previous[key]['partial']
+                else:
+                    rescanned += 1
+                partitions[key] = {'signature': signature, 'partial': partial}
+            done += futures[future]
+            if progress:
+                progress(done, len(users), rescanned)
+
+    if state_path:
+        save_state(state_path, partitions, rates)
+    return users, {key: entry['partial'] for key, entry in partitions.items()}, rescanned, unmigrated
+
+
+def scan_sqlite(path, rates_file=None):
+    """
+    Partials of every user's months from the SQLite backend: one aggregate
+    query over the base-currency rows, the others converted in one pass
+    """
+    store = storage.SQLiteStorage(path)
+    partitions = {}
+    with store.connection() as conn:
+        rows = conn.execute(
+            f"SELECT mobile, substr(date, 1, 7), category, COUNT(*), "
+            f"SUM(CAST(ROUND(amount * {AMOUNT_SCALE}) AS INTEGER)) "
+            "FROM expenses WHERE currency = ? GROUP BY mobile, substr(date, 1, 7), category",
+            (BASE_CURRENCY,)
+        ).fetchall()
+        foreign = pd.read_sql_query(
+            f"SELECT mobile, date, category, CAST(ROUND(amount * {AMOUNT_SCALE}) AS INTEGER) AS amount, currency "
+            "FROM expenses WHERE currency != ?",
+            conn, params=(BASE_CURRENCY,)
+        )
+    unconverted = {}
+    if len(foreign):
+        rates = currency.get_rates(rates_file)
+        convertible = rates.convertible(foreign['currency'])
+        left_out = foreign[~convertible]
+        unconverted = left_out.groupby(left_out['mobile'] + '|' + left_out['date'].str[:7]).size().to_dict()
+        foreign = foreign[convertible]
+        foreign = foreign.assign(amount=rates.to_base(foreign['amount'], foreign['currency'], foreign['date']))
+        converted = foreign.groupby([foreign['mobile'], foreign['date'].str[:7], foreign['category']])['amount']
+        rows += [
+            (mobile, period, category, count, total)
+            for (mobile, period, category), count, total in converted.agg(['count', 'sum']).itertuples()
+        ]
+    for mobile, period, category, count, total in rows:
+        partial = partitions.setdefault(f"{mobile}|{period}", {'count': 0, 'total': 0, 'categories': {}})
+        partial['count'] += int(count)
+        partial['total'] += int(total)
+        entry = partial['categories'].setdefault(category, [0, 0])
+        entry[0] += int(total)
+        entry[1] += int(count)
+    for key, count in unconverted.items():
+        partitions.setdefault(key, {'count': 0, 'total': 0, 'categories': {}})['unconverted'] = int(count)
+    return store.list_users(), partitions
+
+
+def platform_stats(users, partitions, unmigrated=()):
+    """
+    Merge per-(user, month) partials into platform-wide statistics (amounts in
+    the base currency); unmigrated are the users whose files were not scanned
+    """
+    months = {}
+    categories = {}
+    unconverted = 0
+    for key, partial in partitions.items():
+        period = key.split('|', 1)[1]
+        unconverted += partial.get('unconverted', 0)
+        if not partial['count']:
+            continue
+        month = months.setdefault(period, {'active_users': 0, 'expenses': 0, 'spend': 0, 'categories': {}})
+        month['active_users'] += 1
+        month['expenses'] += partial['count']
+        month['spend'] += partial['total']
+        for category, (total, _) in partial['categories'].items():
+            month['categories'][category] = month['categories'].get(category, 0) + total
+            categories[category] = categories.get(category, 0) + total
+
+    signups = {}
+    for user in users:
+        period = str(user.get('created_at') or '')[:7]
+        if period:
+            signups[period] = signups.get(period, 0) + 1
+
+    report, previous = [], None
+    for period in sorted(set(months) | set(signups)):
+        month = months.get(period, {'active_users': 0, 'expenses': 0, 'spend': 0, 'categories': {}})
+        entry = {
+            'month': period,
+            'signups': signups.get(period, 0),
+            'active_users': month['active_users'],
+            'expenses': month['expenses'],
+            'spend': from_minor(month['spend']),
+            'spend_by_category': {name: from_minor(total) for name, total in sorted(month['categories'].items())},
+            'spend_growth_pct': (
+                round((month['spend'] - previous['spend']) / previous['spend'] * 100, 2)
+                if previous and previous['spend'] else None
+            ),
+            'active_user_growth_pct': (
+                round((month['active_users'] - previous['active_users']) / previous['active_users'] * 100, 2)
+                if previous and previous['active_users'] else None
+            ),
+        }
+        report.append(entry)
+        previous = month
+
+    active = {key.split('|', 1)[0] for key, partial in partitions.items() if partial['count']}
+    total = sum(month['spend'] for month in months.values())
+    return {
+        'registered_users': len(users),
+        'users_with_expenses': len(active),
+        'expenses': sum(month['expenses'] for month in months.values()),
+        'spend': from_minor(total),
+        'spend_by_category': {name: from_minor(amount) for name, amount in sorted(categories.items())},
+        'unconverted_expenses': unconverted,
+        'unmigrated_users': len(unmigrated),
+        'months': report,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home Expense Tracker platform analytics")
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan = commands.add_parser('scan', help="compute platform-wide statistics over every user")
+    scan.add_argument('--csv-dir', default=os.environ.get('EXPENSE_DATA_DIR', '.'), help="data root holding users.csv")
+    scan.add_argument('--db', help="scan this SQLite database instead of a CSV directory")
+    scan.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU)")
+    scan.add_argument('--state', help="file keeping per-month partials between runs, for incremental scans")
+    scan.add_argument('--output', help="write the statistics as JSON here instead of stdout")
+    scan.add_argument('--rates', help="exchange rate table (default: the one in the data root, see currency.py)")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    args.rates = args.rates or currency.rates_file(None if args.db else args.csv_dir)
+    if args.db:
+        users, partitions = scan_sqlite(args.db, args.rates)
+        rescanned, unmigrated = len(partitions), []
+    else:
+        def progress(done, total, rescanned):
+            elapsed = time.perf_counter() - started
+            print(
+                f"\r[{done}/{total} users] {rescanned} months scanned, {done / max(elapsed, 1e-9):,.0f} users/s",
+                end='', file=sys.stderr, flush=True
+            )
+
+        users, partitions, rescanned, unmigrated = scan_csv(
+            args.csv_dir, args.workers, args.state, progress, args.rates
+        )
+        print(file=sys.stderr)
+        if unmigrated:
+            print(
+                f"Left out {len(unmigrated)} users whose files are in an older layout; they are migrated when "
+                f"they next sign in, or at once by 'python storage.py shard --csv-dir {args.csv_dir}' for flat files",
+                file=sys.stderr
+            )
+    stats = platform_stats(users, partitions, unmigrated)
+    print(
+        f"{len(users)} users, {len(partitions)} user-months ({rescanned} scanned, "
+        f"{len(partitions) - rescanned} unchanged) in {time.perf_counter() - started:.1f}s",
+        file=sys.stderr
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(stats, f, indent=2)
+    else:
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Choose the scrypt cost for a target login latency
+
+For each candidate cost n, a burst of --concurrency logins (password
+verifications) is pushed through a worker pool shaped like the app's
+(--workers threads) and the time from submitting to finishing every login
+is recorded. The largest n whose p95 latency stays under the target is
+printed as the PASSWORD_SCRYPT_N setting to use.
+
+Usage:
+    python benchmarks/calibrate_kdf.py --concurrency 8 --target-p95-ms 250
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords  # noqa: E402
+
+
+def login_latencies(n, concurrency, workers, rounds):
+    """Latency (seconds) of every login in rounds bursts of concurrent logins at cost n"""
+    stored = passwords.hash_password('calibration', n=n)
+    latencies = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in range(rounds):
+            started = time.perf_counter()
+            futures = [pool.submit(passwords.verify_password, 'calibration', stored) for _ in range(concurrency)]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=8, help="logins arriving at the same time")
+    parser.add_argument('--target-p95-ms', type=float, default=250.0, help="acceptable p95 login latency")
+    parser.add_argument('--workers', type=int, default=passwords.KDF_WORKERS, help="KDF worker threads")
+    parser.add_argument('--rounds', type=int, default=5, help="bursts measured per cost")
+    parser.add_argument('--min-log2', type=int, default=12, help="smallest cost to try, as log2(n)")
+    parser.add_argument('--max-log2', type=int, default=18, help="largest cost to try, as log2(n)")
+    args = parser.parse_args(argv)
+
+    print(f"concurrency={args.concurrency} workers={args.workers} target p95={args.target_p95_ms:.0f}ms")
+    print(f"{'n':>8} {'memory/worker':>14} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    chosen = None
+    for log2 in range(args.min_log2, args.max_log2 + 1):
+        n = 2 ** log2
+        latencies = np.array(login_latencies(n, args.concurrency, args.workers, args.rounds)) * 1000
+        p50, p95 = np.percentile(latencies, [50, 95])
+        memory = 128 * passwords.SCRYPT_R * n / 2 ** 20
+        print(f"{n:>8} {memory:>11.0f} MiB {p50:>9.1f} {p95:>9.1f}")
+        if p95 > args.target_p95_ms:
+            break
+        chosen = n
+
+    if chosen is None:
+        print(f"Even n={2 ** args.min_log2} misses the target; add workers or lower --min-log2")
+        return 1
+    if chosen < 2 ** 14:
+        print("Note: n below 16384 is weaker than the usual interactive-login recommendation")
+    print(f"export PASSWORD_SCRYPT_N={chosen}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
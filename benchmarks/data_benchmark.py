@@ -0,0 +1,244 @@
+"""
+Headless benchmark suite for the data functions behind the app
+
+Generates synthetic ledgers (see synthetic.py) of each --sizes row count,
+copies them into every --backends storage, and times the storage calls that
+expense_tracker.py's data functions make, without Streamlit:
+
+    load_users                list every user (fresh store, files parsed again)
+    verify_user               look up a user and check the password
+    load_expenses             all of a user's expenses (fresh store / warmed up)
+    calculate_total_expenses  total of every month (fresh store / warmed up)
+    expense_summary           the figures of the analysis section (category
+                              breakdown, daily average) for every month
+    expense_trend             the daily, weekly and monthly trend series of
+                              every month, rolled up from the summary cube
+    query_expenses            first table page of the latest month / all time
+    search_expenses           first table page of a note search over all time
+                              (prefix words, from the note indexes)
+    save_expense              append one expense
+    delete_expense            delete one expense of the ledger
+
+For each it reports throughput, latency percentiles and the peak memory
+traced (tracemalloc) during one extra call, as JSON on stdout or --output.
+Pass a previous run as --compare to flag operations whose median latency
+grew by more than --tolerance; the exit status is then 1.
+
+Usage:
+    python benchmarks/data_benchmark.py --sizes 1000 100000 1000000 --output bench.json
+    python benchmarks/data_benchmark.py --sizes 1000 100000 --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import accounts  # noqa: E402
+import passwords  # noqa: E402
+import schema  # noqa: E402
+import storage  # noqa: E402
+import synthetic  # noqa: E402
+
+# Calls measured per operation, by how expensive a single call is
+OPS = {
+    'load_users': 5, 'verify_user': 10, 'load_expenses (cold)': 3, 'load_expenses (warm)': 20,
+    'calculate_total_expenses (cold)': 3, 'calculate_total_expenses (warm)': 50,
+    'expense_summary': 50, 'expense_trend': 20, 'query_expenses (month)': 20, 'query_expenses (all time)': 10,
+    'search_expenses': 50,
+    'save_expense': 200, 'delete_expense': 100,
+}
+
+
+def open_backend(kind, root):
+    """A fresh storage object (empty caches) over the benchmark data"""
+    if kind == 'csv':
+        return storage.CSVStorage(root)
+    return storage.SQLiteStorage(os.path.join(root, 'expenses.db'))
+
+
+def analysis(store, mobile):
+    """The aggregations of the app's analysis section, from the stored summary"""
+    periods = store.expense_periods(mobile)
+    summary = store.summary(mobile, periods)
+    categories = schema.from_minor(
+        pd.Series(summary['category_totals'], name='Amount', dtype='int64')
+    ).sort_values(ascending=False)
+    days = (schema.period_bounds(periods[-1])[1] - schema.period_bounds(periods[0])[0]).days + 1
+    return categories, schema.from_minor(summary['total']) / days
+
+
+def trends(store, mobile):
+    """The trend series of the app's analysis section, at every grain"""
+    periods = store.expense_periods(mobile)
+    return [store.trend(mobile, periods, grain) for grain in ('day', 'week', 'month')]
+
+
+def operations(kind, root, mobile, ids):
+    """(name, callable taking the call number) of every measured operation, in order"""
+    store = open_backend(kind, root)
+    users = store.users
+    user_count = len(users.records())
+    store.load_expenses(mobile)
+    store.summary(mobile)
+    store.search_expenses(mobile, 'warm-up')
+    latest = store.expense_periods(mobile)[-1]
+    first, last = schema.period_bounds(latest)
+    rng = random.Random(0)
+
+    def verify_user(_):
+        record = users.get(synthetic.mobile_number(rng.randrange(user_count)))
+        return passwords.verify_password(synthetic.PASSWORD, record['password'])
+
+    def save_expense(_):
+        date = pd.Timestamp(latest) + pd.Timedelta(days=rng.randrange(28))
+        return store.append_expense(mobile, date, rng.choice(schema.CATEGORIES), rng.randrange(1, 50_000), 'bench')
+
+    return [
+        ('load_users', lambda _: accounts.open_user_store(kind, root=root, path=os.path.join(root, 'expenses.db')).records()),
+        ('verify_user', verify_user),
+        ('load_expenses (cold)', lambda _: open_backend(kind, root).load_expenses(mobile)),
+        ('load_expenses (warm)', lambda _: store.load_expenses(mobile)),
+        ('calculate_total_expenses (cold)', lambda _: open_backend(kind, root).total_expenses(mobile)),
+        ('calculate_total_expenses (warm)', lambda _: store.total_expenses(mobile)),
+        ('expense_summary', lambda _: analysis(store, mobile)),
+        ('expense_trend', lambda _: trends(store, mobile)),
+        ('query_expenses (month)', lambda _: store.query_expenses(mobile, first, last)),
+        ('query_expenses (all time)', lambda _: store.query_expenses(mobile)),
+        ('search_expenses', lambda call: store.search_expenses(mobile, ['groc', 'school fee', 'ph', 'bill'][call % 4])),
+        ('save_expense', save_expense),
+        ('delete_expense', lambda call: store.delete_expense(mobile, ids[call])),
+    ]
+
+
+def measure(function, ops):
+    """Latencies (seconds) of ops calls, plus the traced peak memory (bytes) of one more"""
+    latencies = []
+    for call in range(ops):
+        started = time.perf_counter()
+        function(call)
+        latencies.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        function(ops)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return latencies, peak
+
+
+def result_row(backend, rows, name, latencies, peak):
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {
+        'backend': backend,
+        'rows': rows,
+        'operation': name,
+        'ops': len(latencies),
+        'throughput_per_s': round(len(latencies) / sum(latencies), 2),
+        'latency_ms': {
+            'mean': round(float(latencies_ms.mean()), 3), 'p50': round(float(p50), 3),
+            'p95': round(float(p95), 3), 'p99': round(float(p99), 3), 'max': round(float(latencies_ms.max()), 3),
+        },
+        'peak_memory_mb': round(peak / 2 ** 20, 2),
+    }
+
+
+def run_size(rows, backends, users, password_hash):
+    """Generate a ledger of rows expenses and benchmark it on every backend"""
+    results = []
+    for kind in backends:
+        with tempfile.TemporaryDirectory() as root:
+            started = time.perf_counter()
+            mobile = synthetic.generate(root, users=users, rows=rows, password_hash=password_hash)[0]
+            if kind == 'sqlite':
+                storage.migrate_csv_to_sqlite(storage.CSVStorage(root), open_backend(kind, root))
+            print(f"[{kind} {rows:,} rows] data ready in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+            ids = open_backend(kind, root).load_expenses(mobile)['ID'].sample(
+                n=min(rows, OPS['delete_expense'] + 1), random_state=0
+            ).tolist()
+            for name, function in operations(kind, root, mobile, ids):
+                ops = min(OPS[name], len(ids) - 1) if name == 'delete_expense' else OPS[name]
+                row = result_row(kind, rows, name, *measure(function, ops))
+                results.append(row)
+                print(
+                    f"  {name:<34} {row['throughput_per_s']:>10,.1f}/s  p50 {row['latency_ms']['p50']:>9.2f}ms  "
+                    f"p95 {row['latency_ms']['p95']:>9.2f}ms  peak {row['peak_memory_mb']:>8.1f}MiB",
+                    file=sys.stderr
+                )
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Operations whose p50 latency exceeds the baseline's by more than tolerance (a fraction)"""
+    before = {(row['backend'], row['rows'], row['operation']): row for row in baseline['results']}
+    slower = []
+    for row in results:
+        old = before.get((row['backend'], row['rows'], row['operation']))
+        if old and row['latency_ms']['p50'] > old['latency_ms']['p50'] * (1 + tolerance):
+            slower.append((row, old))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100_000, 1_000_000], help="ledger rows")
+    parser.add_argument('--backends', nargs='+', choices=['csv', 'sqlite'], default=['csv', 'sqlite'])
+    parser.add_argument('--users', type=int, default=1000, help="registered users")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', help="JSON report of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed p50 slowdown, as a fraction")
+    args = parser.parse_args(argv)
+
+    password_hash = passwords.hash_password(synthetic.PASSWORD)
+    results = []
+    for rows in args.sizes:
+        results.extend(run_size(rows, args.backends, args.users, password_hash))
+
+    report = {
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'pandas': pd.__version__, 'scrypt_n': passwords.SCRYPT_N,
+        },
+        'results': results,
+        # ru_maxrss is in KiB on Linux
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for row, old in slower:
+            print(
+                f"REGRESSION {row['backend']} {row['rows']:,} rows {row['operation']}: "
+                f"p50 {old['latency_ms']['p50']:.2f}ms -> {row['latency_ms']['p50']:.2f}ms",
+                file=sys.stderr
+            )
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Time a bulk statement import end to end
+
+Builds a synthetic bank statement (day-first dates, thousands separators,
+debits and credits in one column), then times each stage of importing it
+into an empty ledger - parsing, preparing (validation and category mapping),
+the duplicate check and the write - and a second import of the same
+statement, which must add nothing.
+
+Usage:
+    python benchmarks/import_benchmark.py --rows 100000 --backend sqlite
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import importer  # noqa: E402
+import storage  # noqa: E402
+
+DESCRIPTIONS = [
+    'KFC Gulberg', 'LESCO electricity bill', 'SNGPL gas bill', 'Landlord rent', 'City School fee',
+    'Fazal Din Pharma', 'Shell fuel', 'Daraz order', 'Salary credit', 'ATM withdrawal',
+]
+
+
+def make_statement(rows, seed=0):
+    """CSV bytes of a statement with rows transactions (about one in ten a credit)"""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D')
+    amounts = rng.integers(100, 5_000_000, rows) / 100
+    signs = np.where(rng.random(rows) < 0.9, '-', '')
+    return pd.DataFrame({
+        'Txn Date': dates.strftime('%d/%m/%Y'),
+        'Description': rng.choice(DESCRIPTIONS, rows),
+        'Amount': [f"{sign}{amount:,.2f}" for sign, amount in zip(signs, amounts)],
+    }).to_csv(index=False).encode('utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    args = parser.parse_args(argv)
+
+    data = make_statement(args.rows)
+    with tempfile.TemporaryDirectory() as root:
+        store = storage.CSVStorage(root) if args.backend == 'csv' else storage.SQLiteStorage(os.path.join(root, 'x.db'))
+        timings = {}
+
+        started = time.perf_counter()
+        raw = importer.read_statement(data, 'statement.csv')
+        timings['parse'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        mapping = importer.guess_columns(raw.columns)
+        expenses, skipped = importer.prepare_statement(raw, mapping, importer.has_debit_signs(raw, mapping['Amount']))
+        timings['prepare'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        new, duplicates = importer.drop_existing(store, 'bench', expenses)
+        timings['dedupe'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store.append_expenses('bench', new)
+        timings['write'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        imported_again, duplicates_again = importer.import_expenses(store, 'bench', expenses)
+        timings['re-import'] = time.perf_counter() - started
+
+    print(f"{args.rows:,} statement rows ({args.backend}): {len(new):,} imported, {len(skipped):,} skipped")
+    for stage, seconds in timings.items():
+        print(f"  {stage:<10} {seconds * 1000:>9.1f} ms")
+    first_import = sum(seconds for stage, seconds in timings.items() if stage != 're-import')
+    print(f"  {'total':<10} {first_import * 1000:>9.1f} ms ({args.rows / first_import:,.0f} rows/s)")
+    if imported_again or duplicates_again != len(expenses):
+        print(f"Re-import added {imported_again} rows - duplicate check failed")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
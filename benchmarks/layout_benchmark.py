@@ -0,0 +1,138 @@
+"""
+Compare file open and listing times of the flat and the sharded data layout
+
+Fills a data root with the files of many users in the flat layout
+(<mobile>_expenses_2024-01.csv next to users.csv), times listing a user's
+months, opening a user's file, creating a file and walking the whole root,
+then moves everything into the per-user directories with
+CSVStorage.shard_all() (as "python storage.py shard" does) and times the same
+operations again.
+
+Usage:
+    python benchmarks/layout_benchmark.py --users 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from synthetic import mobile_number, write_users  # noqa: E402
+
+PERIODS = ['2024-01', '2024-02', '2024-03']
+
+
+def write_flat(root, users):
+    """Register users and write a salary file and one small expense file per period for each, flat layout"""
+    write_users(root, users, 'x')
+    for n in range(users):
+        prefix = os.path.join(root, storage.get_user_filename(mobile_number(n), ''))
+        with open(prefix + storage.SALARY_FILE, 'w') as f:
+            f.write('salary,date\n50000,2024-01-01\n')
+        for period in PERIODS:
+            with open(prefix + storage.PERIOD_EXPENSES_FILE.format(period=period), 'w') as f:
+                f.write(f"ID,Date,Category,Amount,Note,Currency\n{n:016x},{period}-05,Food,100.00,x,PKR\n")
+
+
+def flat_periods(root, mobile):
+    """A user's months in the flat layout: what CSVStorage had to list before user directories"""
+    prefix = storage.get_user_filename(mobile, 'expenses_')
+    with os.scandir(root) as entries:
+        return sorted(entry.name[len(prefix):-4] for entry in entries
+                      if entry.name.startswith(prefix) and len(entry.name) == len(prefix) + 11)
+
+
+def timed(function, runs):
+    """Median and worst time of runs calls, in milliseconds"""
+    times = []
+    for run in range(runs):
+        started = time.perf_counter()
+        function(run)
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[-1]
+
+
+def walk(root):
+    """Visit every file under root, as a backup would"""
+    count = 0
+    for _, _, files in os.walk(root):
+        count += len(files)
+    return count
+
+
+def measure(root, users, runs, list_periods, open_path, create_path):
+    rng = random.Random(0)
+    picks = [mobile_number(rng.randrange(users)) for _ in range(runs)]
+
+    def read(run):
+        with open(open_path(picks[run])) as f:
+            f.read()
+
+    def create(run):
+        with open(create_path(picks[run], run), 'w') as f:
+            f.write('x\n')
+
+    results = {
+        'list months': timed(lambda run: list_periods(picks[run]), runs),
+        'open + read': timed(read, runs),
+        'create file': timed(create, runs),
+    }
+    for run in range(runs):
+        os.remove(create_path(picks[run], run))
+    started = time.perf_counter()
+    files = walk(root)
+    results['walk root'] = ((time.perf_counter() - started) * 1000, files)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--runs', type=int, default=200, help="timed calls per operation")
+    parser.add_argument('--dir', help="parent of the temporary data root (default: the system temp directory)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        started = time.perf_counter()
+        write_flat(root, args.users)
+        print(f"{args.users:,} users, {args.users * (len(PERIODS) + 1):,} files "
+              f"written in {time.perf_counter() - started:.1f}s")
+
+        flat = measure(
+            root, args.users, args.runs,
+            list_periods=lambda mobile: flat_periods(root, mobile),
+            open_path=lambda mobile: os.path.join(root, storage.get_user_filename(mobile, 'expenses_2024-02.csv')),
+            create_path=lambda mobile, run: os.path.join(root, storage.get_user_filename(mobile, f'bench_{run}.csv')),
+        )
+
+        store = storage.CSVStorage(root)
+        started = time.perf_counter()
+        moved, conflicts = store.shard_all()
+        migration = time.perf_counter() - started
+        print(f"Moved {moved:,} users into user directories in {migration:.1f}s "
+              f"({moved / max(migration, 1e-9):,.0f} users/s, {len(conflicts)} with conflicts)")
+
+        sharded = measure(
+            root, args.users, args.runs,
+            list_periods=store.expense_periods,
+            open_path=lambda mobile: store.expense_file(mobile, '2024-02'),
+            create_path=lambda mobile, run: store.user_file(mobile, f'bench_{run}.csv'),
+        )
+
+    print(f"{'':14} {'flat p50':>10} {'max':>9} {'sharded p50':>12} {'max':>9}  (ms)")
+    for operation in ('list months', 'open + read', 'create file'):
+        print(f"{operation:14} {flat[operation][0]:10.3f} {flat[operation][1]:9.3f} "
+              f"{sharded[operation][0]:12.3f} {sharded[operation][1]:9.3f}")
+    print(f"{'walk root':14} {flat['walk root'][0]:10.1f} {'':9} {sharded['walk root'][0]:12.1f}"
+          f"   ({sharded['walk root'][1]:,} files)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
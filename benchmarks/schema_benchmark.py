@@ -0,0 +1,82 @@
+"""
+Memory and parse-time comparison of the untyped and typed expense frames
+
+Writes a synthetic expense file, then reads it back the old way (plain
+pandas inference: object dates, categories and notes, float amounts) and
+through schema.apply_expense_schema, and reports the deep memory usage and
+read time of both, plus how long a category/day aggregation takes on each.
+
+Usage:
+    python benchmarks/schema_benchmark.py --rows 1000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schema  # noqa: E402
+import storage  # noqa: E402
+
+
+def write_ledger(filename, rows, seed=0):
+    """Write a synthetic expense file with the given number of rows"""
+    rng = np.random.default_rng(seed)
+    days = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 5 * 365, rows), unit='D')
+    df = pd.DataFrame({
+        'ID': [f"{n:016x}" for n in range(rows)],
+        'Date': days.strftime('%Y-%m-%d'),
+        'Category': rng.choice(schema.CATEGORIES, rows),
+        'Amount': [schema.format_minor(minor) for minor in rng.integers(100, 5_000_000, rows)],
+        'Note': rng.choice(['', 'groceries', 'monthly rent', 'school fee', 'pharmacy'], rows),
+        'Currency': schema.BASE_CURRENCY,
+    })
+    df.to_csv(filename, index=False)
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000, help="rows in the synthetic expense file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as root:
+        filename = os.path.join(root, 'expenses.csv')
+        write_ledger(filename, args.rows)
+
+        untyped, untyped_read = timed(lambda: storage.read_csv_file(filename, storage.EXPENSE_COLUMNS, dtype={'ID': str}))
+        typed, typed_read = timed(lambda: schema.apply_expense_schema(
+            storage.read_csv_file(filename, storage.EXPENSE_COLUMNS, dtype=schema.CSV_DTYPES)
+        ))
+
+    _, untyped_group = timed(lambda: untyped.groupby([untyped['Date'].astype(str), 'Category'])['Amount'].sum())
+    _, typed_group = timed(lambda: typed.groupby(['Date', 'Category'], observed=True)['Amount'].sum())
+
+    print(f"{args.rows:,} rows")
+    print(f"{'':10} {'memory (MB)':>12} {'read (s)':>10} {'group-by (s)':>13}")
+    for name, df, read, group in (
+        ('untyped', untyped, untyped_read, untyped_group),
+        ('typed', typed, typed_read, typed_group),
+    ):
+        memory = df.memory_usage(deep=True).sum() / 1e6
+        print(f"{name:10} {memory:12.1f} {read:10.2f} {group:13.3f}")
+    for column in storage.EXPENSE_COLUMNS:
+        before = untyped[column].memory_usage(deep=True, index=False) / 1e6
+        after = typed[column].memory_usage(deep=True, index=False) / 1e6
+        print(f"  {column:9} {before:8.1f} MB -> {after:8.1f} MB ({typed[column].dtype})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Time snapshots of a data root and per-user restores
+
+Fills a data root with synthetic ledgers (see synthetic.py), then times a
+first full snapshot, a snapshot with nothing changed, a snapshot after one
+expense was added for each of --changed users, and restoring single users,
+as "python snapshots.py take" / "restore" do.
+
+Usage:
+    python benchmarks/snapshot_benchmark.py --users 10000 --rows 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshots  # noqa: E402
+import storage  # noqa: E402
+from synthetic import generate, mobile_number  # noqa: E402
+
+
+def report(name, manifest):
+    stats = manifest['stats']
+    print(f"{name:22} {stats['seconds']:8.2f}s {stats['files']:>10,} files {stats['read']:>14,} bytes read "
+          f"{stats['objects']:>9,} new objects {stats['stored']:>13,} bytes stored")
+
+
+def disk_usage(directory):
+    """Number of files under a directory and the bytes they take on disk (whole blocks where known)"""
+    count = size = 0
+    for parent, _, names in os.walk(directory):
+        for name in names:
+            stat = os.stat(os.path.join(parent, name))
+            count += 1
+            size += stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+    return count, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--rows', type=int, default=1_000_000, help="expenses spread over all the users")
+    parser.add_argument('--changed', type=int, default=100, help="users adding an expense between snapshots")
+    parser.add_argument('--runs', type=int, default=50, help="timed restores")
+    parser.add_argument('--dir', help="parent of the temporary data root (default: the system temp directory)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        started = time.perf_counter()
+        generate(root, users=args.users, rows=args.rows, ledger_users=args.users, password_hash='x')
+        print(f"{args.users:,} users, {args.rows:,} expenses written in {time.perf_counter() - started:.1f}s")
+
+        store = storage.CSVStorage(root)
+        repository = snapshots.open_repository(root)
+        report('first snapshot', repository.take(root))
+        report('nothing changed', repository.take(root))
+
+        rng = random.Random(0)
+        for n in rng.sample(range(args.users), min(args.changed, args.users)):
+            store.append_expense(mobile_number(n), '2023-12-31', 'Food', 250, 'benchmark')
+        report(f'{args.changed} users changed', repository.take(root))
+
+        snapshot_id = repository.list()[0]['id']
+        times = []
+        for _ in range(args.runs):
+            mobile = mobile_number(rng.randrange(args.users))
+            started = time.perf_counter()
+            repository.restore_user(store, snapshot_id, mobile)
+            times.append((time.perf_counter() - started) * 1000)
+        times.sort()
+        print(f"restore one user       p50 {times[len(times) // 2]:.1f} ms, max {times[-1]:.1f} ms "
+              f"(includes the snapshot taken before restoring)")
+
+        objects, size = disk_usage(repository.objects)
+        files, data = disk_usage(os.path.join(root, storage.USER_DATA_DIR))
+        print(f"repository: {objects:,} objects, {size:,} bytes; user files: {files:,} files, {data:,} bytes "
+              f"({len(repository.list())} snapshots)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
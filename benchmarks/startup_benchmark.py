@@ -0,0 +1,89 @@
+"""
+Cold-start time of the app's first render
+
+Each measurement runs in a fresh Python process (nothing imported yet) and
+renders the app once through Streamlit's AppTest harness, in an empty data
+directory:
+- login:       the login page, as a new visitor sees it
+- login-eager: the login page with pandas and the storage layer imported
+               up front, as every page did before the login path was slimmed
+- tracker:     the expense tracker page of a logged-in user
+
+Reported per scenario: the median render time (excluding the import of
+Streamlit itself, which every scenario pays) and whether pandas got imported.
+
+Usage:
+    python benchmarks/startup_benchmark.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['login', 'login-eager', 'tracker']
+
+
+def render_once(scenario):
+    """Render the app once in this (fresh) process; returns (seconds, pandas imported)"""
+    from streamlit.testing.v1 import AppTest
+
+    sys.path.insert(0, APP_DIR)
+    started = time.perf_counter()
+    if scenario == 'login-eager':
+        import export  # noqa: F401
+        import storage  # noqa: F401
+    app = AppTest.from_file(os.path.join(APP_DIR, 'expense_tracker.py'), default_timeout=120)
+    if scenario == 'tracker':
+        app.session_state.authenticated = True
+        app.session_state.user_mobile = '923001234567'
+        app.session_state.user_name = 'Benchmark'
+    app.run()
+    elapsed = time.perf_counter() - started
+    if app.exception:
+        raise RuntimeError(app.exception)
+    return elapsed, 'pandas' in sys.modules
+
+
+def measure(scenario, runs):
+    """Times of runs cold renders of a scenario, each in a new process and data directory"""
+    times, pandas_loaded = [], set()
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as root:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', scenario],
+                cwd=root, check=True, capture_output=True, text=True
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        pandas_loaded.add(result['pandas'])
+    return times, pandas_loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="cold renders per scenario")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        seconds, pandas_loaded = render_once(args.child)
+        print(json.dumps({'seconds': seconds, 'pandas': pandas_loaded}))
+        return 0
+
+    print(f"{'scenario':<12} {'median (ms)':>12} {'min (ms)':>9} {'pandas':>7}")
+    for scenario in args.scenarios:
+        times, pandas_loaded = measure(scenario, args.runs)
+        pandas_column = '/'.join('yes' if loaded else 'no' for loaded in sorted(pandas_loaded))
+        print(f"{scenario:<12} {statistics.median(times) * 1000:>12.0f} {min(times) * 1000:>9.0f} {pandas_column:>7}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Multi-process write stress test for the CSV storage backend
+
+Several processes, each running several threads, append expenses and salary
+entries for one shared household, delete some of the expenses again and all
+race to register the same set of mobile numbers. Afterwards the files are
+checked for lost or duplicated writes and the write throughput is reported.
+
+Usage:
+    python benchmarks/stress_writes.py --processes 4 --threads 4 --writes 200
+"""
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+HOUSEHOLD = '+92 3000000000'
+SIGNUPS = 50
+
+
+def worker(root, process_number, threads, writes, deletes, results):
+    """Hammer one CSVStorage from several threads and report what succeeded"""
+    store = storage.CSVStorage(root)
+    counts = {'expenses': 0, 'salaries': 0, 'deletes': 0, 'signups': 0}
+    counts_lock = threading.Lock()
+
+    def run(thread_number):
+        mine = {'expenses': 0, 'salaries': 0, 'deletes': 0, 'signups': 0}
+        for i in range(writes):
+            expense_id = store.append_expense(
+                HOUSEHOLD, datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 28),
+                'Food', 10.0, f"p{process_number}-t{thread_number}-{i}"
+            )
+            mine['expenses'] += 1
+            if i % 10 == 0:
+                store.append_salary(HOUSEHOLD, 50000.0 + i, '2024-01-01')
+                mine['salaries'] += 1
+            if i < deletes and store.delete_expense(HOUSEHOLD, expense_id):
+                mine['deletes'] += 1
+        for n in range(SIGNUPS):
+            mobile = f"+92 31{n:08d}"
+            record = {'mobile': mobile, 'password': 'x', 'name': f"User {n}", 'created_at': '2024-01-01 00:00:00'}
+            if store.add_user(record):
+                mine['signups'] += 1
+        with counts_lock:
+            for key, value in mine.items():
+                counts[key] += value
+
+    pool = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4, help="threads per process")
+    parser.add_argument('--writes', type=int, default=200, help="expenses appended per thread")
+    parser.add_argument('--deletes', type=int, default=5, help="deletes attempted per thread")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='expense-stress-')
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(root, n, args.threads, args.writes, args.deletes, results))
+        for n in range(args.processes)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    counts = {'expenses': 0, 'salaries': 0, 'deletes': 0, 'signups': 0}
+    for _ in processes:
+        for key, value in results.get().items():
+            counts[key] += value
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    store = storage.CSVStorage(root)
+    expenses = store.load_expenses(HOUSEHOLD)
+    salaries = storage.read_csv_file(store.user_file(HOUSEHOLD, storage.SALARY_FILE), storage.SALARY_COLUMNS)
+    users = storage.read_csv_file(os.path.join(root, storage.USERS_FILE), storage.USER_COLUMNS)
+
+    failures = []
+    if len(expenses) != counts['expenses'] - counts['deletes']:
+        failures.append(f"expenses: {len(expenses)} rows, expected {counts['expenses'] - counts['deletes']}")
+    if expenses['Note'].duplicated().any() or expenses['ID'].duplicated().any():
+        failures.append("expenses: duplicated rows")
+    if len(salaries) != counts['salaries']:
+        failures.append(f"salaries: {len(salaries)} rows, expected {counts['salaries']}")
+    if counts['signups'] != SIGNUPS or len(users) != SIGNUPS or users['mobile'].duplicated().any():
+        failures.append(f"users: {counts['signups']} successful signups, {len(users)} rows, expected {SIGNUPS}")
+
+    writes = counts['expenses'] + counts['salaries'] + counts['deletes'] + counts['signups']
+    print(f"processes={args.processes} threads={args.threads} elapsed={elapsed:.2f}s")
+    print(f"appends={counts['expenses'] + counts['salaries']} deletes={counts['deletes']} signups={counts['signups']}")
+    print(f"throughput={writes / elapsed:,.0f} writes/s")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print("OK - no lost or duplicated writes" if not failures else "FAILED")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Synthetic users and expense ledgers for the benchmarks
+
+Writes a CSV data directory in the app's own layout (users.csv plus a
+directory per user with one expense file per month), vectorized so that million-row ledgers
+take seconds rather than one append per row; copy it into a SQLite database
+with storage.migrate_csv_to_sqlite() to benchmark that backend.
+
+The ledger rows are spread over the ledger users, the rest of the users only
+have an account. Every user's password is PASSWORD.
+
+Usage:
+    python benchmarks/synthetic.py --root /tmp/expense-data --users 1000 --rows 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import accounts  # noqa: E402
+import csvfiles  # noqa: E402
+import passwords  # noqa: E402
+import schema  # noqa: E402
+import storage  # noqa: E402
+
+PASSWORD = 'benchmark-password'
+NOTES = ['', 'groceries', 'monthly rent', 'school fee', 'pharmacy', 'fuel', 'electricity bill']
+
+
+def mobile_number(n):
+    """Mobile number of the n-th synthetic user"""
+    return f"92300{n:07d}"
+
+
+def write_users(root, count, password_hash):
+    """Append count synthetic accounts (all with password_hash) to the users file in root"""
+    rows = [
+        [mobile_number(n), password_hash, f"User {n}", '2024-01-01 00:00:00'] for n in range(count)
+    ]
+    csvfiles.append_csv_rows(os.path.join(root, accounts.USERS_FILE), accounts.USER_COLUMNS, rows)
+
+
+def ledger_frame(rows, start='2021-01-01', days=3 * 365, seed=0):
+    """A DataFrame of rows random expenses in the on-disk layout (text dates, 2-decimal amounts)"""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, rows), unit='D')
+    return pd.DataFrame({
+        'ID': [f"{n:016x}" for n in rng.permutation(rows)],
+        'Date': dates.strftime('%Y-%m-%d'),
+        'Category': rng.choice(schema.CATEGORIES, rows),
+        'Amount': pd.Series(rng.integers(100, 5_000_000, rows)).map(schema.format_minor),
+        'Note': rng.choice(NOTES, rows),
+        'Currency': schema.BASE_CURRENCY,
+    })
+
+
+def write_ledger(store, mobile, df):
+    """Write a ledger frame into a CSVStorage as the user's monthly expense files"""
+    os.makedirs(store.user_directory(mobile), exist_ok=True)
+    for period, month in df.groupby(df['Date'].str[:7], sort=True):
+        month.sort_values('Date').to_csv(store.expense_file(mobile, period), index=False, lineterminator='\n')
+
+
+def generate(root, users=1000, rows=100_000, ledger_users=1, seed=0, password_hash=None):
+    """
+    Fill root with users accounts and a ledger of rows expenses split over the
+    first ledger_users of them; returns the mobile numbers holding the ledger
+    """
+    os.makedirs(root, exist_ok=True)
+    # One hash for every account: the benchmarks measure verification, not signup
+    write_users(root, users, password_hash or passwords.hash_password(PASSWORD))
+    store = storage.CSVStorage(root)
+    frame = ledger_frame(rows, seed=seed)
+    holders = [mobile_number(n) for n in range(min(ledger_users, users))]
+    owners = np.arange(rows) % len(holders)
+    for index, mobile in enumerate(holders):
+        write_ledger(store, mobile, frame[owners == index])
+    return holders
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', required=True, help="data directory to fill (CSV layout)")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=100_000, help="expenses in total")
+    parser.add_argument('--ledger-users', type=int, default=1, help="users the expenses are spread over")
+    parser.add_argument('--sqlite', help="also copy the data into this SQLite database")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    holders = generate(args.root, args.users, args.rows, args.ledger_users, args.seed)
+    print(f"Wrote {args.users} users and {args.rows:,} expenses (held by {', '.join(holders)}) "
+          f"to {args.root} in {time.perf_counter() - started:.1f}s")
+    if args.sqlite:
+        storage.migrate_csv_to_sqlite(storage.CSVStorage(args.root), storage.SQLiteStorage(args.sqlite))
+        print(f"Copied into {args.sqlite}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
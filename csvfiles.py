@@ -0,0 +1,306 @@
+"""
+CSV file primitives for the Home Expense Tracker data files
+
+Everything here works on raw bytes and the csv module, without pandas, so
+that the login path (accounts.py) can use it without paying for the pandas
+import; storage.py builds its DataFrame readers and writers on top of it.
+
+Appends are written as whole records in one write followed by fsync, and a
+record torn by a crash is dropped before the next append, so readers only
+ever need to skip an incomplete last line. Every writer takes file_lock().
+"""
+
+import contextlib
+import csv
+import io
+import os
+import tempfile
+import threading
+import weakref
+
+from instrumentation import count_read
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# ============================================
+# APPENDS
+# ============================================
+
+def complete_length(f, size):
+    """Return the length of an open file up to (and including) its last newline"""
+    position = size
+    while position > 0:
+        start = max(0, position - 4096)
+        f.seek(start)
+        block = f.read(position - start)
+        newline = block.rfind(b'\n')
+        if newline != -1:
+            return start + newline + 1
+        position = start
+    return 0
+
+def _encode_rows(columns, rows, with_header):
+    """Serialize rows as CSV; returns the encoded header and the encoded records"""
+    header = b''
+    if with_header:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerow(columns)
+        header = buffer.getvalue().encode('utf-8')
+    records = []
+    for row in rows:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerow(row)
+        records.append(buffer.getvalue().encode('utf-8'))
+    return header, records
+
+def _append_size(f):
+    """Size of a file opened for appending, after dropping a record torn by an earlier crash"""
+    size = os.fstat(f.fileno()).st_size
+    f.seek(max(size - 1, 0))
+    if size > 0 and f.read(1) != b'\n':
+        size = complete_length(f, size)
+        f.truncate(size)
+    return size
+
+def _write_all(f, data):
+    while data:
+        written = f.write(data)
+        data = data[written:]
+    os.fsync(f.fileno())
+
+def append_rows_unlocked(filename, columns, rows):
+    """
+    Append rows to a CSV file in a single write followed by fsync
+    Readers see either whole records or none of them; the caller must hold file_lock(filename)
+    Returns the (start, end) byte offsets of every row
+    """
+    with open(filename, 'a+b', buffering=0) as f:
+        size = _append_size(f)
+        header, records = _encode_rows(columns, rows, with_header=(size == 0))
+
+        offsets = []
+        position = size + len(header)
+        for record in records:
+            offsets.append((position, position + len(record)))
+            position += len(record)
+        if offsets:
+            # The header belongs to the first row written to a new file
+            offsets[0] = (size, offsets[0][1])
+
+        _write_all(f, header + b''.join(records))
+    return offsets
+
+def append_csv_rows(filename, columns, rows):
+    """Append a batch of records to a CSV file as one locked write; returns their offsets"""
+    with file_lock(filename):
+        return append_rows_unlocked(filename, columns, rows)
+
+def append_csv_data(filename, columns, data):
+    """
+    Append already encoded CSV records (bytes ending in a newline, no header)
+    as one locked write followed by fsync, for large batches
+    Returns the (start, end) byte offsets of the whole batch
+    """
+    with file_lock(filename), open(filename, 'a+b', buffering=0) as f:
+        size = _append_size(f)
+        if size == 0:
+            data = _encode_rows(columns, [], with_header=True)[0] + data
+        _write_all(f, data)
+    return size, size + len(data)
+
+class _PendingAppend:
+    """A record waiting for the group writer of its file"""
+
+    def __init__(self, row):
+        self.row = row
+        self.offsets = None
+        self.error = None
+
+class _AppendGroup:
+    """Coalesces concurrent appends to one file into a single locked write"""
+
+    def __init__(self):
+        self.queue_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = []
+
+# A group lives while some thread is appending through it, so the table
+# only holds the files being written right now
+_append_groups = weakref.WeakValueDictionary()
+_append_groups_lock = threading.Lock()
+
+def append_csv_row(filename, columns, row):
+    """
+    Append one record to a CSV file without rewriting it
+    Records appended by concurrent threads while a write is in progress are
+    batched into the next write, so the file lock and fsync are paid once per
+    batch rather than once per record
+    Returns the (start, end) byte offsets of the record
+    """
+    path = os.path.abspath(filename)
+    with _append_groups_lock:
+        group = _append_groups.get(path)
+        if group is None:
+            group = _append_groups[path] = _AppendGroup()
+    entry = _PendingAppend(row)
+    with group.queue_lock:
+        group.pending.append(entry)
+
+    with group.write_lock:
+        if entry.offsets is None and entry.error is None:
+            # Nobody wrote our record yet - write everything queued so far
+            with group.queue_lock:
+                batch, group.pending = group.pending, []
+            try:
+                offsets = append_csv_rows(filename, columns, [pending.row for pending in batch])
+            except Exception as error:
+                for pending in batch:
+                    pending.error = error
+            else:
+                for pending, position in zip(batch, offsets):
+                    pending.offsets = position
+    if entry.error is not None:
+        raise entry.error
+    return entry.offsets
+
+def fsync_directory(directory):
+    """Make a rename durable (not supported on Windows)"""
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(filename, data, durable=True):
+    """
+    Replace a file with data (bytes) through a temporary file renamed over it,
+    so readers see the old or the new contents, never a mix; the caller must
+    hold file_lock(filename) if others write the file. durable=False skips
+    the fsyncs, for callers that sync many files at once afterwards
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb', buffering=0) as f:
+            view = memoryview(data)
+            while view:
+                view = view[f.write(view):]
+            if durable:
+                os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_name)
+        raise
+    if durable:
+        fsync_directory(directory)
+
+# ============================================
+# FILE LOCKING
+# ============================================
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held_locks = threading.local()
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after ~10 seconds; keep waiting
+                continue
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    Exclusive lock on a data file, across threads and processes
+    The lock is taken on a sidecar "<file>.lock" so that it survives the
+    file being replaced by rewrite_csv_file; it is reentrant within a thread
+    """
+    path = os.path.abspath(filename)
+    held = _held_locks.__dict__.setdefault('paths', set())
+    if path in held:
+        yield
+        return
+
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        with open(path + '.lock', 'a+b') as f:
+            _lock_file(f)
+            held.add(path)
+            try:
+                yield
+            finally:
+                held.discard(path)
+                _unlock_file(f)
+
+# ============================================
+# INCREMENTAL READS
+# ============================================
+
+def read_appended_rows(filename, offset):
+    """
+    Parse the complete CSV rows of a file past byte offset (skipping the header at 0)
+    Returns (rows, new offset); a torn trailing record is left for a later call
+    """
+    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if size <= offset:
+        return [], offset
+
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size - offset)
+    data = data[:data.rfind(b'\n') + 1]
+    if not data:
+        return [], offset
+    count_read(len(data))
+
+    rows = csv.reader(io.StringIO(data.decode('utf-8')))
+    if offset == 0:
+        next(rows, None)  # header
+    return [row for row in rows if row], offset + len(data)
+
+def iter_csv_records(filename):
+    """
+    Stream the complete records of a CSV file (header skipped) as lists of strings
+    Much cheaper than pandas for the many small files of the data directory;
+    a torn trailing record is left out, as in read_appended_rows()
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        size = complete_length(f, os.fstat(f.fileno()).st_size)
+        count_read(size)
+        f.seek(0)
+
+        def lines(remaining):
+            # Stop at the size measured above, even if another append lands meanwhile
+            for line in f:
+                remaining -= len(line)
+                if remaining < 0:
+                    return
+                yield line.decode('utf-8')
+
+        rows = csv.reader(lines(size))
+        next(rows, None)  # header
+        yield from (row for row in rows if row)
@@ -0,0 +1,223 @@
+"""
+Exchange rates for multi-currency expenses
+
+Every expense keeps the amount and currency it was paid in; totals,
+summaries and analytics are in BASE_CURRENCY (schema.py). Rates live in a
+date-indexed table kept with the data it converts (RATES_FILENAME in the
+data root, or $EXPENSE_RATES):
+    date,currency,rate
+    2024-01-01,USD,281.50
+where rate is the value of one unit of the currency in the base currency,
+effective from that date until the next rate of the same currency. Days
+before a currency's first rate use that first rate.
+
+The table is parsed once per process and reused until the file changes.
+RateTable.to_base() converts a whole column of amounts in one pass: one
+binary search per currency over its sorted rate dates, never a lookup per
+row. Each converted amount is rounded to minor units on its own, so sums
+agree however the rows are grouped. New expenses need a rate for their
+currency; should a currency lose every rate later, its expenses are left out
+of converted totals (and counted, see unconverted_counts()) rather than
+failing every page that shows them.
+
+Maintain the table with:
+    python currency.py set USD 281.50 --date 2024-01-01
+    python currency.py list
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+from csvfiles import append_csv_row
+from schema import BASE_CURRENCY, day_key
+
+RATES_FILENAME = "exchange_rates.csv"
+RATE_COLUMNS = ['date', 'currency', 'rate']
+
+
+def rates_file(root=None):
+    """The rate table of a data root (default: $EXPENSE_DATA_DIR); $EXPENSE_RATES overrides it"""
+    return os.environ.get('EXPENSE_RATES') or os.path.join(
+        root or os.environ.get('EXPENSE_DATA_DIR', '.'), RATES_FILENAME
+    )
+
+
+RATES_FILE = rates_file()
+
+
+def normalize_currency(currency):
+    """Upper-case ISO code of a currency ("usd" -> "USD")"""
+    return str(currency).strip().upper()
+
+
+class RateTable:
+    """Per-currency exchange rates to BASE_CURRENCY, ordered by effective date"""
+
+    def __init__(self, rates=None, version=None):
+        """rates: DataFrame with RATE_COLUMNS; a later row for the same currency and day wins"""
+        # currency -> (effective days as datetime64[D], rates)
+        self.rates = {}
+        self.version = version
+        if rates is None or rates.empty:
+            return
+        rates = pd.DataFrame({
+            'date': pd.to_datetime(rates['date'], format='ISO8601').to_numpy().astype('datetime64[D]'),
+            'currency': rates['currency'].map(normalize_currency),
+            'rate': pd.to_numeric(rates['rate']).astype('float64'),
+        })
+        rates = rates.drop_duplicates(['currency', 'date'], keep='last').sort_values('date', kind='stable')
+        for code, group in rates.groupby('currency', sort=True):
+            self.rates[code] = (group['date'].to_numpy(), group['rate'].to_numpy())
+
+    @classmethod
+    def load(cls, filename):
+        """Parse a rate file (an empty table if it does not exist)"""
+        if not os.path.exists(filename):
+            return cls(version=None)
+        stat = os.stat(filename)
+        return cls(pd.read_csv(filename, dtype={'currency': str}), version=(stat.st_mtime_ns, stat.st_size))
+
+    def currencies(self):
+        """Every currency expenses can be entered in: the base currency first, then those with rates"""
+        return [BASE_CURRENCY] + [code for code in self.rates if code != BASE_CURRENCY]
+
+    def validate(self, currency):
+        """Return the normalized currency if it can be converted, else raise ValueError"""
+        code = normalize_currency(currency)
+        if code != BASE_CURRENCY and code not in self.rates:
+            raise ValueError(f"No exchange rate for {code!r}")
+        return code
+
+    def convertible(self, currencies):
+        """Boolean array: True for the rows of a currency column that can be converted"""
+        currencies = np.asarray(currencies, dtype=object)
+        return (currencies == BASE_CURRENCY) | np.isin(currencies, list(self.rates))
+
+    def rate_on(self, currency, date):
+        """Value of one unit of currency in the base currency on a day"""
+        code = self.validate(currency)
+        if code == BASE_CURRENCY:
+            return 1.0
+        days, rates = self.rates[code]
+        position = np.searchsorted(days, np.datetime64(day_key(date), 'D'), side='right') - 1
+        return float(rates[max(position, 0)])
+
+    def to_base(self, amounts, currencies, dates):
+        """
+        Convert amounts in minor units to base-currency minor units
+        amounts, currencies and dates are equal-length columns (Series or
+        arrays); returns an int64 array. Rows already in the base currency are
+        copied, the others are converted one currency at a time
+        """
+        amounts = np.asarray(amounts, dtype='int64')
+        currencies = np.asarray(currencies, dtype=object)
+        foreign = currencies != BASE_CURRENCY
+        if not foreign.any():
+            return amounts.copy()
+        converted = amounts.copy()
+        days = np.asarray(dates).astype('datetime64[D]')
+        for code in pd.unique(currencies[foreign]):
+            rows = np.flatnonzero(currencies == code)
+            effective, rates = self.rates.get(code, (None, None))
+            if effective is None:
+                raise ValueError(f"No exchange rate for {code!r}")
+            positions = np.maximum(np.searchsorted(effective, days[rows], side='right') - 1, 0)
+            converted[rows] = np.rint(amounts[rows] * rates[positions]).astype('int64')
+        return converted
+
+    def minor_to_base(self, minor, currency, date):
+        """to_base() for a single amount"""
+        code = self.validate(currency)
+        if code == BASE_CURRENCY:
+            return int(minor)
+        return int(np.rint(int(minor) * self.rate_on(code, date)))
+
+
+_tables_lock = threading.Lock()
+_tables = {}
+
+
+def get_rates(filename=None):
+    """
+    The RateTable of a rate file (default RATES_FILE), parsed once and
+    shared until the file changes
+    """
+    filename = filename or RATES_FILE
+    try:
+        stat = os.stat(filename)
+        signature = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        signature = None
+    with _tables_lock:
+        table = _tables.get(filename)
+        if table is not None and table.version == signature:
+            return table
+    table = RateTable.load(filename)
+    with _tables_lock:
+        _tables[filename] = table
+    return table
+
+
+def in_base_currency(df, rates=None):
+    """
+    A typed expense frame with Amount in base-currency minor units (df itself
+    if nothing needs converting); rows in a currency without any rate are left out
+    """
+    if 'Currency' not in df.columns or not (df['Currency'] != BASE_CURRENCY).any():
+        return df
+    rates = rates or get_rates()
+    convertible = rates.convertible(df['Currency'])
+    if not convertible.all():
+        df = df[convertible]
+    return df.assign(
+        Amount=rates.to_base(df['Amount'], df['Currency'], df['Date']), Currency=BASE_CURRENCY
+    )
+
+
+def unconverted_counts(currencies, rates=None):
+    """{currency: number of rows} of the rows of a currency column that have no rate (left out of totals)"""
+    rates = rates or get_rates()
+    currencies = np.asarray(currencies, dtype=object)
+    codes, counts = np.unique(currencies[~rates.convertible(currencies)].astype(str), return_counts=True)
+    return {str(code): int(count) for code, count in zip(codes, counts)}
+
+
+def set_rate(currency, rate, date=None, filename=None):
+    """Record a rate effective from date (default today)"""
+    code = normalize_currency(currency)
+    if code == BASE_CURRENCY:
+        raise ValueError(f"{BASE_CURRENCY} is the base currency")
+    if not float(rate) > 0:
+        raise ValueError("Rates must be positive")
+    append_csv_row(filename or RATES_FILE, RATE_COLUMNS, [day_key(date or datetime.date.today()), code, rate])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home Expense Tracker exchange rates")
+    parser.add_argument('--rates', default=RATES_FILE, help="rate table file")
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('set', help=f"record the value of one unit of a currency in {BASE_CURRENCY}")
+    add.add_argument('currency', help="ISO currency code, e.g. USD")
+    add.add_argument('rate', type=float)
+    add.add_argument('--date', help="first day the rate applies (default: today)")
+    commands.add_parser('list', help="show every rate")
+    args = parser.parse_args(argv)
+
+    if args.command == 'set':
+        set_rate(args.currency, args.rate, args.date, args.rates)
+    else:
+        rates = get_rates(args.rates)
+        for code, (days, values) in rates.rates.items():
+            for day, rate in zip(days, values):
+                print(f"{code} {day} {rate:g}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
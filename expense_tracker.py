@@ -4,12 +4,19 @@ Features: Mobile Number + Password + OTP Verification
 """
 
 import streamlit as st
-import pandas as pd
 from datetime import datetime
-import os
-import random
-import hashlib
-import time
+import concurrent.futures
+
+import accounts
+import instrumentation
+import otp
+import passwords
+import sms
+
+# pandas and the modules built on it (currency, export, importer, schema,
+# snapshots, storage) are imported by load_data_modules() when the tracker
+# page first needs them, so the login and OTP pages render without paying for them
+pd = currency = export = importer = schema = snapshots = storage = None
 
 # Set page configuration
 st.set_page_config(
@@ -19,8 +26,9 @@ st.set_page_config(
     initial_sidebar_state="auto" 
 )
 
-# Custom CSS for mobile responsiveness
-st.markdown("""
+# Custom CSS for mobile responsiveness, split into the rules every page needs
+# and the ones only the expense tracker page uses
+BASE_CSS = """
     <style>
     /* Make the app more mobile-friendly */
     .main .block-container {
@@ -43,6 +51,40 @@ st.markdown("""
         font-size: clamp(1rem, 3vw, 1.5rem) !important;
     }
     
+    /* Better form inputs on mobile */
+    input, select, textarea {
+        font-size: 16px !important;
+    }
+    
+    /* Better spacing on mobile */
+    @media (max-width: 768px) {
+        .main .block-container {
+            padding-left: 0.5rem;
+            padding-right: 0.5rem;
+        }
+    }
+    
+    /* Extra small devices */
+    @media (max-width: 480px) {
+        h1 {
+            font-size: 1.5rem !important;
+        }
+    }
+    
+    /* Login/Signup container styling */
+    .auth-container {
+        max-width: 500px;
+        margin: 50px auto;
+        padding: 30px;
+        background: white;
+        border-radius: 15px;
+        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+    }
+    </style>
+"""
+
+TRACKER_CSS = """
+    <style>
     /* Make metrics more readable on mobile */
     [data-testid="stMetricValue"] {
         font-size: clamp(1rem, 4vw, 2rem) !important;
@@ -58,18 +100,8 @@ st.markdown("""
         font-size: clamp(0.8rem, 2vw, 1rem);
     }
     
-    /* Better form inputs on mobile */
-    input, select, textarea {
-        font-size: 16px !important;
-    }
-    
     /* Better spacing on mobile */
     @media (max-width: 768px) {
-        .main .block-container {
-            padding-left: 0.5rem;
-            padding-right: 0.5rem;
-        }
-        
         .element-container {
             margin-bottom: 0.5rem;
         }
@@ -81,164 +113,268 @@ st.markdown("""
     
     /* Extra small devices */
     @media (max-width: 480px) {
-        h1 {
-            font-size: 1.5rem !important;
-        }
-        
         [data-testid="stMetricValue"] {
             font-size: 1.2rem !important;
         }
     }
-    
-    /* Login/Signup container styling */
-    .auth-container {
-        max-width: 500px;
-        margin: 50px auto;
-        padding: 30px;
-        background: white;
-        border-radius: 15px;
-        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-    }
     </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(BASE_CSS, unsafe_allow_html=True)
+
+# Columns shown in the expenses table and the CSV download
+DISPLAY_COLUMNS = ['Date', 'Category', 'Amount', 'Currency', 'Note']
+PAGE_SIZES = [25, 50, 100, 250]
+
+# Multi-month views offered by the period selector (None = every month with expenses)
+PERIOD_RANGES = {"Last 3 months": 3, "Last 12 months": 12, "All time": None}
+
+# ============================================
+# STORAGE
+# ============================================
+
+def load_data_modules():
+    """Import pandas and the expense storage layer the first time they are needed"""
+    global pd, currency, export, importer, schema, snapshots, storage
+    if storage is None:
+        import pandas as pd
+        import currency
+        import export
+        import importer
+        import schema
+        import snapshots
+        import storage
+
+@st.cache_resource
+def get_user_store():
+    """Process-wide user store for the login pages (no pandas needed), see accounts.py"""
+    return accounts.open_user_store()
+
+@st.cache_resource
+def get_storage():
+    """Process-wide storage backend (survives Streamlit reruns), see storage.py"""
+    load_data_modules()
+    return instrumentation.instrument(storage.open_storage(users=get_user_store()))
 
-# File paths
-USERS_FILE = "users.csv"
-SALARY_FILE = "monthly_salary.csv"
-EXPENSES_FILE = "expenses.csv"
+@st.cache_resource
+def get_snapshots():
+    """Snapshot repository of the CSV backend's data root, None with SQLite (see snapshots.py)"""
+    store = get_storage()
+    return snapshots.open_repository(store.root) if hasattr(store, 'replace_user_files') else None
 
 # ============================================
 # AUTHENTICATION FUNCTIONS
 # ============================================
 
 def hash_password(password):
-    """Hash password for secure storage"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password for secure storage (salted scrypt on the KDF worker pool, see passwords.py)"""
+    return passwords.hash_in_pool(password)
 
 def load_users():
     """Load all registered users"""
-    if os.path.exists(USERS_FILE):
-        return pd.read_csv(USERS_FILE)
-    return pd.DataFrame(columns=['mobile', 'password', 'name', 'created_at'])
+    return get_user_store().records()
 
 def save_user(mobile, password, name):
     """Register a new user"""
-    users_df = load_users()
-    
+    if get_user_store().get(mobile) is not None:
+        # Skip the hashing work for a signup that would fail anyway
+        return False, "Mobile number already registered!"
+    try:
+        password_hash = hash_password(password)
+    except concurrent.futures.TimeoutError:
+        return False, "The server is busy, please try again."
+    new_user = {
+        'mobile': mobile,
+        'password': password_hash,
+        'name': name,
+        'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
     # Check if user already exists
-    if mobile in users_df['mobile'].values:
+    if not get_user_store().add(new_user):
         return False, "Mobile number already registered!"
-    
-    # Add new user
-    new_user = pd.DataFrame({
-        'mobile': [mobile],
-        'password': [hash_password(password)],
-        'name': [name],
-        'created_at': [datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
-    })
-    
-    users_df = pd.concat([users_df, new_user], ignore_index=True)
-    users_df.to_csv(USERS_FILE, index=False)
     return True, "Registration successful!"
 
 def verify_user(mobile, password):
     """Verify user credentials"""
-    users_df = load_users()
-    
-    if mobile not in users_df['mobile'].values:
+    user_data = get_user_store().get(mobile)
+
+    if user_data is None:
         return False, "Mobile number not registered!"
-    
-    user_data = users_df[users_df['mobile'] == mobile].iloc[0]
-    
-    if user_data['password'] == hash_password(password):
-        return True, user_data['name']
-    else:
+
+    try:
+        matches, needs_rehash = passwords.verify_in_pool(password, user_data['password'])
+    except concurrent.futures.TimeoutError:
+        return False, "The server is busy, please try again."
+    if not matches:
         return False, "Incorrect password!"
 
+    if needs_rehash:
+        # Upgrade a legacy SHA-256 (or outdated scrypt) hash while the password
+        # is at hand, without making this login wait for it
+        store, old_hash = get_user_store(), user_data['password']
+        passwords.kdf_pool().submit(passwords.hash_password, password).add_done_callback(
+            lambda done: store.update_password(mobile, old_hash, done.result())
+        )
+    return True, user_data['name']
+
 def generate_otp():
     """Generate a 6-digit OTP"""
-    return str(random.randint(100000, 999999))
+    return otp.generate_code()
 
-def send_otp_simulation(mobile, otp):
+def send_otp(mobile):
     """
-    Simulate sending OTP to mobile number
-    In production, integrate with SMS API like Twilio, MSG91, or Fast2SMS
+    Create an OTP for a mobile number and queue its SMS for background delivery
+    (see sms.py) without waiting for the provider
+    Returns (True, handle of the OTP in the server-side store) or (False, error message)
     """
-    # For demo purposes, we'll display the OTP on screen
-    # In production, this would send actual SMS
-    return True
+    code = generate_otp()
+    try:
+        job_id = sms.get_dispatcher().enqueue(mobile, f"Your Home Expense Tracker verification code is {code}")
+    except sms.RateLimited as limited:
+        return False, f"Too many OTP requests for this number. Please try again in {limited.retry_after:.0f} seconds."
+    except sms.QueueFull:
+        return False, "The SMS service is busy, please try again shortly."
+    return True, otp.get_store().issue(mobile, code, delivery=job_id)
 
-def get_user_filename(mobile, filename):
-    """Create user-specific filename"""
-    # Replace special characters in mobile number for filename
-    safe_mobile = mobile.replace('+', '').replace(' ', '')
-    return f"{safe_mobile}_{filename}"
+def otp_delivery_status(job_id):
+    """Delivery state of a queued OTP SMS ('queued', 'sending', 'retrying', 'sent', 'failed'), or None"""
+    status = sms.get_dispatcher().status(job_id) if job_id else None
+    return status['state'] if status else None
+
+def otp_shown_on_screen():
+    """True in demo mode, where no SMS is sent and the code is shown on the verification page"""
+    return isinstance(sms.get_dispatcher().provider, sms.DemoProvider)
 
 # ============================================
 # EXPENSE MANAGEMENT FUNCTIONS (User-specific)
 # ============================================
 
-def load_salary(mobile):
-    """Load the monthly salary from user-specific file"""
-    filename = get_user_filename(mobile, SALARY_FILE)
-    if os.path.exists(filename):
-        df = pd.read_csv(filename)
-        if not df.empty:
-            return df.iloc[-1]['salary']
-    return 0.0
-
-def save_salary(mobile, salary):
-    """Save monthly salary to user-specific file"""
-    filename = get_user_filename(mobile, SALARY_FILE)
-    df = pd.DataFrame({'salary': [salary], 'date': [datetime.now().strftime("%Y-%m-%d")]})
-    if os.path.exists(filename):
-        existing_df = pd.read_csv(filename)
-        df = pd.concat([existing_df, df], ignore_index=True)
-    df.to_csv(filename, index=False)
+def load_salary(mobile, date=None):
+    """Load the monthly salary of a user in effect on a date (default: today)"""
+    return get_storage().salary_timeline(mobile).salary_on(date or datetime.now())
+
+def load_salary_changes(mobile):
+    """Load a user's salary changes as (effective date, salary), oldest first"""
+    return get_storage().salary_timeline(mobile).changes()
+
+def save_salary(mobile, salary, effective_date=None):
+    """Save the monthly salary of a user, in effect from effective_date (default: today)"""
+    get_storage().append_salary(mobile, salary, (effective_date or datetime.now()).strftime("%Y-%m-%d"))
 
 def load_expenses(mobile):
-    """Load all expenses from user-specific file"""
-    filename = get_user_filename(mobile, EXPENSES_FILE)
-    if os.path.exists(filename):
-        df = pd.read_csv(filename)
-        return df
-    return pd.DataFrame(columns=['Date', 'Category', 'Amount', 'Note'])
-
-def save_expense(mobile, date, category, amount, note):
-    """Save a new expense to user-specific file"""
-    filename = get_user_filename(mobile, EXPENSES_FILE)
-    new_expense = pd.DataFrame({
-        'Date': [date],
-        'Category': [category],
-        'Amount': [amount],
-        'Note': [note]
-    })
-    
-    df = load_expenses(mobile)
-    df = pd.concat([df, new_expense], ignore_index=True)
-    df.to_csv(filename, index=False)
-
-def delete_expense(mobile, index):
-    """Delete a specific expense by index"""
-    filename = get_user_filename(mobile, EXPENSES_FILE)
-    df = load_expenses(mobile)
-    if not df.empty and 0 <= index < len(df):
-        df = df.drop(index).reset_index(drop=True)
-        df.to_csv(filename, index=False)
-        return True
-    return False
-
-def calculate_total_expenses(mobile):
-    """Calculate the sum of all expenses"""
-    df = load_expenses(mobile)
-    if not df.empty:
-        return df['Amount'].sum()
-    return 0.0
-
-def calculate_remaining_balance(mobile, salary):
-    """Calculate how much money is left"""
-    total_expenses = calculate_total_expenses(mobile)
-    return salary - total_expenses
+    """
+    Load all expenses of a user
+    The frame may be shared through a cache, so callers must not modify it in place
+    """
+    return get_storage().load_expenses(mobile)
+
+def load_expense_page(mobile, start=None, end=None, categories=None, page=0, page_size=50, search=''):
+    """Load one page of expenses (newest first) and the number of matching expenses, optionally searching the notes"""
+    if search.strip():
+        return get_storage().search_expenses(mobile, search, start, end, categories, page, page_size)
+    return get_storage().query_expenses(mobile, start, end, categories, page, page_size)
+
+def save_expense(mobile, date, category, amount, note, currency_code=None):
+    """Save a new expense (amount in currency_code, default the base currency) and return its ID"""
+    return get_storage().append_expense(mobile, date, category, amount, note, currency_code or schema.BASE_CURRENCY)
+
+def delete_expense(mobile, expense_id):
+    """Delete a specific expense by its ID"""
+    return get_storage().delete_expense(mobile, expense_id)
+
+def clear_expenses(mobile):
+    """Delete all expenses of a user"""
+    return get_storage().clear_expenses(mobile)
+
+def snapshot_user(mobile, label):
+    """Snapshot a user's files before a destructive change; returns the snapshot ID (None without snapshots)"""
+    repository = get_snapshots()
+    return repository.take_user(get_storage(), mobile, label)['id'] if repository else None
+
+def restore_snapshot(mobile, snapshot_id):
+    """Put a user's files back as they were in a snapshot"""
+    return get_snapshots().restore_user(get_storage(), snapshot_id, mobile)
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def load_statement(data, filename):
+    """Parse an uploaded statement (kept across reruns while the column mapping is chosen)"""
+    return importer.read_statement(data, filename)
+
+def import_expenses(mobile, expenses):
+    """Bulk-save prepared statement expenses, skipping ones already saved; returns (imported, duplicates)"""
+    return importer.import_expenses(get_storage(), mobile, expenses)
+
+def load_currencies():
+    """Currencies expenses can be entered in: the base currency and every one in the rate table"""
+    return currency.get_rates().currencies()
+
+def load_expense_periods(mobile):
+    """Load the months ("YYYY-MM") in which a user has expenses"""
+    return get_storage().expense_periods(mobile)
+
+def load_expense_summary(mobile, periods=None):
+    """Load the precomputed summary figures of a user's months (total, per-category sums, dates, count)"""
+    return get_storage().summary(mobile, periods)
+
+def load_expense_trend(mobile, periods, grain):
+    """
+    Spend per category (columns, base currency) per day, week or month (rows, by start
+    date) of the given months, rolled up from the summaries' category x day cube
+    """
+    buckets = get_storage().trend(mobile, periods, grain)
+    trend = pd.DataFrame.from_dict(buckets, orient='index').fillna(0).astype('int64')
+    trend = trend.reindex(columns=[category for category in schema.CATEGORIES if category in trend.columns])
+    trend.index = pd.to_datetime(trend.index)
+    return schema.from_minor(trend.sort_index().rename_axis(grain.capitalize()))
+
+def month_over_month(mobile, periods):
+    """
+    Spend per category (base currency) in each of the given months and the change from
+    the month before it, as (monthly totals, percentage changes)
+    """
+    months = [schema.shift_period(periods[0], -1)] + list(periods)
+    totals = pd.DataFrame(
+        {period: load_expense_summary(mobile, [period])['category_totals'] for period in months}
+    ).T.reindex(index=months, columns=schema.CATEGORIES).fillna(0).astype('int64')
+    totals['Total'] = totals.sum(axis=1)
+    totals = schema.from_minor(totals.loc[:, (totals != 0).any()])
+    # A month without spending has no meaningful percentage change
+    changes = (totals.diff() / totals.shift(1).where(totals.shift(1) != 0) * 100).iloc[1:]
+    return totals.iloc[1:], changes
+
+def calculate_total_expenses(mobile, periods=None):
+    """Calculate the sum of the expenses in the given months (default: all) in the base currency"""
+    return schema.from_minor(get_storage().total_expenses(mobile, periods))
+
+def calculate_budget(mobile, periods):
+    """Calculate the salary of the given months, each month at the salary in effect then"""
+    return get_storage().salary_timeline(mobile).budget(periods)
+
+def calculate_remaining_balance(mobile, periods=None):
+    """Calculate how much money is left of the salary of the given months (default: this month)"""
+    if periods is None:
+        periods = [schema.period_key(datetime.now())]
+    total_expenses = calculate_total_expenses(mobile, periods)
+    return calculate_budget(mobile, periods) - total_expenses
+
+def format_money(amount):
+    """Display text of an amount in the base currency ("PKR 1,234.50")"""
+    return f"{schema.BASE_CURRENCY} {amount:,.2f}"
+
+def format_period(choice):
+    """Label of a period selector option ("2024-01" -> "January 2024")"""
+    if choice in PERIOD_RANGES:
+        return choice
+    return datetime.strptime(choice, "%Y-%m").strftime("%B %Y")
+
+def resolve_periods(choice, months, this_month):
+    """Months covered by a period selector option"""
+    if choice not in PERIOD_RANGES:
+        return [choice]
+    if PERIOD_RANGES[choice] is None:
+        return schema.periods_between(min(months), max(months))
+    return schema.periods_between(schema.shift_period(this_month, 1 - PERIOD_RANGES[choice]), this_month)
 
 # ============================================
 # SESSION STATE INITIALIZATION
@@ -250,18 +386,9 @@ if 'user_mobile' not in st.session_state:
     st.session_state.user_mobile = None
 if 'user_name' not in st.session_state:
     st.session_state.user_name = None
-if 'otp_sent' not in st.session_state:
-    st.session_state.otp_sent = False
-if 'otp_code' not in st.session_state:
-    st.session_state.otp_code = None
-if 'otp_mobile' not in st.session_state:
-    st.session_state.otp_mobile = None
-if 'otp_timestamp' not in st.session_state:
-    st.session_state.otp_timestamp = None
-if 'temp_password' not in st.session_state:
-    st.session_state.temp_password = None
-if 'temp_name' not in st.session_state:
-    st.session_state.temp_name = None
+if 'otp_handle' not in st.session_state:
+    # Handle of the pending OTP in the server-side store (see otp.py)
+    st.session_state.otp_handle = None
 
 # ============================================
 # AUTHENTICATION UI
@@ -299,19 +426,13 @@ def show_login_page():
                     success, result = verify_user(mobile, password)
                     
                     if success:
-                        # Send OTP for verification
-                        otp = generate_otp()
-                        st.session_state.otp_code = otp
-                        st.session_state.otp_mobile = mobile
-                        st.session_state.temp_password = password
-                        st.session_state.otp_timestamp = time.time()
-                        st.session_state.otp_sent = True
-                        
-                        # Simulate sending OTP
-                        send_otp_simulation(mobile, otp)
-                        st.success(f"✅ OTP sent to {mobile}")
-                        st.info(f"🔢 Your OTP is: **{otp}** (Demo Mode - In production, this will be sent via SMS)")
-                        st.rerun()
+                        # Send OTP for verification (queued, delivered in the background)
+                        sent, handle = send_otp(mobile)
+                        if sent:
+                            st.session_state.otp_handle = handle
+                            st.rerun()
+                        else:
+                            st.error(f"❌ {handle}")
                     else:
                         st.error(f"❌ {result}")
     
@@ -341,45 +462,49 @@ def show_login_page():
                     success, message = save_user(mobile, password, name)
                     
                     if success:
-                        # Send OTP for verification
-                        otp = generate_otp()
-                        st.session_state.otp_code = otp
-                        st.session_state.otp_mobile = mobile
-                        st.session_state.temp_password = password
-                        st.session_state.temp_name = name
-                        st.session_state.otp_timestamp = time.time()
-                        st.session_state.otp_sent = True
-                        
-                        send_otp_simulation(mobile, otp)
-                        st.success(f"✅ {message}")
-                        st.info(f"🔢 Your OTP is: **{otp}** (Demo Mode)")
-                        st.rerun()
+                        # Send OTP for verification (queued, delivered in the background)
+                        sent, handle = send_otp(mobile)
+                        if sent:
+                            st.session_state.otp_handle = handle
+                            st.rerun()
+                        else:
+                            st.success(f"✅ {message}")
+                            st.error(f"❌ {handle} You can log in once the limit has passed.")
                     else:
                         st.error(f"❌ {message}")
 
 def show_otp_verification():
     """Display OTP verification page"""
     
+    pending = otp.get_store().lookup(st.session_state.otp_handle)
+    
     st.markdown("<h1 style='text-align: center;'>🔐 OTP Verification</h1>", unsafe_allow_html=True)
-    st.markdown(f"<p style='text-align: center;'>OTP sent to: <strong>{st.session_state.otp_mobile}</strong></p>", unsafe_allow_html=True)
+    if pending is not None:
+        st.markdown(f"<p style='text-align: center;'>OTP sent to: <strong>{pending[0]}</strong></p>", unsafe_allow_html=True)
     st.markdown("---")
     
-    # Check OTP expiry (5 minutes)
-    if st.session_state.otp_timestamp:
-        elapsed_time = time.time() - st.session_state.otp_timestamp
-        if elapsed_time > 300:  # 5 minutes
-            st.error("⏰ OTP expired! Please login again.")
-            if st.button("🔙 Back to Login"):
-                st.session_state.otp_sent = False
-                st.session_state.otp_code = None
-                st.rerun()
-            return
+    # The store drops codes when they expire or after too many wrong attempts
+    if pending is None:
+        st.error("⏰ OTP expired! Please login again.")
+        if st.button("🔙 Back to Login"):
+            st.session_state.otp_handle = None
+            st.rerun()
+        return
+    otp_mobile, otp_code, seconds_left, delivery_job = pending
     
     col1, col2, col3 = st.columns([1, 2, 1])
     
     with col2:
-        st.info(f"🔢 **Demo OTP:** {st.session_state.otp_code}")
-        st.caption("In production, OTP will be sent via SMS")
+        if otp_shown_on_screen():
+            st.info(f"🔢 **Demo OTP:** {otp_code}")
+            st.caption("In production, OTP will be sent via SMS")
+        else:
+            st.info("📨 A verification code has been sent to your mobile.")
+        delivery = otp_delivery_status(delivery_job)
+        if delivery == 'failed':
+            st.warning("📨 The SMS could not be delivered. Use Resend OTP to try again.")
+        elif delivery:
+            st.caption(f"📨 SMS delivery: {delivery} · code valid for {int(seconds_left) // 60}:{int(seconds_left) % 60:02d} more")
         
         with st.form("otp_form"):
             otp_input = st.text_input("Enter OTP", placeholder="Enter 6-digit OTP", max_chars=6)
@@ -391,39 +516,39 @@ def show_otp_verification():
                 resend_button = st.form_submit_button("🔄 Resend OTP", use_container_width=True)
             
             if verify_button:
-                if otp_input == st.session_state.otp_code:
+                outcome, mobile, attempts_left = otp.get_store().verify(st.session_state.otp_handle, otp_input)
+                if outcome == otp.VERIFIED:
                     # OTP verified - log in user
                     st.session_state.authenticated = True
-                    st.session_state.user_mobile = st.session_state.otp_mobile
+                    st.session_state.user_mobile = mobile
                     
                     # Get user name
-                    users_df = load_users()
-                    if st.session_state.otp_mobile in users_df['mobile'].values:
-                        st.session_state.user_name = users_df[users_df['mobile'] == st.session_state.otp_mobile].iloc[0]['name']
+                    user_data = get_user_store().get(mobile)
+                    if user_data is not None:
+                        st.session_state.user_name = user_data['name']
                     
                     # Clear OTP data
-                    st.session_state.otp_sent = False
-                    st.session_state.otp_code = None
-                    
-                    st.success("✅ Login successful!")
-                    time.sleep(1)
+                    st.session_state.otp_handle = None
                     st.rerun()
+                elif outcome == otp.INVALID:
+                    st.error(f"❌ Invalid OTP! Please try again ({attempts_left} attempts left).")
                 else:
-                    st.error("❌ Invalid OTP! Please try again.")
+                    # Expired meanwhile, or too many wrong codes
+                    st.error("❌ Too many wrong codes. Please login again." if outcome == otp.LOCKED else "⏰ OTP expired!")
+                    st.session_state.otp_handle = None
             
             if resend_button:
                 # Generate new OTP
-                new_otp = generate_otp()
-                st.session_state.otp_code = new_otp
-                st.session_state.otp_timestamp = time.time()
-                send_otp_simulation(st.session_state.otp_mobile, new_otp)
-                st.success(f"✅ New OTP sent!")
-                st.info(f"🔢 Your new OTP is: **{new_otp}**")
-                st.rerun()
+                sent, handle = send_otp(otp_mobile)
+                if sent:
+                    st.session_state.otp_handle = handle
+                    st.rerun()
+                else:
+                    st.error(f"❌ {handle}")
         
         if st.button("🔙 Back to Login", use_container_width=True):
-            st.session_state.otp_sent = False
-            st.session_state.otp_code = None
+            otp.get_store().discard(st.session_state.otp_handle)
+            st.session_state.otp_handle = None
             st.rerun()
 
 
@@ -431,6 +556,9 @@ def show_otp_verification():
 def show_expense_tracker():
     """Display the main expense tracker interface"""
     
+    load_data_modules()
+    st.markdown(TRACKER_CSS, unsafe_allow_html=True)
+    
     user_mobile = st.session_state.user_mobile
     user_name = st.session_state.user_name
     
@@ -443,6 +571,7 @@ def show_expense_tracker():
             st.session_state.authenticated = False
             st.session_state.user_mobile = None
             st.session_state.user_name = None
+            st.session_state.undo_clear = None
             st.rerun()
     
     st.markdown("---")
@@ -453,7 +582,7 @@ def show_expense_tracker():
     current_salary = load_salary(user_mobile)
     
     if current_salary > 0:
-        st.sidebar.success(f"Current Monthly Salary: PKR {current_salary:,.2f}")
+        st.sidebar.success(f"Current Monthly Salary: {format_money(current_salary)}")
     
     with st.sidebar.form("salary_form"):
         st.subheader("Set Monthly Salary")
@@ -464,16 +593,47 @@ def show_expense_tracker():
             step=1000.0,
             help="Set your monthly income/budget"
         )
+        effective_date = st.date_input(
+            "Effective from", value=datetime.now(),
+            help="Months ending on or after this date use the new salary; earlier months keep theirs"
+        )
         submit_salary = st.form_submit_button("💾 Save Salary", use_container_width=True)
         
         if submit_salary:
-            save_salary(user_mobile, new_salary)
+            save_salary(user_mobile, new_salary, effective_date)
             st.success("✅ Salary saved successfully!")
             st.rerun()
     
+    salary_changes = load_salary_changes(user_mobile)
+    if len(salary_changes) > 1:
+        with st.sidebar.expander("🕒 Salary History"):
+            for effective, amount in reversed(salary_changes):
+                st.write(f"**{effective}:** {format_money(amount)}")
+    instrumentation.lap('salary')
+    
+    # Period selector - a single month only reads that month's expenses;
+    # older months are read when a multi-month view asks for them
+    st.sidebar.header("📅 Period")
+    this_month = schema.period_key(datetime.now())
+    expense_months = load_expense_periods(user_mobile)
+    months = sorted(set(expense_months) | {this_month}, reverse=True)
+    period_choice = st.sidebar.selectbox(
+        "Show expenses for", months + list(PERIOD_RANGES), index=months.index(this_month), format_func=format_period
+    )
+    view_periods = resolve_periods(period_choice, months, this_month)
+    view_start = schema.period_bounds(view_periods[0])[0].date()
+    view_end = schema.period_bounds(view_periods[-1])[1].date()
+    instrumentation.lap('periods')
+    
     # Calculate values
-    total_expenses = calculate_total_expenses(user_mobile)
-    remaining_balance = calculate_remaining_balance(user_mobile, current_salary)
+    summary = load_expense_summary(user_mobile, view_periods)
+    if summary['unconverted']:
+        left_out = ", ".join(f"{count} in {code}" for code, count in sorted(summary['unconverted'].items()))
+        st.warning(f"⚠️ Some expenses have no exchange rate to {currency.BASE_CURRENCY} and are left out of "
+                   f"the totals: {left_out}. Add the rate with `python currency.py set`.")
+    total_expenses = schema.from_minor(summary['total'])
+    budget = calculate_budget(user_mobile, view_periods)
+    remaining_balance = budget - total_expenses
     
     # Financial Summary
     st.header("📊 Financial Summary")
@@ -482,15 +642,15 @@ def show_expense_tracker():
     
     with summary_cols[0]:
         st.metric(
-            "Monthly Salary", 
-            f"PKR {current_salary:,.2f}",
-            help="Your monthly income"
+            "Monthly Salary" if len(view_periods) == 1 else f"Salary × {len(view_periods)} months", 
+            format_money(budget),
+            help="Your monthly income; each month counts the salary in effect at its end"
         )
     
     with summary_cols[1]:
         st.metric(
             "Total Expenses", 
-            f"PKR {total_expenses:,.2f}",
+            format_money(total_expenses),
             help="Sum of all expenses"
         )
     
@@ -498,7 +658,7 @@ def show_expense_tracker():
         if remaining_balance < 0:
             st.metric(
                 "Remaining", 
-                f"PKR {remaining_balance:,.2f}", 
+                format_money(remaining_balance), 
                 delta="Over Budget!", 
                 delta_color="inverse",
                 help="Amount remaining from salary"
@@ -506,9 +666,10 @@ def show_expense_tracker():
         else:
             st.metric(
                 "Remaining", 
-                f"PKR {remaining_balance:,.2f}",
+                format_money(remaining_balance),
                 help="Amount remaining from salary"
             )
+    instrumentation.lap('totals')
     
     st.markdown("---")
     
@@ -522,53 +683,181 @@ def show_expense_tracker():
             expense_date = st.date_input("Date", value=datetime.now())
             category = st.selectbox(
                 "Category",
-                ["Food", "Rent", "Electricity", "Gas", "Education", "Medical", "Other"]
+                schema.CATEGORIES
             )
         
         with form_col2:
-            amount = st.number_input("Amount (PKR)", min_value=0.0, step=10.0)
+            amount_col, currency_col = st.columns([2, 1])
+            with amount_col:
+                amount = st.number_input("Amount", min_value=0.0, step=10.0)
+            with currency_col:
+                expense_currency = st.selectbox(
+                    "Currency", load_currencies(),
+                    help=f"Totals are converted to {schema.BASE_CURRENCY} at the rate of the expense's date"
+                )
             note = st.text_input("Note (Optional)", "", max_chars=100)
         
         submit_expense = st.form_submit_button("➕ Add Expense", use_container_width=True)
         
         if submit_expense:
             if amount > 0:
-                save_expense(user_mobile, expense_date, category, amount, note)
+                save_expense(user_mobile, expense_date, category, amount, note, expense_currency)
                 st.success("✅ Expense added successfully!")
                 st.rerun()
             else:
                 st.error("⚠️ Please enter a valid amount!")
     
+    # Bulk import - the whole statement is validated and written in one batch
+    with st.expander("📤 Import Bank/Wallet Statement"):
+        uploaded = st.file_uploader("Statement file (CSV or Excel)", type=importer.upload_types())
+        if uploaded is not None:
+            try:
+                statement = load_statement(uploaded.getvalue(), uploaded.name)
+            except ValueError as error:
+                st.error(f"❌ {error}")
+                statement = None
+        
+        if uploaded is not None and statement is not None:
+            guessed = importer.guess_columns(statement.columns)
+            column_options = [None] + list(statement.columns)
+            mapping = {}
+            for mapping_col, role in zip(st.columns(len(importer.ROLES)), importer.ROLES):
+                with mapping_col:
+                    mapping[role] = st.selectbox(
+                        role if role in importer.REQUIRED else f"{role} (optional)",
+                        column_options,
+                        index=column_options.index(guessed[role]),
+                        format_func=lambda column: "—" if column is None else column,
+                        key=f"import_column_{role}"
+                    )
+            
+            if mapping['Date'] is None or mapping['Amount'] is None:
+                st.warning("⚠️ Choose the Date and Amount columns.")
+            else:
+                option_col1, option_col2, option_col3 = st.columns(3)
+                with option_col1:
+                    debits_only = st.checkbox(
+                        "Negative amounts are expenses (skip credits)",
+                        value=importer.has_debit_signs(statement, mapping['Amount'])
+                    )
+                with option_col2:
+                    dayfirst = st.checkbox("Dates are day first (31/01/2024)", value=True)
+                with option_col3:
+                    statement_currency = st.selectbox("Statement currency", load_currencies())
+                
+                expenses, skipped = importer.prepare_statement(
+                    statement, mapping, debits_only, dayfirst, statement_currency
+                )
+                st.caption(f"{len(expenses):,} expenses ready to import, {len(skipped):,} rows skipped")
+                if len(skipped):
+                    st.dataframe(skipped.head(100), hide_index=True, use_container_width=True, height=150)
+                
+                if st.button(f"📤 Import {len(expenses):,} Expenses", use_container_width=True, disabled=expenses.empty):
+                    imported, duplicates = import_expenses(user_mobile, expenses)
+                    st.success(f"✅ Imported {imported:,} expenses ({duplicates:,} already saved were skipped).")
+                    st.rerun()
+    instrumentation.lap('expense form')
+    
     st.markdown("---")
     
     # All Expenses
-    st.header("📋 All Expenses")
-    
-    expenses_df = load_expenses(user_mobile)
-    
-    if not expenses_df.empty:
-        expenses_df = expenses_df.sort_values('Date', ascending=False)
+    st.header(f"📋 Expenses – {format_period(period_choice)}")
+    
+    if summary['count'] > 0:
+        # Filters and paging are applied by the storage layer, so only the
+        # visible page is sorted and sent to the browser
+        search_text = st.text_input(
+            "🔍 Search notes", placeholder="e.g. groc, school fee",
+            help="Finds expenses whose note has words starting with every word you type"
+        )
+        filter_col1, filter_col2, filter_col3 = st.columns([2, 2, 1])
+        with filter_col1:
+            first_date = datetime.strptime(summary['first_date'], "%Y-%m-%d").date()
+            last_date = datetime.strptime(summary['last_date'], "%Y-%m-%d").date()
+            date_filter = st.date_input(
+                "Date range", value=(first_date, last_date), min_value=view_start, max_value=view_end,
+                key=f"expense_date_filter_{period_choice}"
+            )
+        with filter_col2:
+            category_filter = st.multiselect(
+                "Categories", sorted(summary['category_totals']), placeholder="All categories"
+            )
+        with filter_col3:
+            page_size = st.selectbox("Rows per page", PAGE_SIZES)
+
+        start_date = date_filter[0] if len(date_filter) > 0 else view_start
+        end_date = date_filter[1] if len(date_filter) > 1 else view_end
+
+        page = st.session_state.get('expense_page', 1) - 1
+        expenses_df, matching = load_expense_page(
+            user_mobile, start_date, end_date, category_filter or None, page, page_size, search_text
+        )
+        page_count = max(1, -(-matching // page_size))
+        if page >= page_count:
+            # Filters shrank the result - jump to the last page
+            page = page_count - 1
+            st.session_state.expense_page = page_count
+            expenses_df, matching = load_expense_page(
+                user_mobile, start_date, end_date, category_filter or None, page, page_size, search_text
+            )
         
-        # Add selection column for deletion
-        expenses_display = expenses_df.copy()
-        expenses_display.insert(0, 'Select', False)
+        if matching:
+            st.caption(f"Showing {page * page_size + 1:,}–{page * page_size + len(expenses_df):,} of {matching:,} expenses")
+        else:
+            st.caption("No expenses match these filters")
         
         st.dataframe(
-            expenses_df, 
+            expenses_df.assign(Amount=schema.from_minor(expenses_df['Amount'])), 
             use_container_width=True, 
             hide_index=True,
-            height=350
+            height=350,
+            column_order=DISPLAY_COLUMNS,
+            column_config={
+                "Date": st.column_config.DateColumn(format="YYYY-MM-DD"),
+                "Amount": st.column_config.NumberColumn(format="%.2f")
+            }
         )
+        st.number_input("Page", min_value=1, max_value=page_count, step=1, key="expense_page")
         
-        # Download button
-        csv = expenses_df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📥 Download Expenses as CSV",
-            data=csv,
-            file_name=f'expenses_{datetime.now().strftime("%Y%m%d")}.csv',
-            mime='text/csv',
-            use_container_width=True
-        )
+        # Delete a single expense (by its ID, so the choice matches the table)
+        with st.expander("🗑️ Delete an Expense"):
+            expense_labels = dict(zip(
+                expenses_df['ID'],
+                expenses_df['Date'].dt.strftime("%Y-%m-%d") + " | " + expenses_df['Category'].astype(str)
+                + " | " + expenses_df['Currency'].astype(str)
+                + " " + schema.from_minor(expenses_df['Amount']).map('{:,.2f}'.format)
+                + " | " + expenses_df['Note']
+            )) if len(expenses_df) else {}
+            expense_to_delete = st.selectbox(
+                "Select an expense from this page", list(expense_labels), format_func=expense_labels.get
+            )
+            if st.button("🗑️ Delete Selected Expense", use_container_width=True, disabled=not expense_labels):
+                if delete_expense(user_mobile, expense_to_delete):
+                    st.success("✅ Expense deleted!")
+                    st.rerun()
+                else:
+                    st.error("❌ This expense no longer exists.")
+        instrumentation.lap('table')
+        
+        # Download button - the file is only built when the button is clicked
+        with st.expander("📥 Download Expenses"):
+            export_col1, export_col2 = st.columns([1, 2])
+            with export_col1:
+                export_format = st.selectbox("Format", export.available_formats())
+            with export_col2:
+                export_range = st.date_input(
+                    "Date range to export", value=(first_date, last_date), key=f"export_date_range_{period_choice}"
+                )
+            export_start = export_range[0] if len(export_range) > 0 else None
+            export_end = export_range[1] if len(export_range) > 1 else export_start
+            st.download_button(
+                label=f"📥 Download Expenses as {export_format}",
+                data=lambda: export.export_expenses(get_storage(), user_mobile, export_format, export_start, export_end),
+                file_name=f'expenses_{datetime.now().strftime("%Y%m%d")}.{export.file_extension(export_format)}',
+                mime=export.mime_type(export_format),
+                use_container_width=True
+            )
+        instrumentation.lap('export')
         
         # Expense Analysis
         st.markdown("---")
@@ -578,16 +867,46 @@ def show_expense_tracker():
         
         with chart_col1:
             st.subheader("Expenses by Category")
-            category_expenses = expenses_df.groupby('Category')['Amount'].sum().reset_index()
-            st.bar_chart(category_expenses.set_index('Category'), height=300)
+            category_expenses = schema.from_minor(
+                pd.Series(summary['category_totals'], name='Amount', dtype='int64')
+            ).rename_axis('Category').sort_index()
+            st.bar_chart(category_expenses.to_frame(), height=300)
         
         with chart_col2:
             st.subheader("Category Breakdown")
-            category_expenses = expenses_df.groupby('Category')['Amount'].sum().sort_values(ascending=False)
+            category_expenses = category_expenses.sort_values(ascending=False)
             
             for category, amount in category_expenses.items():
                 percentage = (amount / total_expenses) * 100
-                st.write(f"**{category}:** PKR {amount:,.2f} ({percentage:.1f}%)")
+                st.write(f"**{category}:** {format_money(amount)} ({percentage:.1f}%)")
+        instrumentation.lap('charts')
+        
+        # Trends - rolled up from the per-day summary cube, so they cost the
+        # same however many expenses the months hold
+        st.subheader("Spending Trend")
+        for tab, grain in zip(st.tabs(["Daily", "Weekly", "Monthly"]), ['day', 'week', 'month']):
+            with tab:
+                st.bar_chart(load_expense_trend(user_mobile, view_periods, grain), height=300)
+        
+        st.subheader("Month-over-Month")
+        monthly, changes = month_over_month(user_mobile, view_periods)
+        latest, latest_change = monthly.iloc[-1], changes.iloc[-1]
+        previous_month = schema.shift_period(view_periods[-1], -1)
+        st.caption(f"{format_period(view_periods[-1])} compared with {format_period(previous_month)}")
+        delta_cols = st.columns(min(len(latest), 4))
+        for position, (column, amount) in enumerate(latest.items()):
+            with delta_cols[position % len(delta_cols)]:
+                change = latest_change[column]
+                st.metric(
+                    column, format_money(amount),
+                    delta=None if pd.isna(change) else f"{change:+.1f}%",
+                    delta_color="inverse"
+                )
+        if len(view_periods) > 1:
+            table = monthly[['Total']].assign(**{'Change %': changes['Total'].round(1)})
+            table.index = [format_period(period) for period in table.index]
+            st.dataframe(table.iloc[::-1], use_container_width=True)
+        instrumentation.lap('trends')
         
         # Expense Insights
         st.markdown("---")
@@ -596,17 +915,20 @@ def show_expense_tracker():
         insight_cols = st.columns([1, 1, 1])
         
         with insight_cols[0]:
-            date_range = (pd.to_datetime(expenses_df['Date'].max()) - pd.to_datetime(expenses_df['Date'].min())).days + 1
-            avg_per_day = total_expenses / max(date_range, 1)
-            st.metric("Avg. Expense/Day", f"PKR {avg_per_day:,.2f}")
+            # Every day of the period so far counts, including days without expenses
+            today = datetime.now().date()
+            elapsed_days = ((view_end if today < view_start else min(view_end, today)) - view_start).days + 1
+            avg_per_day = total_expenses / max(elapsed_days, 1)
+            st.metric("Avg. Expense/Day", format_money(avg_per_day))
         
         with insight_cols[1]:
             top_category = category_expenses.idxmax()
             top_amount = category_expenses.max()
-            st.metric("Top Category", f"{top_category}", f"PKR {top_amount:,.2f}")
+            st.metric("Top Category", f"{top_category}", format_money(top_amount))
         
         with insight_cols[2]:
-            st.metric("Total Transactions", len(expenses_df))
+            st.metric("Total Transactions", summary['count'])
+        instrumentation.lap('insights')
         
         # Data Management
         st.markdown("---")
@@ -616,14 +938,21 @@ def show_expense_tracker():
         
         with col_clear2:
             if st.button("🗑️ Clear All Expenses", type="secondary", use_container_width=True):
-                filename = get_user_filename(user_mobile, EXPENSES_FILE)
-                if os.path.exists(filename):
-                    os.remove(filename)
+                snapshot_id = snapshot_user(user_mobile, "before Clear All Expenses")
+                if clear_expenses(user_mobile):
+                    st.session_state.undo_clear = snapshot_id
                     st.success("✅ All expenses cleared!")
                     st.rerun()
     
+    elif expense_months:
+        st.info(f"📭 No expenses recorded for {format_period(period_choice)}. Pick another period in the sidebar.")
+    
     else:
         st.info("📱 No expenses recorded yet. Add your first expense above! 👆")
+        if st.session_state.get('undo_clear') and st.button("↩️ Undo Clear All Expenses"):
+            restore_snapshot(user_mobile, st.session_state.undo_clear)
+            st.session_state.undo_clear = None
+            st.rerun()
         st.markdown("""
             ### How to use:
             1. **Set your monthly salary** in the sidebar
@@ -643,11 +972,41 @@ def show_expense_tracker():
         """,
         unsafe_allow_html=True
     )
+    instrumentation.lap('footer')
+    
+    trace = instrumentation.current()
+    if trace is not None:
+        show_debug_panel(trace)
+
+def show_debug_panel(trace):
+    """Sidebar panel with the timings of this rerun (EXPENSE_PROFILE=1, see instrumentation.py)"""
+    with st.sidebar.expander("🐞 Performance", expanded=False):
+        st.caption(
+            f"Rerun so far: {trace.elapsed() * 1000:,.1f} ms · "
+            f"{trace.file_reads} file reads · {trace.bytes_read / 1024:,.1f} KiB parsed"
+        )
+        st.dataframe(
+            pd.DataFrame(
+                [(name, seconds * 1000) for name, seconds in trace.sections], columns=['Section', 'ms']
+            ),
+            hide_index=True, use_container_width=True
+        )
+        st.dataframe(
+            pd.DataFrame(
+                [(name, calls, seconds * 1000) for name, (calls, seconds) in trace.calls.items()],
+                columns=['Storage call', 'Calls', 'ms']
+            ).sort_values('ms', ascending=False),
+            hide_index=True, use_container_width=True
+        )
 
 if not st.session_state.authenticated:
-    if st.session_state.otp_sent:
+    if st.session_state.otp_handle is not None:
         show_otp_verification()
     else:
         show_login_page()
 else:
-    show_expense_tracker()
\ No newline at end of file
+    instrumentation.start('tracker')
+    try:
+        show_expense_tracker()
+    finally:
+        instrumentation.finish()
\ No newline at end of file
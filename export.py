@@ -0,0 +1,107 @@
+"""
+Expense export for the download button
+
+Exports are built only when the user asks for one: the stored expenses are
+read in chunks (Storage.iter_expense_chunks) and each chunk is written
+straight to a spooled temporary file, so memory stays bounded by the chunk
+size and the compressed output rather than by the size of the ledger.
+
+Formats: CSV, gzip-compressed CSV and, when pyarrow is installed, Parquet
+and Arrow IPC.
+"""
+
+import gzip
+import io
+import tempfile
+
+from schema import from_minor
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pyarrow is optional
+    pa = None
+
+EXPORT_COLUMNS = ['Date', 'Category', 'Amount', 'Currency', 'Note']
+
+# Output beyond this size spills from memory to a temporary file
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def _normalize(chunk):
+    """Turn a typed expense chunk into plain export columns (ISO dates, amounts in their own currency)"""
+    chunk = chunk[EXPORT_COLUMNS].copy()
+    chunk['Date'] = chunk['Date'].dt.strftime('%Y-%m-%d')
+    chunk['Category'] = chunk['Category'].astype(str)
+    chunk['Amount'] = from_minor(chunk['Amount'])
+    return chunk
+
+
+def _write_csv(chunks, out):
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+    header = True
+    for chunk in chunks:
+        chunk.to_csv(text, index=False, header=header, lineterminator='\n', float_format='%.2f')
+        header = False
+    if header:
+        text.write(','.join(EXPORT_COLUMNS) + '\n')
+    text.detach()
+
+
+def _write_csv_gzip(chunks, out):
+    with gzip.GzipFile(fileobj=out, mode='wb') as compressed:
+        _write_csv(chunks, compressed)
+
+
+def _arrow_schema():
+    return pa.schema([
+        ('Date', pa.string()), ('Category', pa.string()), ('Amount', pa.float64()), ('Currency', pa.string()),
+        ('Note', pa.string())
+    ])
+
+
+def _write_parquet(chunks, out):
+    with pyarrow.parquet.ParquetWriter(out, _arrow_schema(), compression='zstd') as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=_arrow_schema(), preserve_index=False))
+
+
+def _write_arrow(chunks, out):
+    with pyarrow.ipc.new_file(out, _arrow_schema()) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=_arrow_schema(), preserve_index=False))
+
+
+# Format name -> (writer, file extension, MIME type, needs pyarrow)
+EXPORT_FORMATS = {
+    'CSV': (_write_csv, 'csv', 'text/csv', False),
+    'CSV (gzip)': (_write_csv_gzip, 'csv.gz', 'application/gzip', False),
+    'Parquet': (_write_parquet, 'parquet', 'application/vnd.apache.parquet', True),
+    'Arrow': (_write_arrow, 'arrow', 'application/vnd.apache.arrow.file', True),
+}
+
+
+def available_formats():
+    """Names of the export formats usable in this installation"""
+    return [name for name, (_, _, _, needs_arrow) in EXPORT_FORMATS.items() if pa is not None or not needs_arrow]
+
+
+def file_extension(fmt):
+    """File extension for an export format"""
+    return EXPORT_FORMATS[fmt][1]
+
+
+def mime_type(fmt):
+    """MIME type for an export format"""
+    return EXPORT_FORMATS[fmt][2]
+
+
+def export_expenses(store, mobile, fmt, start=None, end=None):
+    """Build an export of a user's expenses (optionally within [start, end]) and return its bytes"""
+    writer = EXPORT_FORMATS[fmt][0]
+    chunks = (_normalize(chunk) for chunk in store.iter_expense_chunks(mobile, start, end))
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as out:
+        writer(chunks, out)
+        out.seek(0)
+        return out.read()
@@ -0,0 +1,192 @@
+"""
+Bulk import of bank and wallet statements
+
+A statement (CSV, or Excel when openpyxl is installed) is read as text, its
+columns are mapped to Date / Amount / Category / Note, and every row is
+parsed, validated and given a category in one vectorized pass: dates and
+amounts are converted column-wise, and categories come from the statement's
+own category column or from keywords in the row's text, falling back to
+"Other". Every row of a statement is in the currency chosen for it.
+
+Before writing, rows already in the ledger are dropped using a hash index:
+each row is fingerprinted by (date, amount, currency, note) and by how many identical
+rows come before it, so re-importing an overlapping statement adds only the
+new rows while genuinely repeated expenses (two identical purchases on the
+same day) are kept. The remaining rows are written with
+Storage.append_expenses, one write per month.
+"""
+
+import importlib.util
+import io
+import re
+
+import numpy as np
+import pandas as pd
+
+from schema import AMOUNT_SCALE, BASE_CURRENCY, CATEGORIES, CATEGORY_DTYPE
+
+# Column roles of a statement; Date and Amount are required
+ROLES = ['Date', 'Amount', 'Category', 'Note']
+REQUIRED = ['Date', 'Amount']
+
+# Lower-case header names recognized for each role, best match first
+COLUMN_HINTS = {
+    'Date': ['date', 'transaction date', 'txn date', 'value date', 'posting date', 'booking date'],
+    'Amount': ['amount', 'debit', 'withdrawal', 'withdrawals', 'paid out', 'amount (pkr)', 'value'],
+    'Category': ['category', 'type', 'transaction type'],
+    'Note': ['description', 'narration', 'details', 'note', 'notes', 'memo', 'particulars', 'remarks'],
+}
+
+# The first number in an amount's text, with the "-" or "(" directly before it: (sign, number)
+AMOUNT_PATTERN = r'(?P<sign>[-(]?)\s*(?P<number>\d[\d,]*(?:\.\d+)?)'
+
+# Keywords (matched case-insensitively in the category and note text) for each category
+CATEGORY_KEYWORDS = {
+    'Food': ['food', 'grocer', 'restaurant', 'cafe', 'bakery', 'mart', 'foodpanda', 'kfc', 'pizza'],
+    'Rent': ['rent', 'landlord', 'lease'],
+    'Electricity': ['electric', 'k-electric', 'lesco', 'iesco', 'fesco', 'mepco', 'wapda', 'power'],
+    'Gas': ['sngpl', 'ssgc', 'gas bill', 'sui gas', 'lpg'],
+    'Education': ['school', 'tuition', 'university', 'college', 'academy', 'books'],
+    'Medical': ['pharma', 'hospital', 'clinic', 'doctor', 'medical', 'laboratory', 'medicine'],
+}
+
+EXCEL_SUPPORTED = importlib.util.find_spec('openpyxl') is not None
+
+
+def upload_types():
+    """File extensions accepted for statements"""
+    return ['csv', 'xlsx'] if EXCEL_SUPPORTED else ['csv']
+
+
+def read_statement(data, filename):
+    """Parse a statement file's bytes into a frame of text columns; raises ValueError if it can't"""
+    if filename.lower().endswith('.xlsx'):
+        if not EXCEL_SUPPORTED:
+            raise ValueError("Excel statements need the openpyxl package")
+        try:
+            raw = pd.read_excel(io.BytesIO(data), dtype=str)
+        except Exception as error:  # a damaged workbook fails anywhere in zipfile, the XML parser or openpyxl
+            raise ValueError(f"Could not read {filename}: {error!r}")
+    else:
+        try:
+            raw = pd.read_csv(io.BytesIO(data), dtype=str, skipinitialspace=True)
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as error:
+            raise ValueError(f"Could not read {filename}: {error}")
+    raw.columns = [str(column).strip() for column in raw.columns]
+    return raw.dropna(how='all')
+
+
+def guess_columns(columns):
+    """Best guess of the statement column for each role (None when there is no match)"""
+    by_name = {str(column).strip().lower(): column for column in columns}
+    mapping = {}
+    for role in ROLES:
+        mapping[role] = next((by_name[hint] for hint in COLUMN_HINTS[role] if hint in by_name), None)
+    return mapping
+
+
+def parse_amounts(text):
+    """
+    Amount text to floats; NaN where there is no number
+    "1,234.50", "PKR 1,500.00", "Rs. 1,500", "Rs.250.00" and "1,500.00 CR"
+    are positive; "PKR -20", "-Rs. 20", "(75.00)" and "Rs. (75.00)" are
+    negative. The number is picked out of the text, so the "." of "Rs." is
+    never taken for a decimal point
+    """
+    text = text.fillna('').astype(str).str.strip()
+    parts = text.str.extract(AMOUNT_PATTERN)
+    values = pd.to_numeric(parts['number'].str.replace(',', '', regex=False), errors='coerce')
+    negative = text.str.startswith('-') | parts['sign'].isin(['-', '('])
+    return values.where(~negative, -values.abs())
+
+
+def has_debit_signs(raw, amount_column):
+    """True if a statement's amounts include negative values (debits and credits in one column)"""
+    return amount_column is not None and bool((parse_amounts(raw[amount_column]) < 0).any())
+
+
+def map_categories(category_text, note_text):
+    """Category for every row: a known category name, else the first keyword match, else "Other" """
+    known = {category.lower(): category for category in CATEGORIES}
+    result = category_text.str.strip().str.lower().map(known)
+    text = category_text + ' ' + note_text
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        unresolved = result.isna()
+        if not unresolved.any():
+            break
+        pattern = '|'.join(re.escape(keyword) for keyword in keywords)
+        matches = unresolved & text.str.contains(pattern, case=False, regex=True)
+        result = result.mask(matches, category)
+    return result.fillna('Other').astype(CATEGORY_DTYPE)
+
+
+def prepare_statement(raw, mapping, debits_only=False, dayfirst=True, currency=BASE_CURRENCY):
+    """
+    Validate and convert the mapped statement columns in one pass
+    With debits_only, negative amounts are the expenses and other rows are
+    skipped as credits; otherwise every amount counts as an expense
+    Amounts are taken to be in currency
+    Returns (expenses as a typed frame without IDs, skipped rows with a Reason column)
+    """
+    blank = pd.Series('', index=raw.index)
+    dates = pd.to_datetime(raw[mapping['Date']], dayfirst=dayfirst, errors='coerce').dt.normalize()
+    amounts = parse_amounts(raw[mapping['Amount']])
+    category_text = raw[mapping['Category']].fillna('').astype(str) if mapping.get('Category') else blank
+    notes = raw[mapping['Note']].fillna('').astype(str).str.strip() if mapping.get('Note') else blank
+
+    reasons = pd.Series(None, index=raw.index, dtype=object)
+    if debits_only:
+        reasons = reasons.mask(amounts >= 0, 'credit')
+    amounts = amounts.abs()
+    reasons = reasons.mask(amounts == 0, 'zero amount')
+    reasons = reasons.mask(amounts.isna(), 'invalid amount')
+    reasons = reasons.mask(dates.isna(), 'invalid date')
+    valid = reasons.isna()
+
+    expenses = pd.DataFrame({
+        'Date': dates[valid],
+        'Category': map_categories(category_text[valid], notes[valid]),
+        'Amount': (amounts[valid] * AMOUNT_SCALE).round().astype('int64'),
+        'Note': notes[valid],
+        'Currency': currency,
+    }).reset_index(drop=True)
+    skipped = raw[~valid].assign(Reason=reasons[~valid])
+    return expenses, skipped
+
+
+def fingerprints(df):
+    """
+    uint64 key per expense row from (day, amount, currency, note) plus the number of
+    identical rows before it, so duplicates within a statement stay distinct
+    """
+    key = pd.DataFrame({
+        # Same date unit on both sides, or equal days would hash differently
+        'Date': df['Date'].astype('datetime64[ns]').dt.normalize(),
+        'Amount': df['Amount'],
+        'Currency': df['Currency'],
+        'Note': df['Note'].str.strip(),
+    })
+    row_hash = pd.util.hash_pandas_object(key, index=False)
+    occurrence = row_hash.groupby(row_hash).cumcount()
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({'hash': row_hash.to_numpy(), 'occurrence': occurrence.to_numpy()}), index=False
+    ).to_numpy()
+
+
+def drop_existing(store, mobile, expenses):
+    """Remove the expenses already in the user's ledger; returns (new expenses, number dropped)"""
+    if expenses.empty:
+        return expenses, 0
+    chunks = list(store.iter_expense_chunks(mobile, expenses['Date'].min(), expenses['Date'].max()))
+    if not chunks:
+        return expenses, 0
+    index = fingerprints(pd.concat(chunks, ignore_index=True))
+    duplicate = np.isin(fingerprints(expenses), index)
+    return expenses[~duplicate].reset_index(drop=True), int(duplicate.sum())
+
+
+def import_expenses(store, mobile, expenses):
+    """Write the statement expenses that are not in the ledger yet; returns (imported, duplicates)"""
+    new, duplicates = drop_existing(store, mobile, expenses)
+    store.append_expenses(mobile, new)
+    return len(new), duplicates
@@ -0,0 +1,135 @@
+"""
+Opt-in timing of the expense tracker page
+
+Set EXPENSE_PROFILE=1 to enable it. Each rerun of the tracker page is then
+traced: the time spent in each section of the page (marked with lap()), in
+each storage call, and the number of data files read and bytes parsed. The
+page shows the trace in a sidebar panel, and every finished trace is logged
+as one JSON line on the "expense_tracker.perf" logger (stderr by default).
+
+When disabled, instrument() returns the storage object itself and lap() and
+count_read() return after a single thread-local lookup, so the hooks can
+stay in place. Traces are per thread: Streamlit runs each session's script
+in its own thread, and work done on other threads (background compaction,
+the password pool) is not attributed to any rerun.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('EXPENSE_PROFILE', '') not in ('', '0')
+
+logger = logging.getLogger('expense_tracker.perf')
+if ENABLED and not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_local = threading.local()
+
+
+class Trace:
+    """Timings and read counters of one rerun"""
+
+    def __init__(self, page):
+        self.page = page
+        self.started = time.perf_counter()
+        self._last_lap = self.started
+        self.sections = []
+        # storage method -> [calls, seconds]
+        self.calls = {}
+        self.file_reads = 0
+        self.bytes_read = 0
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.sections.append((name, now - self._last_lap))
+        self._last_lap = now
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {
+            'event': 'rerun',
+            'page': self.page,
+            'total_ms': round(self.elapsed() * 1000, 2),
+            'sections': {name: round(seconds * 1000, 2) for name, seconds in self.sections},
+            'storage_calls': {
+                name: {'calls': calls, 'ms': round(seconds * 1000, 2)} for name, (calls, seconds) in self.calls.items()
+            },
+            'file_reads': self.file_reads,
+            'bytes_read': self.bytes_read,
+        }
+
+
+def start(page):
+    """Begin tracing a rerun on this thread (returns None when instrumentation is disabled)"""
+    _local.trace = Trace(page) if ENABLED else None
+    return _local.trace
+
+
+def finish():
+    """Stop tracing on this thread and log the trace as a JSON line"""
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    if trace is not None:
+        logger.info(json.dumps(trace.as_dict()))
+    return trace
+
+
+def current():
+    """The trace of the rerun running on this thread, or None"""
+    return getattr(_local, 'trace', None)
+
+
+def lap(name):
+    """Record the time since the previous lap (or the start) as section name"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.lap(name)
+
+
+def count_read(nbytes):
+    """Count a data file read of nbytes bytes"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.file_reads += 1
+        trace.bytes_read += nbytes
+
+
+class _TracedStorage:
+    """Proxy of a storage backend that times its method calls into the current trace"""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        attribute = getattr(self._store, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            trace = getattr(_local, 'trace', None)
+            if trace is None:
+                return attribute(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                entry = trace.calls.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += time.perf_counter() - started
+        return timed
+
+
+def instrument(store):
+    """Wrap a storage backend so its calls are traced (the backend itself when disabled)"""
+    return _TracedStorage(store) if ENABLED else store
@@ -0,0 +1,156 @@
+"""
+Server-side store of pending OTP codes
+
+Codes live in one process-wide OTPStore, keyed by mobile number; a session
+only keeps the opaque handle returned by issue(). Entries expire after
+OTP_TTL seconds and are evicted through a heap ordered by expiry, so memory
+stays bounded (at most MAX_ENTRIES codes) even under bursts of signups.
+Codes are compared in constant time and each mobile number gets at most
+MAX_ATTEMPTS wrong guesses per code (the count carries over when a code is
+resent), after which the code is discarded.
+"""
+
+import heapq
+import hmac
+import itertools
+import secrets
+import threading
+import time
+
+OTP_TTL = 300
+MAX_ATTEMPTS = 5
+MAX_ENTRIES = 100_000
+
+# Outcomes of OTPStore.verify()
+VERIFIED = 'verified'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+LOCKED = 'locked'
+
+
+def generate_code():
+    """A random 6-digit code"""
+    return f"{secrets.randbelow(1_000_000):06d}"
+
+
+class _Entry:
+    __slots__ = ('handle', 'mobile', 'code', 'expires_at', 'attempts', 'delivery')
+
+    def __init__(self, handle, mobile, code, expires_at, attempts, delivery):
+        self.handle = handle
+        self.mobile = mobile
+        self.code = code
+        self.expires_at = expires_at
+        self.attempts = attempts
+        self.delivery = delivery
+
+
+class OTPStore:
+    """Pending OTP codes by mobile number, with TTL eviction and attempt limits"""
+
+    def __init__(self, ttl=OTP_TTL, max_attempts=MAX_ATTEMPTS, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._by_mobile = {}
+        self._by_handle = {}
+        # (expires_at, sequence, entry); entries replaced or removed since
+        # they were pushed are skipped when they reach the top
+        self._expiry = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_mobile)
+
+    def issue(self, mobile, code, delivery=None):
+        """
+        Store a new code for a mobile number, replacing any earlier one
+        delivery is an optional reference to the SMS job (see sms.py)
+        Returns the handle the session keeps
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            previous = self._by_mobile.get(mobile)
+            attempts = previous.attempts if previous is not None else 0
+            if previous is not None:
+                self._drop(previous)
+            entry = _Entry(secrets.token_urlsafe(16), mobile, code, now + self.ttl, attempts, delivery)
+            self._by_mobile[mobile] = entry
+            self._by_handle[entry.handle] = entry
+            heapq.heappush(self._expiry, (entry.expires_at, next(self._sequence), entry))
+            while len(self._by_mobile) > self.max_entries:
+                # Full - give up the code closest to expiring
+                self._drop(heapq.heappop(self._expiry)[2])
+            return entry.handle
+
+    def verify(self, handle, code):
+        """
+        Check a code against the one stored for handle
+        Returns (outcome, mobile, attempts left) where outcome is VERIFIED,
+        INVALID, EXPIRED (unknown or expired handle) or LOCKED (too many
+        wrong codes); a verified code cannot be used again
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._by_handle.get(handle)
+            if entry is None:
+                return EXPIRED, None, 0
+            if hmac.compare_digest(entry.code.encode(), str(code).encode()):
+                self._drop(entry)
+                return VERIFIED, entry.mobile, self.max_attempts - entry.attempts
+            entry.attempts += 1
+            if entry.attempts >= self.max_attempts:
+                self._drop(entry)
+                return LOCKED, entry.mobile, 0
+            return INVALID, entry.mobile, self.max_attempts - entry.attempts
+
+    def lookup(self, handle):
+        """
+        Return (mobile, code, seconds left, delivery) for a live handle, or None
+        The code is only meant for demo mode, where it is shown on screen
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._by_handle.get(handle)
+            if entry is None:
+                return None
+            return entry.mobile, entry.code, entry.expires_at - now, entry.delivery
+
+    def discard(self, handle):
+        """Forget the code behind a handle (e.g. when the user goes back to login)"""
+        with self._lock:
+            entry = self._by_handle.get(handle)
+            if entry is not None:
+                self._drop(entry)
+
+    def _drop(self, entry):
+        if self._by_handle.get(entry.handle) is entry:
+            del self._by_handle[entry.handle]
+        if self._by_mobile.get(entry.mobile) is entry:
+            del self._by_mobile[entry.mobile]
+
+    def _evict(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            self._drop(heapq.heappop(self._expiry)[2])
+        if len(self._expiry) > 2 * len(self._by_handle) + 64:
+            # Mostly stale heap items from replaced or verified codes - rebuild
+            self._expiry = [item for item in self._expiry if self._by_handle.get(item[2].handle) is item[2]]
+            heapq.heapify(self._expiry)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The process-wide OTP store (survives Streamlit reruns)"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = OTPStore()
+        return _store
@@ -0,0 +1,111 @@
+"""
+Password hashing for the Home Expense Tracker
+
+Passwords are stored as salted scrypt hashes in a versioned format:
+    scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+Bare 64-character hex strings are the unsalted SHA-256 hashes written by
+earlier versions; they still verify, and verify_password() reports that they
+(like scrypt hashes made with an outdated cost) should be rehashed.
+
+scrypt is slow and memory-hard on purpose, so the work runs on a bounded
+thread pool (hashlib releases the GIL while hashing): concurrent logins queue
+for a worker instead of each allocating scrypt's memory at once, and the
+Streamlit script threads only wait for their own result.
+
+The cost can be tuned with environment variables; pick PASSWORD_SCRYPT_N with
+    python benchmarks/calibrate_kdf.py --concurrency 8 --target-p95-ms 250
+"""
+
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+SCHEME = "scrypt"
+SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+# Hashes computed at once; each needs about 128 * r * n bytes (16 MiB by default)
+KDF_WORKERS = int(os.environ.get('PASSWORD_KDF_WORKERS', min(4, os.cpu_count() or 1)))
+# Seconds a login waits for a worker before giving up
+KDF_TIMEOUT = 30
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=HASH_BYTES
+    )
+
+
+def hash_password(password, n=None):
+    """Return a new salted hash of password in the versioned format"""
+    n = n or SCRYPT_N
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _scrypt(password, salt, n, SCRYPT_R, SCRYPT_P)
+    return f"{SCHEME}${n}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def is_legacy_hash(stored):
+    """True for the unsalted SHA-256 hashes of earlier versions"""
+    return '$' not in stored and len(stored) == 64
+
+
+def verify_password(password, stored):
+    """
+    Check password against a stored hash
+    Returns (matches, needs_rehash); needs_rehash is set for legacy hashes and
+    hashes made with other parameters than the current ones
+    """
+    if is_legacy_hash(stored):
+        digest = hashlib.sha256(password.encode()).hexdigest()
+        matches = hmac.compare_digest(digest, stored)
+        return matches, matches
+
+    try:
+        scheme, n, r, p, salt, digest = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, digest = bytes.fromhex(salt), bytes.fromhex(digest)
+    except ValueError:
+        return False, False
+    if scheme != SCHEME:
+        return False, False
+    matches = hmac.compare_digest(_scrypt(password, salt, n, r, p), digest)
+    return matches, matches and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def kdf_pool():
+    """The process-wide worker pool for password hashing"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix='kdf')
+        return _pool
+
+
+def _run_in_pool(function, *args):
+    future = kdf_pool().submit(function, *args)
+    try:
+        return future.result(timeout=KDF_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # Don't leave the work queued for a login that has given up
+        future.cancel()
+        raise
+
+
+def hash_in_pool(password):
+    """hash_password() on the worker pool; raises concurrent.futures.TimeoutError when the pool is saturated"""
+    return _run_in_pool(hash_password, password)
+
+
+def verify_in_pool(password, stored):
+    """verify_password() on the worker pool; raises concurrent.futures.TimeoutError when the pool is saturated"""
+    return _run_in_pool(verify_password, password, stored)
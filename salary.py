@@ -0,0 +1,56 @@
+"""
+Effective-dated salary timeline
+
+The salary history (see storage.SALARY_COLUMNS) is a list of changes, each
+taking effect on its date. SalaryTimeline sorts the changes once and answers
+"salary in effect on day X" with a binary search, so looking up every month
+of a long view stays cheap however many changes a user has made. Storage
+backends cache one per user until the history changes.
+
+A month's salary is the one in effect on its last day, so a raise saved
+mid-month counts for that whole month. Months before the first change use
+the first salary, as the app did before salaries had a history.
+"""
+
+import bisect
+
+from schema import day_key, shift_period
+
+
+class SalaryTimeline:
+    """A user's salary changes ordered by effective date"""
+
+    def __init__(self, changes=()):
+        """changes: (effective date, salary) pairs in the order they were saved"""
+        by_date = {}
+        for date, salary in changes:
+            # A later save for the same day replaces the earlier one
+            by_date[day_key(date)] = float(salary)
+        self.dates = sorted(by_date)
+        self.salaries = [by_date[date] for date in self.dates]
+
+    @classmethod
+    def from_history(cls, df):
+        """Build the timeline of a salary history frame (SALARY_COLUMNS, in saved order)"""
+        return cls(zip(df['date'], df['salary']))
+
+    def _at(self, position):
+        if not self.salaries:
+            return 0.0
+        return self.salaries[max(position, 0)]
+
+    def salary_on(self, date):
+        """Salary in effect on a day (0.0 if none was ever set)"""
+        return self._at(bisect.bisect_right(self.dates, day_key(date)) - 1)
+
+    def period_salary(self, period):
+        """Salary of a month ("YYYY-MM"): the one in effect on its last day"""
+        return self._at(bisect.bisect_left(self.dates, shift_period(period, 1) + '-01') - 1)
+
+    def budget(self, periods):
+        """Sum of the salaries of the given months"""
+        return sum(self.period_salary(period) for period in periods)
+
+    def changes(self):
+        """(effective date, salary) of every change, oldest first"""
+        return list(zip(self.dates, self.salaries))
@@ -0,0 +1,121 @@
+"""
+In-memory schema of expense frames
+
+Every backend returns expenses in this layout and every writer goes through
+the conversions below:
+- ID: string
+- Date: datetime64, parsed once when the data is read
+- Category: categorical over CATEGORIES (unknown values read back as "Other")
+- Amount: int64 minor units (paisa), so sums are exact
+- Note: string
+- Currency: categorical ISO code the amount is in (BASE_CURRENCY when not recorded)
+
+Files and the database keep amounts as decimal numbers; only the in-memory
+frames use minor units. Use to_minor()/from_minor() at the edges.
+Totals are in BASE_CURRENCY; currency.py converts the other amounts.
+"""
+
+import pandas as pd
+
+CATEGORIES = ["Food", "Rent", "Electricity", "Gas", "Education", "Medical", "Other"]
+CATEGORY_DTYPE = pd.CategoricalDtype(CATEGORIES)
+
+# dtype hints for the CSV parser, so categories are built while parsing
+CSV_DTYPES = {'ID': str, 'Category': CATEGORY_DTYPE, 'Currency': 'category'}
+
+# Minor units per currency unit
+AMOUNT_SCALE = 100
+
+# Currency of totals, and of expenses recorded before they had a currency
+BASE_CURRENCY = 'PKR'
+
+
+def to_minor(amount):
+    """Convert an amount in currency units to integer minor units"""
+    return int(round(float(amount) * AMOUNT_SCALE))
+
+
+def from_minor(minor):
+    """Convert integer minor units (a number or a Series) to currency units"""
+    return minor / AMOUNT_SCALE
+
+
+def format_minor(minor):
+    """Exact decimal text for an amount in minor units, as stored in files"""
+    sign = '-' if minor < 0 else ''
+    units, cents = divmod(abs(int(minor)), AMOUNT_SCALE)
+    return f"{sign}{units}.{cents:02d}"
+
+
+def format_amounts(minor):
+    """format_minor() for a whole Series of minor units at once"""
+    magnitude = minor.abs()
+    text = (magnitude // AMOUNT_SCALE).astype(str) + '.' + (magnitude % AMOUNT_SCALE).astype(str).str.zfill(2)
+    return text.where(minor >= 0, '-' + text)
+
+
+def validate_category(category):
+    """Return category if it is one of CATEGORIES, else raise ValueError"""
+    if category not in CATEGORIES:
+        raise ValueError(f"Unknown category: {category!r}")
+    return category
+
+
+def apply_expense_schema(df):
+    """Convert a raw expense frame (as parsed from CSV or SQL) to the typed layout"""
+    typed = pd.DataFrame(index=df.index)
+    typed['ID'] = df['ID'].astype(str)
+    typed['Date'] = pd.to_datetime(df['Date'], format='ISO8601')
+    category = df['Category'].astype(CATEGORY_DTYPE)
+    typed['Category'] = category.fillna('Other') if category.isna().any() else category
+    typed['Amount'] = (pd.to_numeric(df['Amount']).astype('float64') * AMOUNT_SCALE).round().astype('int64')
+    typed['Note'] = df['Note'].astype(object).where(df['Note'].notna(), '').astype(str)
+    if 'Currency' in df.columns:
+        currency = df['Currency'].astype('category')
+        if currency.isna().any():
+            currency = currency.cat.add_categories([BASE_CURRENCY]).fillna(BASE_CURRENCY)
+        typed['Currency'] = currency
+    else:
+        typed['Currency'] = pd.Series(BASE_CURRENCY, index=df.index, dtype='category')
+    return typed
+
+
+def empty_expenses():
+    """An empty typed expense frame"""
+    return apply_expense_schema(pd.DataFrame(
+        {'ID': [], 'Date': [], 'Category': [], 'Amount': [], 'Note': [], 'Currency': []}
+    ))
+
+
+def day_key(date):
+    """ISO day string ("YYYY-MM-DD") for a date, datetime, Timestamp or string"""
+    if hasattr(date, 'strftime'):
+        return date.strftime('%Y-%m-%d')
+    return str(date)[:10]
+
+
+def period_key(date):
+    """Year-month period ("YYYY-MM") of a date, datetime, Timestamp or string"""
+    return day_key(date)[:7]
+
+
+def shift_period(period, months):
+    """The period a number of months after (or, if negative, before) period"""
+    year, month = map(int, period.split('-'))
+    index = year * 12 + month - 1 + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def period_bounds(period):
+    """First and last day of a period, as Timestamps"""
+    first = pd.Timestamp(period + '-01')
+    return first, first + pd.offsets.MonthEnd(0)
+
+
+def periods_between(first, last):
+    """Every period from first to last, inclusive"""
+    periods = []
+    while first <= last:
+        periods.append(first)
+        first = shift_period(first, 1)
+    return periods
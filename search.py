@@ -0,0 +1,122 @@
+"""
+Inverted index over expense notes
+
+A NoteIndex covers one user's period. It maps every word (lower-cased run of
+letters and digits) of the notes to the IDs of the expenses using it, and
+keeps the distinct words sorted so that a prefix ("groc") finds its words
+with a binary search. Along with each expense it remembers the date and
+category, so date and category filters, counting and ordering all run on
+the index; only the expenses of the page shown are read from storage.
+
+Storage backends keep one NoteIndex per user and period next to the
+ExpenseSummary and update it the same way on every write (see storage.py).
+"""
+
+import bisect
+import heapq
+import re
+
+from schema import day_key
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """The distinct lower-case words of a note or query, in order"""
+    return list(dict.fromkeys(TOKEN_PATTERN.findall(str(text).lower())))
+
+
+class NoteIndex:
+    """Word -> expense IDs over the notes of one user's period"""
+
+    def __init__(self):
+        self.postings = {}
+        # Distinct words in sorted order, for prefix lookups
+        self.words = []
+        # Expense ID -> (day, insertion number, category, words)
+        self.entries = {}
+        self._sequence = 0
+
+    @classmethod
+    def from_frame(cls, df):
+        """Build the index of an expense DataFrame (rows in the order they were added)"""
+        index = cls()
+        index.extend(df['ID'], df['Date'], df['Category'], df['Note'])
+        return index
+
+    def add(self, expense_id, date, category, note):
+        """Index one new expense"""
+        words = tokenize(note)
+        self.entries[str(expense_id)] = (day_key(date), self._sequence, str(category), words)
+        self._sequence += 1
+        for word in words:
+            ids = self.postings.get(word)
+            if ids is None:
+                ids = self.postings[word] = set()
+                bisect.insort(self.words, word)
+            ids.add(str(expense_id))
+
+    def extend(self, ids, dates, categories, notes):
+        """Index a batch of new expenses, given column by column"""
+        for expense_id, date, category, note in zip(ids, dates, categories, notes):
+            self.add(expense_id, date, category, note)
+
+    def remove(self, expense_id):
+        """Forget a deleted expense (unknown IDs are ignored)"""
+        entry = self.entries.pop(str(expense_id), None)
+        if entry is None:
+            return
+        for word in entry[3]:
+            ids = self.postings[word]
+            ids.discard(str(expense_id))
+            if not ids:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def clear(self):
+        """Forget every expense"""
+        self.__init__()
+
+    def _prefixed(self, prefix):
+        """IDs of the expenses with a word starting with prefix"""
+        ids = set()
+        position = bisect.bisect_left(self.words, prefix)
+        while position < len(self.words) and self.words[position].startswith(prefix):
+            ids |= self.postings[self.words[position]]
+            position += 1
+        return ids
+
+    def search(self, text, start=None, end=None, categories=None, limit=None):
+        """
+        Find the expenses whose note has a word starting with every word of
+        text, within [start, end] and categories
+        Returns (number found, IDs of the first limit of them, newest and latest
+        added first); with no date or category filter, counting needs no scan
+        """
+        matches = None
+        for prefix in tokenize(text):
+            ids = self._prefixed(prefix)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return 0, []
+        if matches is None:
+            matches = self.entries.keys()
+        if start is not None or end is not None or categories is not None:
+            start = day_key(start) if start is not None else None
+            end = day_key(end) if end is not None else None
+            categories = set(categories) if categories is not None else None
+            matches = [
+                expense_id for expense_id in matches
+                if self._within(self.entries[expense_id], start, end, categories)
+            ]
+        if limit == 0:
+            return len(matches), []
+        # Entries start with (day, insertion number), so they order newest first
+        newest = heapq.nlargest(len(matches) if limit is None else limit, matches, key=self.entries.__getitem__)
+        return len(matches), newest
+
+    @staticmethod
+    def _within(entry, start, end, categories):
+        day, category = entry[0], entry[2]
+        return (start is None or day >= start) and (end is None or day <= end) and (
+            categories is None or category in categories)
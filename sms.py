@@ -0,0 +1,328 @@
+"""
+Background SMS delivery for OTP codes
+
+The UI never talks to the SMS provider itself: it hands the message to the
+process-wide OTPDispatcher, which queues it and returns at once. Worker
+threads deliver queued messages, retrying failed sends with exponential
+backoff, and each mobile number may only request a few messages per window.
+
+Providers:
+- DemoProvider (default): delivers nowhere; the app shows the code on screen
+- HTTPGatewayProvider: POSTs {"to": ..., "message": ...} as JSON to a gateway URL
+
+Choose one with SMS_PROVIDER ("demo" or "http") and SMS_GATEWAY_URL.
+For local testing, start a fake gateway that accepts those requests (and can
+be told to fail or be slow) with:
+    python sms.py fake-gateway --port 8025 --fail-rate 0.3 --latency-ms 500
+and run the app with SMS_PROVIDER=http SMS_GATEWAY_URL=http://127.0.0.1:8025/send
+"""
+
+import argparse
+import collections
+import heapq
+import http.server
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Messages a mobile number may request per RATE_WINDOW seconds
+RATE_LIMIT = 3
+RATE_WINDOW = 600
+
+# Delivery attempts per message and the backoff between them (seconds)
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# Messages waiting for delivery before new ones are refused
+MAX_PENDING = 10_000
+# Delivery states kept for status()
+MAX_TRACKED = 10_000
+
+
+class SMSDeliveryError(Exception):
+    """A provider could not deliver a message; retryable says whether trying again may help"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class RateLimited(Exception):
+    """Too many messages were requested for a mobile number"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class QueueFull(Exception):
+    """The dispatcher has too many undelivered messages"""
+
+# ============================================
+# PROVIDERS
+# ============================================
+
+class SMSProvider:
+    """Interface of an SMS provider"""
+
+    def send(self, mobile, message):
+        """Deliver one message; raise SMSDeliveryError on failure"""
+        raise NotImplementedError
+
+
+class DemoProvider(SMSProvider):
+    """Delivers nowhere (the app shows OTP codes on screen in demo mode)"""
+
+    def send(self, mobile, message):
+        pass
+
+
+class HTTPGatewayProvider(SMSProvider):
+    """Sends messages to an HTTP gateway as JSON POST requests"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, mobile, message):
+        body = json.dumps({'to': mobile, 'message': message}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as error:
+            # Client errors other than throttling will fail the same way again
+            raise SMSDeliveryError(f"Gateway returned {error.code}", retryable=error.code == 429 or error.code >= 500)
+        except (urllib.error.URLError, OSError) as error:
+            raise SMSDeliveryError(f"Gateway unreachable: {error}")
+
+# ============================================
+# DISPATCHER
+# ============================================
+
+class RateLimiter:
+    """Sliding-window limit on the number of events per key"""
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW):
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def acquire(self, key, now=None):
+        """Record an event for key; raises RateLimited if the key is over its limit"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            events = self._events.setdefault(key, collections.deque())
+            while events and events[0] <= now - self.window:
+                events.popleft()
+            if len(events) >= self.limit:
+                raise RateLimited(events[0] + self.window - now)
+            events.append(now)
+            if len(self._events) > 2 * MAX_TRACKED:
+                # Forget keys whose events have all expired
+                self._events = {
+                    key: events for key, events in self._events.items() if events and events[-1] > now - self.window
+                }
+
+
+class OTPDispatcher:
+    """
+    Queue of outgoing messages delivered by background worker threads
+    Failed sends are rescheduled with exponential backoff (plus jitter) until
+    they succeed, fail permanently or run out of attempts
+    """
+
+    def __init__(self, provider, workers=2, rate_limiter=None):
+        self.provider = provider
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._condition = threading.Condition()
+        # Heap of (due time, sequence, job id, mobile, message, attempt)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._states = collections.OrderedDict()
+        self._workers = [
+            threading.Thread(target=self._work, name=f'sms-{n}', daemon=True) for n in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def enqueue(self, mobile, message):
+        """
+        Queue a message for delivery and return its job ID without waiting
+        Raises RateLimited or QueueFull when the message is refused
+        """
+        with self._condition:
+            if len(self._heap) >= MAX_PENDING:
+                raise QueueFull()
+        self.rate_limiter.acquire(mobile)
+        job_id = f"{mobile}-{next(self._sequence)}"
+        with self._condition:
+            self._set_state(job_id, {'state': 'queued', 'attempts': 0, 'error': None})
+            heapq.heappush(self._heap, (time.monotonic(), next(self._sequence), job_id, mobile, message, 1))
+            self._condition.notify()
+        return job_id
+
+    def status(self, job_id):
+        """Return {'state', 'attempts', 'error'} of a job, or None if unknown"""
+        with self._condition:
+            state = self._states.get(job_id)
+            return dict(state) if state else None
+
+    def pending(self):
+        """Number of messages waiting for delivery"""
+        with self._condition:
+            return len(self._heap)
+
+    def _set_state(self, job_id, state):
+        self._states[job_id] = state
+        self._states.move_to_end(job_id)
+        while len(self._states) > MAX_TRACKED:
+            self._states.popitem(last=False)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)
+                self._condition.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _work(self):
+        while True:
+            _, _, job_id, mobile, message, attempt = self._next_job()
+            with self._condition:
+                self._set_state(job_id, {'state': 'sending', 'attempts': attempt, 'error': None})
+            try:
+                self.provider.send(mobile, message)
+            except SMSDeliveryError as error:
+                with self._condition:
+                    if error.retryable and attempt < MAX_ATTEMPTS:
+                        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                        self._set_state(job_id, {'state': 'retrying', 'attempts': attempt, 'error': str(error)})
+                        heapq.heappush(
+                            self._heap, (time.monotonic() + delay, next(self._sequence), job_id, mobile, message, attempt + 1)
+                        )
+                        self._condition.notify()
+                    else:
+                        self._set_state(job_id, {'state': 'failed', 'attempts': attempt, 'error': str(error)})
+            except Exception as error:  # a provider bug must not kill the worker
+                with self._condition:
+                    self._set_state(job_id, {'state': 'failed', 'attempts': attempt, 'error': repr(error)})
+            else:
+                with self._condition:
+                    self._set_state(job_id, {'state': 'sent', 'attempts': attempt, 'error': None})
+
+
+def open_provider(kind=None, **options):
+    """Create the provider named by kind (default: $SMS_PROVIDER or "demo")"""
+    kind = kind or os.environ.get('SMS_PROVIDER', 'demo')
+    if kind == 'demo':
+        return DemoProvider()
+    if kind == 'http':
+        options.setdefault('url', os.environ.get('SMS_GATEWAY_URL', 'http://127.0.0.1:8025/send'))
+        return HTTPGatewayProvider(**options)
+    raise ValueError(f"Unknown SMS provider: {kind!r}")
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """The process-wide dispatcher (survives Streamlit reruns)"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = OTPDispatcher(open_provider())
+        return _dispatcher
+
+# ============================================
+# FAKE GATEWAY (local testing)
+# ============================================
+
+class FakeGateway:
+    """
+    Local HTTP server that accepts the requests of HTTPGatewayProvider
+    fail_rate of the requests are answered with 503 and every request takes
+    latency seconds; accepted messages are kept in .messages
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, fail_rate=0.0, latency=0.0):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.messages = []
+        self.requests = 0
+        self._lock = threading.Lock()
+        gateway = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(gateway.latency)
+                with gateway._lock:
+                    gateway.requests += 1
+                    failed = random.random() < gateway.fail_rate
+                    if not failed:
+                        gateway.messages.append(json.loads(body))
+                self.send_response(503 if failed else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({'ok': not failed}).encode('utf-8'))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/send"
+
+    def start(self):
+        """Serve in a background thread; returns the URL to send to"""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home Expense Tracker SMS tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    fake = commands.add_parser('fake-gateway', help="run a local SMS gateway that prints what it receives")
+    fake.add_argument('--port', type=int, default=8025)
+    fake.add_argument('--fail-rate', type=float, default=0.0, help="share of requests answered with 503")
+    fake.add_argument('--latency-ms', type=float, default=0.0, help="delay before answering each request")
+    args = parser.parse_args(argv)
+
+    if args.command == 'fake-gateway':
+        gateway = FakeGateway(port=args.port, fail_rate=args.fail_rate, latency=args.latency_ms / 1000)
+        print(f"Fake SMS gateway listening on {gateway.url}")
+        gateway.start()
+        seen = 0
+        try:
+            while True:
+                time.sleep(0.5)
+                for message in gateway.messages[seen:]:
+                    print(f"SMS to {message['to']}: {message['message']}")
+                seen = len(gateway.messages)
+        except KeyboardInterrupt:
+            gateway.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
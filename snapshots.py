@@ -0,0 +1,407 @@
+"""
+Incremental snapshots of the CSV data root, and restoring a user's files
+
+A snapshot captures users.csv, password_updates.csv, the exchange rate table
+and every user's salary and expense files (see storage.CSVStorage) as they
+were when it was taken.
+The snapshot repository (SNAPSHOT_DIR in the data root, or
+$EXPENSE_SNAPSHOT_DIR) is content-addressed, like git:
+    objects/ab/<sha-256>   zlib-compressed file chunks and directory listings
+    manifests/<id>.json    one per snapshot: when it was taken and its root listing
+
+Files are split into CHUNK_SIZE chunks stored under the hash of their
+contents, so a chunk already in the repository is never written again: the
+data files only ever grow by appends, which leave every chunk but the last
+unchanged. Each directory is stored as a listing of its files' size, mtime
+and chunks, and a file whose size and mtime match the previous snapshot's
+listing is not read at all, so a snapshot costs one stat per file plus
+reading the files that changed. Listings are objects too; a user directory
+with no changes has the same listing as before and is not written again.
+Most user files are a few hundred bytes, so files under INLINE_SIZE are
+kept inside the listing: a user's small files are compressed together and
+cost one object rather than a filesystem block each.
+
+Files are read without taking their locks: writers only append whole
+records or rename a new file into place, and a snapshot keeps a file up to
+its last complete record (see csvfiles.complete_length).
+
+Usage:
+    python snapshots.py take --every 300 --keep 288   # a snapshot every 5 minutes, a day's worth kept
+    python snapshots.py list --mobile 923001234567
+    python snapshots.py restore 20241005T101500123456Z --mobile 923001234567
+    python snapshots.py extract 20241005T101500123456Z --to /tmp/restored
+"""
+
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+import zlib
+
+from accounts import PASSWORD_UPDATES_FILE, USERS_FILE
+from currency import RATES_FILENAME
+from csvfiles import complete_length, file_lock, fsync_directory, replace_file
+from storage import USER_DATA_DIR, CSVStorage, get_user_filename, safe_mobile, user_shard
+
+SNAPSHOT_DIR = "snapshots"
+CHUNK_SIZE = 1 << 20
+# Smaller files are kept in their directory's listing rather than as objects of their own
+INLINE_SIZE = 4096
+COMPRESSION_LEVEL = 3
+# Taken by every snapshot, restore and prune (a prune must not sweep the objects of a snapshot in progress)
+REPOSITORY_LOCK = "repository"
+
+_EMPTY_TREE = {'files': {}, 'dirs': {}}
+
+
+def _encode_tree(files, dirs):
+    return json.dumps({'files': files, 'dirs': dirs}, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _wanted(name, root_files=None):
+    """True for the data files a snapshot keeps (not locks, temporary files or, in the root, unrelated files)"""
+    if name.startswith('.') or name.endswith('.lock'):
+        return False
+    return root_files is None or name in root_files
+
+
+def _sync():
+    """Flush every object written without fsync before a manifest refers to them"""
+    if hasattr(os, 'sync'):
+        os.sync()
+
+
+class SnapshotRepository:
+    """A snapshot repository directory (see the module docstring)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.manifests = os.path.join(path, 'manifests')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.manifests, exist_ok=True)
+
+    def _lock(self):
+        return file_lock(os.path.join(self.path, REPOSITORY_LOCK))
+
+    # Objects
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, data, stats=None):
+        """Store data unless an object with the same contents exists; returns its digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = zlib.compress(data, COMPRESSION_LEVEL)
+            # Synced all at once before the manifest is written
+            replace_file(path, compressed, durable=False)
+            if stats is not None:
+                stats['objects'] += 1
+                stats['stored'] += len(compressed)
+        return digest
+
+    def get(self, digest):
+        """The contents of an object"""
+        with open(self._object_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def read_tree(self, digest):
+        """
+        A directory listing: {'files': {name: entry}, 'dirs': {name: digest}}
+        with entries [size, mtime_ns, chunk digests] or, for files under
+        INLINE_SIZE, [size, mtime_ns, [], text]
+        """
+        return json.loads(self.get(digest)) if digest else _EMPTY_TREE
+
+    def read_file(self, entry):
+        """The contents of a file from its listing entry"""
+        if len(entry) > 3:
+            return entry[3].encode('utf-8')
+        return b''.join(self.get(digest) for digest in entry[2])
+
+    # Taking snapshots
+    def _store_file(self, path, stats):
+        """Chunk a data file into the repository; returns its listing entry, or None if it is gone"""
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            stat = os.fstat(f.fileno())
+            # Leave out a record being appended right now
+            remaining = complete_length(f, stat.st_size)
+            f.seek(0)
+            if remaining < INLINE_SIZE:
+                data = f.read(remaining)
+                with contextlib.suppress(UnicodeDecodeError):
+                    text = data.decode('utf-8')
+                    stats['read'] += len(data)
+                    return [stat.st_size, stat.st_mtime_ns, [], text]
+                f.seek(0)
+            chunks = []
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                chunks.append(self.put(data, stats))
+                remaining -= len(data)
+                stats['read'] += len(data)
+        return [stat.st_size, stat.st_mtime_ns, chunks]
+
+    def _snapshot_directory(self, path, previous, stats, root_files=None):
+        """
+        Store the listing of a directory (recursively); previous is its listing
+        digest in the last snapshot. In the data root, only root_files and the
+        user directories are kept
+        """
+        top = root_files is not None
+        previous = self.read_tree(previous)
+        files, dirs = {}, {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name = entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if (name == USER_DATA_DIR or not top) and not name.startswith('.'):
+                        dirs[name] = self._snapshot_directory(entry.path, previous['dirs'].get(name), stats)
+                elif _wanted(name, root_files) and entry.is_file(follow_symlinks=False):
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    known = previous['files'].get(name)
+                    if known is None or known[0] != stat.st_size or known[1] != stat.st_mtime_ns:
+                        known = self._store_file(entry.path, stats)
+                        if known is None:
+                            continue
+                    files[name] = known
+                    stats['files'] += 1
+        return self.put(_encode_tree(files, dirs), stats)
+
+    def _write_manifest(self, tree, mobile, label, stats, started, flat=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        manifest = {
+            'id': now.strftime('%Y%m%dT%H%M%S%fZ'),
+            'created': now.isoformat(timespec='seconds'),
+            'tree': tree,
+            'mobile': mobile,
+            'label': label,
+            # Safe mobile -> names of the user's files kept in the flat layout
+            'flat': flat or {},
+            'stats': dict(stats, seconds=round(time.perf_counter() - started, 3)),
+        }
+        _sync()
+        replace_file(os.path.join(self.manifests, manifest['id'] + '.json'), json.dumps(manifest).encode('utf-8'))
+        return manifest
+
+    def take(self, root, label=''):
+        """Snapshot a whole data root, reading only the files changed since the last full snapshot"""
+        started = time.perf_counter()
+        stats = {'files': 0, 'read': 0, 'objects': 0, 'stored': 0}
+        with self._lock():
+            previous = next((m for m in reversed(self.list()) if m['mobile'] is None), None)
+            flat = CSVStorage(root).flat_files()
+            root_files = {USERS_FILE, PASSWORD_UPDATES_FILE, RATES_FILENAME}
+            root_files.update(get_user_filename(mobile, name) for mobile, names in flat.items() for name in names)
+            tree = self._snapshot_directory(root, previous and previous['tree'], stats, root_files)
+            return self._write_manifest(tree, None, label, stats, started, flat)
+
+    def take_user(self, store, mobile, label=''):
+        """Snapshot one user's files of a CSVStorage, e.g. before a destructive change"""
+        started = time.perf_counter()
+        stats = {'files': 0, 'read': 0, 'objects': 0, 'stored': 0}
+        with self._lock():
+            files = {}
+            directory = store.user_directory(mobile)
+            for name in store.user_files(mobile):
+                entry = self._store_file(os.path.join(directory, name), stats)
+                if entry is not None:
+                    files[name] = entry
+                    stats['files'] += 1
+            tree = self.put(_encode_tree(files, {}), stats)
+            # Nest the user's listing at its place in the data root
+            for name in reversed(user_shard(mobile).split(os.sep)):
+                tree = self.put(_encode_tree({}, {name: tree}), stats)
+            return self._write_manifest(tree, safe_mobile(mobile), label, stats, started)
+
+    # Reading snapshots
+    def list(self, mobile=None):
+        """Manifests of every snapshot, oldest first; with mobile, only those holding files of that user"""
+        manifests = []
+        for name in sorted(os.listdir(self.manifests)):
+            if name.endswith('.json'):
+                with open(os.path.join(self.manifests, name), 'rb') as f:
+                    manifests.append(json.load(f))
+        if mobile is not None:
+            manifests = [manifest for manifest in manifests if self.user_entries(manifest, mobile)]
+        return manifests
+
+    def manifest(self, snapshot_id):
+        """The manifest of one snapshot; raises ValueError for an unknown id"""
+        try:
+            with open(os.path.join(self.manifests, os.path.basename(snapshot_id) + '.json'), 'rb') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"No snapshot {snapshot_id!r}") from None
+
+    def user_entries(self, manifest, mobile):
+        """{name in the user's directory: listing entry} of a user's files in a snapshot (empty if none)"""
+        root = self.read_tree(manifest['tree'])
+        entries = {}
+        # Files of users not yet moved into their directory are in the root
+        for name in manifest.get('flat', {}).get(safe_mobile(mobile), ()):
+            entry = root['files'].get(get_user_filename(mobile, name))
+            if entry is not None:
+                entries[name] = entry
+        tree = root
+        for name in user_shard(mobile).split(os.sep):
+            tree = self.read_tree(tree['dirs'].get(name)) if name in tree['dirs'] else _EMPTY_TREE
+        entries.update(tree['files'])
+        return entries
+
+    # Restoring
+    def restore_user(self, store, snapshot_id, mobile):
+        """
+        Put a user's files of a CSVStorage back as they were in a snapshot;
+        the user's current files are snapshotted first, so a restore can be
+        undone the same way. Returns the restored file names
+        """
+        with self._lock():
+            entries = self.user_entries(self.manifest(snapshot_id), mobile)
+            if not entries:
+                raise ValueError(f"Snapshot {snapshot_id} has no files of {mobile}")
+            files = {name: self.read_file(entry) for name, entry in entries.items()}
+            self.take_user(store, mobile, label=f"before restoring {snapshot_id}")
+        store.replace_user_files(mobile, files)
+        return sorted(files)
+
+    def extract(self, snapshot_id, target):
+        """Write out a whole snapshot as a data root in target (a new or empty directory); returns the file count"""
+        if os.path.exists(target) and os.listdir(target):
+            raise ValueError(f"{target} is not empty")
+        with self._lock():
+            count = self._extract_tree(self.manifest(snapshot_id)['tree'], target)
+        _sync()
+        return count
+
+    def _extract_tree(self, digest, directory):
+        tree = self.read_tree(digest)
+        os.makedirs(directory, exist_ok=True)
+        for name, entry in tree['files'].items():
+            replace_file(os.path.join(directory, name), self.read_file(entry), durable=False)
+        return len(tree['files']) + sum(
+            self._extract_tree(child, os.path.join(directory, name)) for name, child in tree['dirs'].items()
+        )
+
+    # Pruning
+    def prune(self, keep):
+        """
+        Remove all but the newest keep full snapshots, and user snapshots
+        older than all of those, then the objects only they used
+        Returns the number of snapshots and of objects removed
+        """
+        if keep < 1:
+            raise ValueError("At least one snapshot must be kept")
+        with self._lock():
+            manifests = self.list()
+            full = [manifest['id'] for manifest in manifests if manifest['mobile'] is None]
+            # With no full snapshot yet, every user snapshot is kept
+            oldest = full[-keep:][0] if full else ''
+            dropped = [manifest for manifest in manifests if manifest['id'] < oldest]
+            for manifest in dropped:
+                os.remove(os.path.join(self.manifests, manifest['id'] + '.json'))
+            fsync_directory(self.manifests)
+            if not dropped:
+                return 0, 0
+
+            live = set()
+            # Manifests are in id order, so the dropped ones are the first
+            pending = [manifest['tree'] for manifest in manifests[len(dropped):]]
+            while pending:
+                digest = pending.pop()
+                if digest in live:
+                    continue
+                live.add(digest)
+                tree = self.read_tree(digest)
+                pending.extend(tree['dirs'].values())
+                for entry in tree['files'].values():
+                    live.update(entry[2])
+
+            removed = 0
+            for prefix in os.listdir(self.objects):
+                directory = os.path.join(self.objects, prefix)
+                for name in os.listdir(directory):
+                    if prefix + name not in live:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(os.path.join(directory, name))
+                        removed += 1
+            return len(dropped), removed
+
+
+def open_repository(root=None, path=None):
+    """The snapshot repository of a data root (default: $EXPENSE_DATA_DIR)"""
+    root = root or os.environ.get('EXPENSE_DATA_DIR', '.')
+    return SnapshotRepository(path or os.environ.get('EXPENSE_SNAPSHOT_DIR') or os.path.join(root, SNAPSHOT_DIR))
+
+
+def _describe(manifest):
+    stats = manifest['stats']
+    scope = f"user {manifest['mobile']}" if manifest['mobile'] else "full"
+    label = f" - {manifest['label']}" if manifest['label'] else ""
+    return (f"{manifest['id']}  {scope:18} {stats['files']:>9,} files {stats['read']:>13,} bytes read "
+            f"{stats['objects']:>7,} new objects {stats['stored']:>12,} bytes {stats['seconds']:>7.2f}s{label}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home Expense Tracker snapshots")
+    parser.add_argument('--csv-dir', default=os.environ.get('EXPENSE_DATA_DIR', '.'), help="data root holding users.csv")
+    parser.add_argument('--repository', help=f"snapshot repository (default: {SNAPSHOT_DIR} in the data root)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    take = commands.add_parser('take', help="snapshot the whole data root")
+    take.add_argument('--every', type=float, help="keep taking a snapshot every this many seconds")
+    take.add_argument('--keep', type=int, help="then prune all but the newest this many snapshots")
+    take.add_argument('--label', default='')
+    listing = commands.add_parser('list', help="show the snapshots")
+    listing.add_argument('--mobile', help="only snapshots holding files of this user")
+    restore = commands.add_parser('restore', help="put a user's files back as they were in a snapshot")
+    restore.add_argument('snapshot')
+    restore.add_argument('--mobile', required=True)
+    extract = commands.add_parser('extract', help="write out a whole snapshot as a data root")
+    extract.add_argument('snapshot')
+    extract.add_argument('--to', required=True, help="new or empty directory")
+    prune = commands.add_parser('prune', help="remove old snapshots and the data only they used")
+    prune.add_argument('--keep', type=int, required=True, help="number of newest snapshots to keep")
+    args = parser.parse_args(argv)
+
+    repository = open_repository(args.csv_dir, args.repository)
+    if args.command == 'take':
+        while True:
+            started = time.monotonic()
+            print(_describe(repository.take(args.csv_dir, args.label)), flush=True)
+            if args.keep is not None:
+                repository.prune(args.keep)
+            if args.every is None:
+                break
+            time.sleep(max(args.every - (time.monotonic() - started), 0))
+    elif args.command == 'list':
+        for manifest in repository.list(args.mobile):
+            print(_describe(manifest))
+    elif args.command == 'restore':
+        names = repository.restore_user(CSVStorage(args.csv_dir), args.snapshot, args.mobile)
+        print(f"Restored {len(names)} files of {args.mobile}: {', '.join(names)}")
+    elif args.command == 'extract':
+        count = repository.extract(args.snapshot, args.to)
+        print(f"Wrote {count} files to {args.to}")
+    elif args.command == 'prune':
+        snapshots, objects = repository.prune(args.keep)
+        print(f"Removed {snapshots} snapshots and {objects} objects")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1615 @@
+"""
+Storage backends for the Home Expense Tracker
+
+Two interchangeable implementations of the same interface:
+- CSVStorage: users.csv plus one directory per user, sharded by a hash of
+  the mobile number (data/ab/cd/<mobile>/), holding the salary file and one
+  expense file per month
+- SQLiteStorage: a single indexed SQLite database
+
+Expenses are grouped by year-month period ("YYYY-MM"), so views of one month
+only read that month's data. Each expense keeps the currency it was paid in;
+summaries are converted to the base currency (see currency.py).
+
+Choose one with the EXPENSE_STORAGE environment variable ("csv" or "sqlite");
+EXPENSE_DATA_DIR sets the data root of the CSV backend (default: the current
+directory) and EXPENSE_DB the database path for the SQLite backend.
+
+Move existing CSV data into SQLite with:
+    python storage.py migrate --db expenses.db
+
+Deleted CSV expenses are compacted automatically; to force it for every user:
+    python storage.py compact
+
+Files of the older flat layout (<mobile>_expenses_2024-01.csv next to
+users.csv) move into the user's directory when the user is first read; to
+move everyone's at once, safely while the app is running:
+    python storage.py shard --csv-dir .
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import queue
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from accounts import (
+    DEFAULT_DB_FILE, PASSWORD_UPDATES_FILE, USER_COLUMNS, USERS_FILE, USERS_SCHEMA, SQLiteUsers, UserDirectory
+)
+from csvfiles import append_csv_data, append_csv_row, complete_length, file_lock, fsync_directory, replace_file
+from currency import get_rates, in_base_currency, unconverted_counts
+from instrumentation import count_read
+from schema import (
+    AMOUNT_SCALE, BASE_CURRENCY, CSV_DTYPES, apply_expense_schema, day_key, empty_expenses, format_amounts,
+    format_minor, from_minor, period_bounds, period_key, shift_period, to_minor, validate_category
+)
+from salary import SalaryTimeline
+from search import NoteIndex, tokenize
+from summary import ExpenseSummary, rollup
+
+# Parent of the user directories, within the data root
+USER_DATA_DIR = "data"
+
+# File paths, within a user's directory
+SALARY_FILE = "monthly_salary.csv"
+PERIOD_EXPENSES_FILE = "expenses_{period}.csv"
+PERIOD_DELETED_FILE = "expenses_{period}_deleted.csv"
+# Single-file expense ledger (and its tombstones) from before the monthly layout
+EXPENSES_FILE = "expenses.csv"
+DELETED_FILE = "expenses_deleted.csv"
+# Held while a user's files move in from the flat layout
+MOVE_LOCK = ".move"
+
+# Column layout of the data files
+SALARY_COLUMNS = ['salary', 'date']
+# Expense files from before expenses had a currency lack the Currency column;
+# they read as BASE_CURRENCY and gain the column on their next write
+EXPENSE_COLUMNS = ['ID', 'Date', 'Category', 'Amount', 'Note', 'Currency']
+DELETED_COLUMNS = ['ID']
+
+# Deleted expenses are only recorded as tombstones until they make up this
+# share of the expense file (and there are at least COMPACTION_MIN_DELETED
+# of them); the file is then rewritten without them in the background
+COMPACTION_RATIO = 0.25
+COMPACTION_MIN_DELETED = 50
+
+# Matches the per-period expense files in a user's directory: (period)
+_PERIOD_FILE_PATTERN = re.compile(r'expenses_(\d{4}-\d{2})\.csv')
+
+
+def new_expense_id():
+    """Return a new stable expense ID"""
+    return uuid.uuid4().hex[:16]
+
+
+def new_expense_ids(count):
+    """Return count new expense IDs (same format as new_expense_id) as a list"""
+    values = np.frombuffer(os.urandom(8 * count), dtype=np.uint64)
+    return pd.Series(values).map('{:016x}'.format).tolist()
+
+
+def safe_mobile(mobile):
+    """Mobile number without the characters that do not belong in file names"""
+    return mobile.replace('+', '').replace(' ', '')
+
+
+def get_user_filename(mobile, filename):
+    """User-specific filename of the flat layout ("<mobile>_<filename>")"""
+    return f"{safe_mobile(mobile)}_{filename}"
+
+
+def split_flat_name(name, mobiles):
+    """
+    (safe mobile, name in the user's directory) of a file of the flat layout,
+    or None if it is not one; mobiles are the safe_mobile() of the registered
+    users. A mobile may itself contain "_", so the longest registered prefix wins
+    """
+    if name.endswith('.lock'):
+        return None
+    position = len(name)
+    while position > 0:
+        position = name.rfind('_', 0, position)
+        if position > 0 and position + 1 < len(name) and name[:position] in mobiles:
+            return name[:position], name[position + 1:]
+    return None
+
+
+def user_shard(mobile):
+    """
+    Directory of a user's files relative to the data root: data/ab/cd/<mobile>,
+    where ab/cd start the SHA-1 of the mobile number, so no directory holds
+    more than a few hundred entries however many users there are
+    """
+    name = safe_mobile(mobile)
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return os.path.join(USER_DATA_DIR, digest[:2], digest[2:4], name)
+
+# ============================================
+# CSV FILE HELPERS
+# ============================================
+
+def read_csv_file(filename, columns, dtype=None):
+    """
+    Read a CSV file written by append_csv_row
+    A record torn by a crash in the middle of an append is ignored
+    """
+    if not os.path.exists(filename):
+        return pd.DataFrame(columns=columns)
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return pd.DataFrame(columns=columns)
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            count_read(size)
+            return pd.read_csv(filename, dtype=dtype)
+        # Last record is incomplete - only parse the complete lines
+        valid = complete_length(f, size)
+        f.seek(0)
+        data = f.read(valid)
+    count_read(len(data))
+    if not data:
+        return pd.DataFrame(columns=columns)
+    return pd.read_csv(io.BytesIO(data), dtype=dtype)
+
+class _CompleteLines(io.RawIOBase):
+    """Read-only view of an open file that stops after its last complete line"""
+
+    def __init__(self, f, limit):
+        self._f = f
+        self._remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        data = self._f.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+def iter_csv_chunks(filename, columns, chunk_size, dtype=None):
+    """Read a CSV file written by append_csv_row in DataFrames of chunk_size rows"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        valid = complete_length(f, os.fstat(f.fileno()).st_size)
+        if valid == 0:
+            return
+        count_read(valid)
+        f.seek(0)
+        reader = io.BufferedReader(_CompleteLines(f, valid))
+        yield from pd.read_csv(reader, chunksize=chunk_size, dtype=dtype)
+
+def rewrite_csv_file(filename, df):
+    """
+    Replace a CSV file with the contents of df
+    The data is written to a temporary file which is then renamed over the
+    original, so readers never see a half-written file; the caller must hold
+    file_lock(filename)
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            df.to_csv(f, index=False, lineterminator='\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_name)
+        raise
+    fsync_directory(directory)
+
+# ============================================
+# PARSED FILE CACHE
+# ============================================
+
+def _file_signature(filename):
+    """Return (mtime, size) of a file, or None when it does not exist"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+class FileCache:
+    """
+    Parsed CSV files shared by every rerun and session of this process
+    An entry is reused while the file's mtime/size and its write version are
+    unchanged; writers call bump() so that changes landing within the same
+    mtime tick are never missed
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._versions = {}
+
+    def version(self, filename):
+        """Return the write version of a file"""
+        with self._lock:
+            return self._versions.get(filename, 0)
+
+    def bump(self, filename):
+        """Invalidate the cached copy of a file after writing to it"""
+        with self._lock:
+            self._versions[filename] = self._versions.get(filename, 0) + 1
+            self._entries.pop(filename, None)
+
+    def get(self, filename, loader, related=()):
+        """
+        Return the cached frame for a file, parsing it with loader() if stale
+        Changes to any of the related files also invalidate the entry
+        """
+        signature = tuple(_file_signature(name) for name in (filename,) + tuple(related))
+        with self._lock:
+            version = self._versions.get(filename, 0)
+            entry = self._entries.get(filename)
+        if entry is not None and entry[0] == signature and entry[1] == version:
+            return entry[2]
+
+        df = loader()
+        with self._lock:
+            # Keep the entry only if no writer bumped the version meanwhile
+            if self._versions.get(filename, 0) == version:
+                self._entries[filename] = (signature, version, df, {})
+        return df
+
+    def derive(self, filename, df, name, compute):
+        """
+        Return compute(), memoized alongside the cached frame df of a file
+        (e.g. a sort order), so it is recomputed only when the file changes
+        """
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or entry[2] is not df:
+                return compute()
+            derived = entry[3]
+            if name in derived:
+                return derived[name]
+        value = compute()
+        with self._lock:
+            derived[name] = value
+        return value
+
+# ============================================
+# STORAGE INTERFACE
+# ============================================
+
+def expense_filter_mask(df, start=None, end=None, categories=None):
+    """Boolean numpy mask of the rows within [start, end] and categories, or None for no filter"""
+    mask = None
+    if start is not None:
+        mask = (df['Date'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        upto = (df['Date'] <= pd.Timestamp(end)).to_numpy()
+        mask = upto if mask is None else mask & upto
+    if categories is not None:
+        chosen = df['Category'].isin(list(categories)).to_numpy()
+        mask = chosen if mask is None else mask & chosen
+    return mask
+
+def with_currency(df):
+    """An expense frame to be written, with every Currency normalized and convertible (see currency.py)"""
+    if 'Currency' not in df.columns:
+        return df.assign(Currency=BASE_CURRENCY)
+    rates = get_rates()
+    codes = {code: rates.validate(code) for code in df['Currency'].unique()}
+    return df.assign(Currency=df['Currency'].map(codes))
+
+def in_id_order(df, ids):
+    """The rows of df with the given IDs, in the order of ids (missing IDs are skipped)"""
+    positions = pd.Series(range(len(df)), index=df['ID'].to_numpy()).reindex(ids).dropna()
+    return df.iloc[positions.astype('int64').to_numpy()]
+
+class Storage:
+    """
+    Interface shared by every storage backend
+    Expenses are grouped by year-month period ("YYYY-MM"). Backends keep a
+    materialized ExpenseSummary per user and period, tagged with the
+    backend's expenses_version() token for that period and updated in place
+    by the write methods; when the token no longer matches (e.g. another
+    process wrote to the ledger, or the exchange rates changed) it is rebuilt
+    on the next request. The NoteIndex of each period behind
+    search_expenses() is kept the same way
+    """
+
+    def __init__(self):
+        self._summary_lock = threading.Lock()
+        self._summaries = {}
+        self._index_lock = threading.Lock()
+        self._note_indexes = {}
+
+    # Users (self.users is the backend's user store, see accounts.py)
+    def get_user(self, mobile):
+        """Return the user record (dict) for a mobile number, or None"""
+        return self.users.get(mobile)
+
+    def add_user(self, record):
+        """Register a user record; returns False if the mobile is taken"""
+        return self.users.add(record)
+
+    def update_password(self, mobile, old_password, new_password):
+        """Replace a user's password hash if it still equals old_password; returns success"""
+        return self.users.update_password(mobile, old_password, new_password)
+
+    def list_users(self):
+        """Return a list of all user records"""
+        return self.users.records()
+
+    # Salary history
+    def load_salary_history(self, mobile):
+        """Return the salary history as a DataFrame with SALARY_COLUMNS"""
+        raise NotImplementedError
+
+    def latest_salary(self, mobile):
+        """Return the most recently saved salary, or 0.0"""
+        df = self.load_salary_history(mobile)
+        if not df.empty:
+            return df.iloc[-1]['salary']
+        return 0.0
+
+    def salary_timeline(self, mobile):
+        """Return the user's SalaryTimeline (see salary.py)"""
+        return SalaryTimeline.from_history(self.load_salary_history(mobile))
+
+    def append_salary(self, mobile, salary, date):
+        """Add an entry to the salary history"""
+        raise NotImplementedError
+
+    # Expenses
+    def load_expenses(self, mobile):
+        """Return all expenses as a DataFrame with EXPENSE_COLUMNS in the layout of schema.py"""
+        raise NotImplementedError
+
+    def query_expenses(self, mobile, start=None, end=None, categories=None, page=0, page_size=50):
+        """
+        Return one page of expenses, newest first, and the number of matching rows
+        start/end (inclusive dates) and categories filter the rows before paging
+        """
+        df = self.load_expenses(mobile)
+        order = self._newest_first(mobile, df)
+        mask = expense_filter_mask(df, start, end, categories)
+        if mask is not None:
+            order = order[mask[order]]
+        rows = order[page * page_size:(page + 1) * page_size]
+        return df.iloc[rows], len(order)
+
+    def search_expenses(self, mobile, text, start=None, end=None, categories=None, page=0, page_size=50):
+        """
+        query_expenses() limited to the expenses whose note has a word starting
+        with every word of text ("groc sh" finds "Grocery shop")
+        Matching, filtering and counting run on the per-period note indexes, so
+        only the rows of the returned page are read
+        """
+        if not tokenize(text):
+            return self.query_expenses(mobile, start, end, categories, page, page_size)
+        skip, wanted, total, page_ids = page * page_size, page_size, 0, {}
+        for period in reversed(self._periods_within(mobile, start, end)):
+            # A period entirely inside [start, end] needs no date filter, and
+            # without any filter its matches are counted without a scan
+            first, last = period_bounds(period)
+            within = (
+                None if start is None or pd.Timestamp(start) <= first else start,
+                None if end is None or pd.Timestamp(end) >= last else end,
+            )
+            count, ids = self.note_matches(mobile, period, text, *within, categories, limit=skip + wanted)
+            total += count
+            if ids[skip:]:
+                page_ids[period] = ids[skip:]
+                wanted -= len(page_ids[period])
+            skip = max(0, skip - count)
+        return self.expenses_by_id(mobile, page_ids), total
+
+    def expenses_by_id(self, mobile, ids_by_period):
+        """
+        The expenses with the given IDs ({period: [ID, ...]}), in the order
+        of the periods and of their ID lists
+        """
+        frames = []
+        for period, ids in ids_by_period.items():
+            first, last = period_bounds(period)
+            chunks = [chunk[chunk['ID'].isin(ids)] for chunk in self.iter_expense_chunks(mobile, first, last)]
+            frames.append(in_id_order(pd.concat(chunks) if chunks else empty_expenses(), ids))
+        return pd.concat(frames) if frames else empty_expenses()
+
+    def iter_expense_chunks(self, mobile, start=None, end=None, chunk_size=50_000):
+        """
+        Yield the user's expenses (optionally within [start, end]) as
+        DataFrames of at most chunk_size rows, reading the stored data
+        incrementally rather than loading it all
+        """
+        raise NotImplementedError
+
+    def _periods_within(self, mobile, start=None, end=None):
+        """The user's periods that overlap [start, end]"""
+        periods = self.expense_periods(mobile)
+        if start is not None:
+            periods = [period for period in periods if period >= period_key(start)]
+        if end is not None:
+            periods = [period for period in periods if period <= period_key(end)]
+        return periods
+
+    def _newest_first(self, mobile, df):
+        """Row positions of df ordered by date, newest (and latest added) first"""
+        return df['Date'].to_numpy().argsort(kind='stable')[::-1]
+
+    def append_expense(self, mobile, date, category, amount, note, currency=BASE_CURRENCY):
+        """
+        Add one expense (amount in units of currency, category one of
+        schema.CATEGORIES); returns its ID
+        The currency must have an exchange rate (see currency.py)
+        """
+        raise NotImplementedError
+
+    def append_expenses(self, mobile, df):
+        """
+        Add a typed expense frame (Date, Category, Amount, Note and optionally
+        Currency as in schema.py) with one write per period; returns the new
+        IDs in row order
+        """
+        raise NotImplementedError
+
+    def delete_expense(self, mobile, expense_id):
+        """Delete the expense with the given ID; returns success"""
+        raise NotImplementedError
+
+    def clear_expenses(self, mobile):
+        """Delete every expense of a user; returns True if there was anything to delete"""
+        raise NotImplementedError
+
+    def total_expenses(self, mobile, periods=None):
+        """Return the sum of the expense amounts in periods (default: all), in base-currency minor units"""
+        return self.summary(mobile, periods)['total']
+
+    def expense_periods(self, mobile):
+        """Return the sorted list of periods ("YYYY-MM") that hold expenses"""
+        raise NotImplementedError
+
+    # Summary
+    def expenses_version(self, mobile, period):
+        """Return a token that changes whenever the user's expenses in a period change"""
+        raise NotImplementedError
+
+    def build_summary(self, mobile, period):
+        """Compute the ExpenseSummary of a user's period from scratch"""
+        first, last = period_bounds(period)
+        chunks = list(self.iter_expense_chunks(mobile, first, last))
+        return ExpenseSummary.from_frame(pd.concat(chunks, ignore_index=True) if chunks else empty_expenses())
+
+    def _summary_token(self, mobile, period):
+        """A summary holds converted amounts, so it is current for one version of the expenses and of the rates"""
+        return self.expenses_version(mobile, period), get_rates().version
+
+    def period_summary(self, mobile, period):
+        """Return a copy of the (cached) ExpenseSummary of one period"""
+        token = self._summary_token(mobile, period)
+        with self._summary_lock:
+            entry = self._summaries.get((mobile, period))
+            if entry is not None and entry[0] == token:
+                return entry[1].copy()
+
+        summary = self.build_summary(mobile, period)
+        with self._summary_lock:
+            self._summaries[(mobile, period)] = (token, summary)
+            return summary.copy()
+
+    def summary(self, mobile, periods=None):
+        """Return the summary figures over periods (default: all) (see ExpenseSummary.snapshot)"""
+        merged = ExpenseSummary()
+        for period in self.expense_periods(mobile) if periods is None else periods:
+            merged.merge(self.period_summary(mobile, period))
+        return merged.snapshot()
+
+    def trend(self, mobile, periods, grain='day'):
+        """Spend per category over periods at a time grain, rolled up from the summary cube (see summary.rollup)"""
+        merged = ExpenseSummary()
+        for period in periods:
+            merged.merge(self.period_summary(mobile, period))
+        return rollup(merged.day_category_totals, grain)
+
+    def verify_summary(self, mobile):
+        """Check the incrementally maintained summaries against a full rebuild"""
+        for period in self.expense_periods(mobile):
+            token = self._summary_token(mobile, period)
+            rebuilt = self.build_summary(mobile, period)
+            with self._summary_lock:
+                entry = self._summaries.get((mobile, period))
+                if entry is not None and entry[0] == token and not entry[1].matches(rebuilt):
+                    return False
+        return True
+
+    def _update_summary(self, mobile, period, before, after, change):
+        """
+        Apply change(summary) to a cached period summary that was current at
+        token before, and tag it with token after; pass after=None when the
+        write cannot vouch for the result and the summary must be rebuilt instead
+        """
+        rates = get_rates().version
+        with self._summary_lock:
+            entry = self._summaries.pop((mobile, period), None)
+            if entry is not None and after is not None and entry[0] == (before, rates):
+                change(entry[1])
+                self._summaries[(mobile, period)] = ((after, rates), entry[1])
+
+    # Note search
+    def build_note_index(self, mobile, period):
+        """Index the notes of a user's period from scratch"""
+        first, last = period_bounds(period)
+        index = NoteIndex()
+        for chunk in self.iter_expense_chunks(mobile, first, last):
+            index.extend(chunk['ID'], chunk['Date'], chunk['Category'], chunk['Note'])
+        return index
+
+    def note_matches(self, mobile, period, text, start=None, end=None, categories=None, limit=None):
+        """Search the notes of a user's period; returns (count, newest IDs) as NoteIndex.search()"""
+        token = self.expenses_version(mobile, period)
+        with self._index_lock:
+            entry = self._note_indexes.get((mobile, period))
+            if entry is not None and entry[0] == token:
+                return entry[1].search(text, start, end, categories, limit)
+
+        index = self.build_note_index(mobile, period)
+        with self._index_lock:
+            self._note_indexes[(mobile, period)] = (token, index)
+            return index.search(text, start, end, categories, limit)
+
+    def _update_note_index(self, mobile, period, before, after, change):
+        """Apply change(index) to a cached note index, like _update_summary()"""
+        with self._index_lock:
+            entry = self._note_indexes.pop((mobile, period), None)
+            if entry is not None and after is not None and entry[0] == before:
+                change(entry[1])
+                self._note_indexes[(mobile, period)] = (after, entry[1])
+
+# ============================================
+# CSV BACKEND
+# ============================================
+
+class CSVStorage(Storage):
+    """
+    users.csv in the data root, and a directory per user (see user_shard())
+    with the salary file and one expense file per period ("expenses_2024-01.csv")
+    Deleting an expense appends its ID to the period's tombstone file which
+    readers filter out; compact_expenses() folds the tombstones back into the
+    expense file once they pass COMPACTION_RATIO. Files of the flat layout
+    ("<mobile>_expenses_2024-01.csv" in the data root) move into the user's
+    directory, and a single-file ledger from before the monthly layout is
+    split into periods, when the user is first read
+    """
+
+    def __init__(self, root='.', users=None):
+        super().__init__()
+        self.root = root
+        self.cache = FileCache()
+        self.users = users or UserDirectory(os.path.join(root, USERS_FILE), os.path.join(root, PASSWORD_UPDATES_FILE))
+        self._ledger_lock = threading.Lock()
+        # filename -> [rows in the expense file, tombstones], when known
+        self._ledger_counts = {}
+        self._sharded = set()
+        self._partitioned = set()
+        # Expense files known to have the Currency column
+        self._upgraded = set()
+        self._compacting = set()
+        # {safe mobile: names of flat layout files} from the one listing of the data root
+        self._listing_lock = threading.Lock()
+        self._listing = None
+
+    def user_directory(self, mobile):
+        """A user's own directory (created by the first write)"""
+        return os.path.join(self.root, user_shard(mobile))
+
+    def user_file(self, mobile, filename):
+        """Path of a user's data file"""
+        self._ensure_sharded(mobile)
+        return os.path.join(self.user_directory(mobile), filename)
+
+    def expense_file(self, mobile, period):
+        """Path of a user's expense file for one period"""
+        return self.user_file(mobile, PERIOD_EXPENSES_FILE.format(period=period))
+
+    def deleted_file(self, mobile, period):
+        """Path of a user's tombstone file for one period"""
+        return self.user_file(mobile, PERIOD_DELETED_FILE.format(period=period))
+
+    def load_salary_history(self, mobile):
+        filename = self.user_file(mobile, SALARY_FILE)
+        return self.cache.get(filename, lambda: read_csv_file(filename, SALARY_COLUMNS))
+
+    def append_salary(self, mobile, salary, date):
+        filename = self.user_file(mobile, SALARY_FILE)
+        os.makedirs(self.user_directory(mobile), exist_ok=True)
+        append_csv_row(filename, SALARY_COLUMNS, [salary, day_key(date)])
+        self.cache.bump(filename)
+
+    def salary_timeline(self, mobile):
+        # Built once per version of the salary file
+        filename = self.user_file(mobile, SALARY_FILE)
+        df = self.load_salary_history(mobile)
+        return self.cache.derive(filename, df, 'timeline', lambda: SalaryTimeline.from_history(df))
+
+    def _ensure_partitioned(self, mobile):
+        """Split a single-file expense ledger from before the monthly layout into periods"""
+        if mobile in self._partitioned:
+            return
+        legacy = self.user_file(mobile, EXPENSES_FILE)
+        legacy_deleted = self.user_file(mobile, DELETED_FILE)
+        if not os.path.exists(legacy):
+            self._partitioned.add(mobile)
+            return
+        with file_lock(legacy), file_lock(legacy_deleted):
+            # Another process may have split it while we waited for the lock
+            if os.path.exists(legacy):
+                # Read as text so that the rows are copied unchanged
+                df = read_csv_file(legacy, EXPENSE_COLUMNS, dtype=str)
+                if 'ID' not in df.columns:
+                    # Written before expenses had IDs
+                    df.insert(0, 'ID', [new_expense_id() for _ in range(len(df))])
+                if 'Currency' not in df.columns:
+                    df['Currency'] = BASE_CURRENCY
+                deleted = read_csv_file(legacy_deleted, DELETED_COLUMNS, dtype=str)['ID']
+                df = df[~df['ID'].isin(deleted)]
+                for period, rows in df.groupby(df['Date'].str[:7]):
+                    filename = self.expense_file(mobile, period)
+                    with file_lock(filename):
+                        # Replaces what a split interrupted by a crash left behind
+                        rewrite_csv_file(filename, rows[EXPENSE_COLUMNS])
+                        self.cache.bump(filename)
+                # Removing the old ledger completes the split
+                os.remove(legacy)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(legacy_deleted)
+        self._partitioned.add(mobile)
+
+    def _ensure_sharded(self, mobile):
+        """Move a user's files of the flat layout into the user's directory"""
+        if mobile in self._sharded:
+            return
+        names = self.flat_files().get(safe_mobile(mobile))
+        if names:
+            self.move_to_shard(mobile, names)
+        self._sharded.add(mobile)
+
+    def move_to_shard(self, mobile, names):
+        """
+        Move the flat layout files of a user (given by their names within the
+        user's directory) into that directory, one rename each
+        Every process moves a user's files under the same lock before using
+        the directory, so this is safe while others are reading and writing
+        Returns the names left in place because the directory already has them
+        """
+        directory = self.user_directory(mobile)
+        os.makedirs(directory, exist_ok=True)
+        conflicts = []
+        with file_lock(os.path.join(directory, MOVE_LOCK)):
+            for name in names:
+                source = os.path.join(self.root, get_user_filename(mobile, name))
+                target = os.path.join(directory, name)
+                with file_lock(source):
+                    if os.path.exists(target) and os.path.exists(source):
+                        conflicts.append(name)
+                        continue
+                    # The source is gone if another process moved it meanwhile
+                    with contextlib.suppress(FileNotFoundError):
+                        os.replace(source, target)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(source + '.lock')
+            fsync_directory(directory)
+            fsync_directory(self.root)
+        with self._listing_lock:
+            if self._listing is not None:
+                if conflicts:
+                    self._listing[safe_mobile(mobile)] = conflicts
+                else:
+                    self._listing.pop(safe_mobile(mobile), None)
+        return conflicts
+
+    def shard_all(self, progress=None):
+        """
+        Move every user's flat layout files into the user directories
+        Returns (number of users moved, {mobile: names left in place})
+        """
+        self._forget_listing()
+        users = sorted(self.flat_files().items())
+        conflicts = {}
+        for count, (mobile, names) in enumerate(users, start=1):
+            left = self.move_to_shard(mobile, names)
+            if left:
+                conflicts[mobile] = left
+            self._sharded.add(mobile)
+            if progress:
+                progress(count, len(users), mobile)
+        return len(users), conflicts
+
+    def _forget_listing(self):
+        with self._listing_lock:
+            self._listing = None
+
+    def flat_files(self):
+        """
+        Safe mobile -> names of the registered users' files still in the flat
+        layout
+        Nothing writes the flat layout any more, so its files only ever leave
+        the data root: the root is listed once, against the users registered
+        then, and move_to_shard() keeps the listing current. Files another
+        process moved meanwhile are simply not found when moved again
+        """
+        with self._listing_lock:
+            if self._listing is None:
+                mobiles = {safe_mobile(user['mobile']) for user in self.users.records()}
+                files = {}
+                with os.scandir(self.root) as entries:
+                    for entry in entries:
+                        owner = split_flat_name(entry.name, mobiles)
+                        if owner:
+                            files.setdefault(owner[0], []).append(owner[1])
+                self._listing = files
+            return self._listing
+
+    def expense_periods(self, mobile):
+        self._ensure_partitioned(mobile)
+        return self._listed_periods(mobile)
+
+    def stored_periods(self, mobile):
+        """
+        expense_periods() without moving or splitting any file, for readers that
+        must not write: None while the user still has files in an older layout
+        """
+        if self.flat_files().get(safe_mobile(mobile)):
+            return None
+        if os.path.exists(os.path.join(self.user_directory(mobile), EXPENSES_FILE)):
+            return None
+        # Nothing left to move, so user_file() and the paths built on it write nothing either
+        self._sharded.add(mobile)
+        return self._listed_periods(mobile)
+
+    def _listed_periods(self, mobile):
+        # A user's directory holds a few files per month, cheap enough to list on every call
+        try:
+            names = os.listdir(self.user_directory(mobile))
+        except FileNotFoundError:
+            return []
+        return sorted(match.group(1) for match in map(_PERIOD_FILE_PATTERN.fullmatch, names) if match)
+
+    def _read_partition(self, mobile, period):
+        """Parse one period's expense file, leaving out rows with a tombstone"""
+        filename = self.expense_file(mobile, period)
+        # Tombstones first: a compaction in between then only leaves extra tombstones
+        deleted = read_csv_file(self.deleted_file(mobile, period), DELETED_COLUMNS, dtype=str)['ID']
+        df = read_csv_file(filename, EXPENSE_COLUMNS, dtype=CSV_DTYPES)
+        with self._ledger_lock:
+            self._ledger_counts[filename] = [len(df), len(deleted)]
+        if len(deleted):
+            df = df[~df['ID'].isin(deleted)].reset_index(drop=True)
+        return apply_expense_schema(df)
+
+    def load_partition(self, mobile, period):
+        """
+        Return the expenses of one period
+        The frame is shared through the file cache, so callers must not modify it in place
+        """
+        filename = self.expense_file(mobile, period)
+        return self.cache.get(
+            filename, lambda: self._read_partition(mobile, period), related=(self.deleted_file(mobile, period),)
+        )
+
+    def load_expenses(self, mobile):
+        frames = [self.load_partition(mobile, period) for period in self.expense_periods(mobile)]
+        return pd.concat(frames, ignore_index=True) if frames else empty_expenses()
+
+    def query_expenses(self, mobile, start=None, end=None, categories=None, page=0, page_size=50):
+        # Periods are walked newest first. One that lies entirely inside
+        # [start, end] is counted from its summary, so its file is only read
+        # when the page actually shows some of its rows
+        skip, wanted, total, frames = page * page_size, page_size, 0, []
+        for period in reversed(self._periods_within(mobile, start, end)):
+            first, last = period_bounds(period)
+            inside = (start is None or pd.Timestamp(start) <= first) and (end is None or pd.Timestamp(end) >= last)
+            if inside and (skip > 0 or wanted == 0):
+                figures = self.period_summary(mobile, period)
+                if categories is None:
+                    matching = figures.count
+                else:
+                    matching = sum(figures.category_counts.get(category, 0) for category in categories)
+                if wanted == 0 or skip >= matching:
+                    total += matching
+                    skip -= matching if wanted else 0
+                    continue
+
+            filename = self.expense_file(mobile, period)
+            df = self.load_partition(mobile, period)
+            # Sorted once per version of the file rather than on every page request
+            order = self.cache.derive(filename, df, 'newest_first', lambda: self._newest_first(mobile, df))
+            mask = expense_filter_mask(df, start, end, categories)
+            if mask is not None:
+                order = order[mask[order]]
+            rows = order[skip:skip + wanted]
+            total += len(order)
+            skip = max(0, skip - len(order))
+            wanted -= len(rows)
+            if len(rows):
+                frames.append(df.iloc[rows])
+        return (pd.concat(frames) if frames else empty_expenses()), total
+
+    def iter_expense_chunks(self, mobile, start=None, end=None, chunk_size=50_000):
+        for period in self._periods_within(mobile, start, end):
+            # Tombstones are bounded by compaction, so holding them in memory is fine
+            deleted = read_csv_file(self.deleted_file(mobile, period), DELETED_COLUMNS, dtype=str)['ID']
+            for chunk in iter_csv_chunks(self.expense_file(mobile, period), EXPENSE_COLUMNS, chunk_size, dtype=CSV_DTYPES):
+                chunk = apply_expense_schema(chunk)
+                mask = expense_filter_mask(chunk, start, end)
+                if len(deleted):
+                    alive = ~chunk['ID'].isin(deleted).to_numpy()
+                    mask = alive if mask is None else mask & alive
+                if mask is not None:
+                    chunk = chunk[mask]
+                if len(chunk):
+                    yield chunk
+
+    def expenses_version(self, mobile, period):
+        filename = self.expense_file(mobile, period)
+        return (
+            _file_signature(filename),
+            _file_signature(self.deleted_file(mobile, period)),
+            self.cache.version(filename)
+        )
+
+    def partition_signature(self, mobile, period):
+        """(mtime, size) of a period's expense and tombstone files; stable across processes, unlike expenses_version()"""
+        return _file_signature(self.expense_file(mobile, period)), _file_signature(self.deleted_file(mobile, period))
+
+    def build_summary(self, mobile, period):
+        return ExpenseSummary.from_frame(self.load_partition(mobile, period))
+
+    def build_note_index(self, mobile, period):
+        return NoteIndex.from_frame(self.load_partition(mobile, period))
+
+    def expenses_by_id(self, mobile, ids_by_period):
+        frames = []
+        for period, ids in ids_by_period.items():
+            filename = self.expense_file(mobile, period)
+            df = self.load_partition(mobile, period)
+            positions = self.cache.derive(filename, df, 'id_positions', lambda: dict(zip(df['ID'], range(len(df)))))
+            frames.append(df.iloc[[positions[expense_id] for expense_id in ids if expense_id in positions]])
+        return pd.concat(frames) if frames else empty_expenses()
+
+    @staticmethod
+    def _appended_exactly(before, after, offsets):
+        """True if a file went from signature before to after through exactly one write at offsets"""
+        start, end = offsets
+        return (before[1] if before is not None else 0) == start and after is not None and after[1] == end
+
+    def _upgrade_layout(self, mobile, period):
+        """Add the Currency column to an expense file written before expenses had a currency"""
+        filename = self.expense_file(mobile, period)
+        with self._ledger_lock:
+            if filename in self._upgraded:
+                return
+        with file_lock(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    header = f.readline().decode('utf-8').rstrip('\r\n').split(',')
+            except FileNotFoundError:
+                header = EXPENSE_COLUMNS
+            if 'Currency' not in header:
+                before = self.expenses_version(mobile, period)
+                # Read as text so that the rows are copied unchanged
+                df = read_csv_file(filename, EXPENSE_COLUMNS, dtype=str)
+                rewrite_csv_file(filename, df.assign(Currency=BASE_CURRENCY)[EXPENSE_COLUMNS])
+                self.cache.bump(filename)
+                after = self.expenses_version(mobile, period)
+                # Same expenses, new file: carry the summary over unchanged
+                self._update_summary(mobile, period, before, after, lambda summary: None)
+                self._update_note_index(mobile, period, before, after, lambda index: None)
+        with self._ledger_lock:
+            self._upgraded.add(filename)
+
+    def append_expense(self, mobile, date, category, amount, note, currency=BASE_CURRENCY):
+        category, minor = validate_category(category), to_minor(amount)
+        rates = get_rates()
+        currency = rates.validate(currency)
+        base = rates.minor_to_base(minor, currency, date)
+        period = period_key(date)
+        self._ensure_partitioned(mobile)
+        os.makedirs(self.user_directory(mobile), exist_ok=True)
+        self._upgrade_layout(mobile, period)
+        filename = self.expense_file(mobile, period)
+        expense_id = new_expense_id()
+        before = self.expenses_version(mobile, period)
+        offsets = append_csv_row(
+            filename, EXPENSE_COLUMNS, [expense_id, day_key(date), category, format_minor(minor), note, currency]
+        )
+        self.cache.bump(filename)
+        after = self.expenses_version(mobile, period)
+        with self._ledger_lock:
+            if filename in self._ledger_counts:
+                self._ledger_counts[filename][0] += 1
+
+        # The write extended exactly the file the summary was built from
+        if not (self._appended_exactly(before[0], after[0], offsets) and before[1] == after[1]):
+            after = None
+        self._update_summary(mobile, period, before, after, lambda summary: summary.add(date, category, base))
+        self._update_note_index(
+            mobile, period, before, after, lambda index: index.add(expense_id, date, category, note)
+        )
+        return expense_id
+
+    def append_expenses(self, mobile, df):
+        ids = new_expense_ids(len(df))
+        if not ids:
+            return ids
+        self._ensure_partitioned(mobile)
+        os.makedirs(self.user_directory(mobile), exist_ok=True)
+        df = with_currency(df.reset_index(drop=True))
+        records = pd.DataFrame({
+            'ID': ids,
+            'Date': df['Date'].dt.strftime('%Y-%m-%d'),
+            'Category': df['Category'].astype(str),
+            'Amount': format_amounts(df['Amount']),
+            'Note': df['Note'],
+            'Currency': df['Currency'],
+        }, index=df.index)
+        for period, batch in records.groupby(records['Date'].str[:7], sort=True):
+            self._upgrade_layout(mobile, period)
+            filename = self.expense_file(mobile, period)
+            data = batch.to_csv(index=False, header=False, lineterminator='\n').encode('utf-8')
+            before = self.expenses_version(mobile, period)
+            offsets = append_csv_data(filename, EXPENSE_COLUMNS, data)
+            self.cache.bump(filename)
+            after = self.expenses_version(mobile, period)
+            with self._ledger_lock:
+                if filename in self._ledger_counts:
+                    self._ledger_counts[filename][0] += len(batch)
+
+            if not (self._appended_exactly(before[0], after[0], offsets) and before[1] == after[1]):
+                after = None
+            added = ExpenseSummary.from_frame(df.loc[batch.index])
+            self._update_summary(mobile, period, before, after, lambda summary: summary.merge(added))
+            self._update_note_index(
+                mobile, period, before, after,
+                lambda index: index.extend(batch['ID'], batch['Date'], batch['Category'], batch['Note'])
+            )
+        return ids
+
+    def delete_expense(self, mobile, expense_id):
+        # Recent periods first - that is where most deletes happen
+        for period in reversed(self.expense_periods(mobile)):
+            if self._delete_from_period(mobile, period, str(expense_id)):
+                return True
+        return False
+
+    def _delete_from_period(self, mobile, period, expense_id):
+        filename = self.expense_file(mobile, period)
+        deleted_filename = self.deleted_file(mobile, period)
+        # Holding the expense file lock keeps two deletes of the same expense
+        # (and compaction) from interleaving
+        with file_lock(filename):
+            df = self.load_partition(mobile, period)
+            match = df.index[df['ID'].to_numpy() == expense_id]
+            if len(match) == 0:
+                return False
+            removed = df.loc[match[0]]
+            before = self.expenses_version(mobile, period)
+            offsets = append_csv_row(deleted_filename, DELETED_COLUMNS, [removed['ID']])
+            self.cache.bump(filename)
+            after = self.expenses_version(mobile, period)
+        rates = get_rates()
+        if not (self._appended_exactly(before[1], after[1], offsets) and before[0] == after[0]):
+            after = None
+        elif not rates.convertible([removed['Currency']])[0]:
+            # Not in the summary's figures; a rebuild updates its unconverted counts
+            after = None
+        self._update_summary(
+            mobile, period, before, after,
+            lambda summary: summary.remove(
+                removed['Date'], removed['Category'],
+                rates.minor_to_base(removed['Amount'], removed['Currency'], removed['Date'])
+            )
+        )
+        self._update_note_index(mobile, period, before, after, lambda index: index.remove(expense_id))
+
+        with self._ledger_lock:
+            counts = self._ledger_counts.get(filename)
+            if counts is not None:
+                counts[1] += 1
+                needs_compaction = (
+                    counts[1] >= COMPACTION_MIN_DELETED and counts[1] >= COMPACTION_RATIO * counts[0]
+                    and filename not in self._compacting
+                )
+                if needs_compaction:
+                    self._compacting.add(filename)
+                    threading.Thread(target=self._compact_in_background, args=(mobile, period), daemon=True).start()
+        return True
+
+    def _compact_in_background(self, mobile, period):
+        try:
+            self.compact_period(mobile, period)
+        finally:
+            with self._ledger_lock:
+                self._compacting.discard(self.expense_file(mobile, period))
+
+    def compact_period(self, mobile, period):
+        """Rewrite one period's expense file without its deleted rows; returns how many were dropped"""
+        filename = self.expense_file(mobile, period)
+        deleted_filename = self.deleted_file(mobile, period)
+        with file_lock(filename), file_lock(deleted_filename):
+            deleted = read_csv_file(deleted_filename, DELETED_COLUMNS, dtype=str)['ID']
+            if deleted.empty:
+                return 0
+            before = self.expenses_version(mobile, period)
+            # Read as text so that the surviving rows are written back unchanged
+            df = read_csv_file(filename, EXPENSE_COLUMNS, dtype=str)
+            keep = ~df['ID'].isin(deleted)
+            rewrite_csv_file(filename, df[keep])
+            # A crash before this point only leaves tombstones for rows that are already gone
+            os.remove(deleted_filename)
+            self.cache.bump(filename)
+            after = self.expenses_version(mobile, period)
+            with self._ledger_lock:
+                self._ledger_counts[filename] = [int(keep.sum()), 0]
+        # Same expenses, new files: carry the summary over unchanged
+        self._update_summary(mobile, period, before, after, lambda summary: None)
+        self._update_note_index(mobile, period, before, after, lambda index: None)
+        return len(df) - int(keep.sum())
+
+    def compact_expenses(self, mobile):
+        """Compact every period of a user; returns how many deleted rows were dropped"""
+        return sum(self.compact_period(mobile, period) for period in self.expense_periods(mobile))
+
+    def clear_expenses(self, mobile):
+        cleared = False
+        for period in self.expense_periods(mobile):
+            filename = self.expense_file(mobile, period)
+            deleted_filename = self.deleted_file(mobile, period)
+            with file_lock(filename), file_lock(deleted_filename):
+                if not os.path.exists(filename):
+                    continue
+                before = self.expenses_version(mobile, period)
+                os.remove(filename)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(deleted_filename)
+                self.cache.bump(filename)
+                after = self.expenses_version(mobile, period)
+                with self._ledger_lock:
+                    self._ledger_counts[filename] = [0, 0]
+            self._update_summary(mobile, period, before, after, ExpenseSummary.clear)
+            self._update_note_index(mobile, period, before, after, NoteIndex.clear)
+            cleared = True
+        return cleared
+
+    def user_files(self, mobile):
+        """Names of a user's data files (without lock files and temporary files)"""
+        self._ensure_sharded(mobile)
+        try:
+            names = os.listdir(self.user_directory(mobile))
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if not name.startswith('.') and not name.endswith('.lock'))
+
+    def replace_user_files(self, mobile, files):
+        """
+        Make a user's directory hold exactly files ({name: bytes}), e.g. to
+        restore a snapshot; the user's other data files are removed
+        Each file is swapped in under its lock with one rename, so readers
+        and writers see either the old or the restored file
+        """
+        directory = self.user_directory(mobile)
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(set(self.user_files(mobile)) | set(files)):
+            filename = os.path.join(directory, name)
+            with file_lock(filename):
+                if name in files:
+                    replace_file(filename, files[name])
+                else:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(filename)
+                self.cache.bump(filename)
+                with self._ledger_lock:
+                    # A restored file may be of an older layout
+                    self._ledger_counts.pop(filename, None)
+                    self._upgraded.discard(filename)
+        self._partitioned.discard(mobile)
+
+# ============================================
+# SQLITE BACKEND
+# ============================================
+
+SQLITE_SCHEMA = USERS_SCHEMA + f"""
+CREATE TABLE IF NOT EXISTS salaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mobile TEXT NOT NULL,
+    salary REAL NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_salaries_mobile ON salaries (mobile, id);
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mobile TEXT NOT NULL,
+    date TEXT NOT NULL,
+    category TEXT NOT NULL,
+    amount REAL NOT NULL,
+    note TEXT,
+    currency TEXT NOT NULL DEFAULT '{BASE_CURRENCY}'
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_mobile_date ON expenses (mobile, date);
+CREATE INDEX IF NOT EXISTS idx_expenses_mobile_category ON expenses (mobile, category);
+CREATE TABLE IF NOT EXISTS period_versions (
+    mobile TEXT NOT NULL,
+    period TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (mobile, period)
+);
+"""
+
+class SQLiteStorage(Storage):
+    """
+    All users in one SQLite database (WAL mode)
+    Connections are pooled per process; per-user queries go through the
+    (mobile, date) and (mobile, category) indexes, so their cost depends on
+    the user's own rows rather than on the size of the whole database
+    """
+
+    def __init__(self, path=DEFAULT_DB_FILE, pool_size=4, users=None):
+        super().__init__()
+        self.path = path
+        self.pool_size = pool_size
+        self._pid = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._timeline_lock = threading.Lock()
+        self._timelines = {}
+        with self.connection() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(expenses)")]
+            if 'currency' not in columns:
+                # Databases from before expenses had a currency
+                conn.execute(f"ALTER TABLE expenses ADD COLUMN currency TEXT NOT NULL DEFAULT '{BASE_CURRENCY}'")
+        self.users = users or SQLiteUsers(path, connection=self.connection)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a pooled connection (autocommit mode; use BEGIN for transactions)"""
+        with self._pool_lock:
+            if self._pid != os.getpid():
+                # Connections must not be shared with a forked child
+                self._pid = os.getpid()
+                self._pool = queue.LifoQueue()
+                for _ in range(self.pool_size):
+                    self._pool.put(None)
+            pool = self._pool
+        conn = pool.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        finally:
+            pool.put(conn)
+
+    def load_salary_history(self, mobile):
+        with self.connection() as conn:
+            return pd.read_sql_query(
+                "SELECT salary, date FROM salaries WHERE mobile = ? ORDER BY id", conn, params=(mobile,)
+            )
+
+    def latest_salary(self, mobile):
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT salary FROM salaries WHERE mobile = ? ORDER BY id DESC LIMIT 1", (mobile,)
+            ).fetchone()
+        return row[0] if row else 0.0
+
+    def append_salary(self, mobile, salary, date):
+        with self.connection() as conn:
+            conn.execute("INSERT INTO salaries (mobile, salary, date) VALUES (?, ?, ?)", (mobile, salary, day_key(date)))
+
+    def salary_timeline(self, mobile):
+        # Salaries are only ever added, so (count, last id) identifies a
+        # version of the history; both come from the (mobile, id) index
+        with self.connection() as conn:
+            version = conn.execute("SELECT COUNT(*), MAX(id) FROM salaries WHERE mobile = ?", (mobile,)).fetchone()
+        with self._timeline_lock:
+            entry = self._timelines.get(mobile)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+        timeline = SalaryTimeline.from_history(self.load_salary_history(mobile))
+        with self._timeline_lock:
+            self._timelines[mobile] = (version, timeline)
+        return timeline
+
+    def load_expenses(self, mobile):
+        with self.connection() as conn:
+            df = pd.read_sql_query(
+                'SELECT CAST(id AS TEXT) AS "ID", date AS "Date", category AS "Category", '
+                'amount AS "Amount", note AS "Note", currency AS "Currency" '
+                "FROM expenses WHERE mobile = ? ORDER BY expenses.id",
+                conn, params=(mobile,)
+            )
+        return apply_expense_schema(df)
+
+    def query_expenses(self, mobile, start=None, end=None, categories=None, page=0, page_size=50):
+        # Filtering, ordering and paging all run on the (mobile, date) index
+        where, params = ["mobile = ?"], [mobile]
+        if start is not None:
+            where.append("date >= ?")
+            params.append(day_key(start))
+        if end is not None:
+            where.append("date <= ?")
+            params.append(day_key(end))
+        if categories is not None:
+            categories = list(categories)
+            where.append(f"category IN ({', '.join('?' * len(categories))})")
+            params.extend(categories)
+        where = " AND ".join(where)
+        with self.connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM expenses WHERE {where}", params).fetchone()[0]
+            df = pd.read_sql_query(
+                'SELECT CAST(id AS TEXT) AS "ID", date AS "Date", category AS "Category", '
+                'amount AS "Amount", note AS "Note", currency AS "Currency" '
+                f"FROM expenses WHERE {where} ORDER BY expenses.date DESC, expenses.id DESC LIMIT ? OFFSET ?",
+                conn, params=params + [page_size, page * page_size]
+            )
+        return apply_expense_schema(df), total
+
+    def iter_expense_chunks(self, mobile, start=None, end=None, chunk_size=50_000):
+        where, params = ["mobile = ?"], [mobile]
+        if start is not None:
+            where.append("date >= ?")
+            params.append(day_key(start))
+        if end is not None:
+            where.append("date <= ?")
+            params.append(day_key(end))
+        with self.connection() as conn:
+            for chunk in pd.read_sql_query(
+                'SELECT CAST(id AS TEXT) AS "ID", date AS "Date", category AS "Category", '
+                'amount AS "Amount", note AS "Note", currency AS "Currency" '
+                f"FROM expenses WHERE {' AND '.join(where)} ORDER BY expenses.id",
+                conn, params=params, chunksize=chunk_size
+            ):
+                yield apply_expense_schema(chunk)
+
+    @contextlib.contextmanager
+    def _ledger_write(self, mobile):
+        """
+        Transaction for changing a user's expenses
+        Yields (conn, touch); call touch(period) for every period the
+        transaction changes. It returns that period's (before, after)
+        versions, and the version is moved to after on commit
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                touched = {}
+
+                def touch(period):
+                    if period not in touched:
+                        before = self._version(conn, mobile, period)
+                        touched[period] = (before, before + 1)
+                    return touched[period]
+
+                yield conn, touch
+                conn.executemany(
+                    "INSERT INTO period_versions (mobile, period, version) VALUES (?, ?, ?) "
+                    "ON CONFLICT(mobile, period) DO UPDATE SET version = excluded.version",
+                    [(mobile, period, after) for period, (_, after) in touched.items()]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _version(self, conn, mobile, period):
+        row = conn.execute(
+            "SELECT version FROM period_versions WHERE mobile = ? AND period = ?", (mobile, period)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def expenses_version(self, mobile, period):
+        with self.connection() as conn:
+            return self._version(conn, mobile, period)
+
+    def _periods(self, conn, mobile):
+        """Periods holding expenses of a user, found with one index seek per period"""
+        periods, day = [], ''
+        while True:
+            (first,) = conn.execute(
+                "SELECT MIN(date) FROM expenses WHERE mobile = ? AND date >= ?", (mobile, day)
+            ).fetchone()
+            if first is None:
+                return periods
+            periods.append(period_key(first))
+            day = shift_period(periods[-1], 1) + '-01'
+
+    def expense_periods(self, mobile):
+        with self.connection() as conn:
+            return self._periods(conn, mobile)
+
+    def append_expense(self, mobile, date, category, amount, note, currency=BASE_CURRENCY):
+        category, minor = validate_category(category), to_minor(amount)
+        rates = get_rates()
+        currency = rates.validate(currency)
+        base = rates.minor_to_base(minor, currency, date)
+        period = period_key(date)
+        with self._ledger_write(mobile) as (conn, touch):
+            cursor = conn.execute(
+                "INSERT INTO expenses (mobile, date, category, amount, note, currency) VALUES (?, ?, ?, ?, ?, ?)",
+                (mobile, day_key(date), category, from_minor(minor), note, currency)
+            )
+            versions = touch(period)
+        expense_id = str(cursor.lastrowid)
+        self._update_summary(mobile, period, *versions, lambda summary: summary.add(date, category, base))
+        self._update_note_index(mobile, period, *versions, lambda index: index.add(expense_id, date, category, note))
+        return expense_id
+
+    def append_expenses(self, mobile, df):
+        if df.empty:
+            return []
+        df = with_currency(df)
+        periods = df['Date'].dt.strftime('%Y-%m')
+        with self._ledger_write(mobile) as (conn, touch):
+            conn.executemany(
+                "INSERT INTO expenses (mobile, date, category, amount, note, currency) VALUES (?, ?, ?, ?, ?, ?)",
+                zip(
+                    [mobile] * len(df),
+                    df['Date'].dt.strftime('%Y-%m-%d'),
+                    df['Category'].astype(str),
+                    from_minor(df['Amount']).tolist(),
+                    df['Note'],
+                    df['Currency']
+                )
+            )
+            # The write lock is held, so the batch got consecutive row IDs
+            last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            versions = {period: touch(period) for period in periods.unique()}
+        ids = pd.Series([str(rowid) for rowid in range(last - len(df) + 1, last + 1)], index=df.index)
+        for period, batch in df.groupby(periods):
+            added = ExpenseSummary.from_frame(batch)
+            self._update_summary(mobile, period, *versions[period], lambda summary: summary.merge(added))
+            self._update_note_index(
+                mobile, period, *versions[period],
+                lambda index: index.extend(ids[batch.index], batch['Date'], batch['Category'], batch['Note'])
+            )
+        return ids.tolist()
+
+    def delete_expense(self, mobile, expense_id):
+        try:
+            rowid = int(expense_id)
+        except (TypeError, ValueError):
+            return False
+        with self._ledger_write(mobile) as (conn, touch):
+            row = conn.execute(
+                "SELECT date, category, amount, currency FROM expenses WHERE id = ? AND mobile = ?", (rowid, mobile)
+            ).fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM expenses WHERE id = ?", (rowid,))
+            date, category, amount, currency = row
+            versions = touch(period_key(date))
+        rates = get_rates()
+        if rates.convertible([currency])[0]:
+            base = rates.minor_to_base(to_minor(amount), currency, date)
+            self._update_summary(
+                mobile, period_key(date), *versions, lambda summary: summary.remove(date, category, base)
+            )
+        else:
+            # Not in the summary's figures; a rebuild updates its unconverted counts
+            self._update_summary(mobile, period_key(date), versions[0], None, None)
+        self._update_note_index(mobile, period_key(date), *versions, lambda index: index.remove(rowid))
+        return True
+
+    def clear_expenses(self, mobile):
+        with self._ledger_write(mobile) as (conn, touch):
+            versions = {period: touch(period) for period in self._periods(conn, mobile)}
+            deleted = conn.execute("DELETE FROM expenses WHERE mobile = ?", (mobile,)).rowcount
+        for period, (before, after) in versions.items():
+            self._update_summary(mobile, period, before, after, ExpenseSummary.clear)
+            self._update_note_index(mobile, period, before, after, NoteIndex.clear)
+        return deleted > 0
+
+    def expenses_by_id(self, mobile, ids_by_period):
+        ids = [expense_id for period_ids in ids_by_period.values() for expense_id in period_ids]
+        if not ids:
+            return empty_expenses()
+        rowids = [int(expense_id) for expense_id in ids]
+        with self.connection() as conn:
+            # The unary + keeps SQLite from scanning the user's rows through
+            # the (mobile, ...) indexes instead of seeking the primary key
+            df = pd.read_sql_query(
+                'SELECT CAST(id AS TEXT) AS "ID", date AS "Date", category AS "Category", '
+                'amount AS "Amount", note AS "Note", currency AS "Currency" '
+                f"FROM expenses WHERE id IN ({', '.join('?' * len(rowids))}) AND +mobile = ?",
+                conn, params=rowids + [mobile]
+            )
+        return in_id_order(apply_expense_schema(df), ids)
+
+    def build_summary(self, mobile, period):
+        # Aggregate inside SQLite instead of materializing the rows; amounts
+        # are summed as integer minor units, like the rest of the app. Only
+        # the rows in other currencies are fetched, to be converted one by one
+        summary = ExpenseSummary()
+        first, last = (day_key(day) for day in period_bounds(period))
+        with self.connection() as conn:
+            cells = conn.execute(
+                f"SELECT date, category, SUM(CAST(ROUND(amount * {AMOUNT_SCALE}) AS INTEGER)), COUNT(*) "
+                "FROM expenses WHERE mobile = ? AND date >= ? AND date <= ? AND currency = ? GROUP BY date, category",
+                (mobile, first, last, BASE_CURRENCY)
+            ).fetchall()
+            foreign = pd.read_sql_query(
+                f"SELECT date, category, CAST(ROUND(amount * {AMOUNT_SCALE}) AS INTEGER) AS amount, currency "
+                "FROM expenses WHERE mobile = ? AND date >= ? AND date <= ? AND currency != ?",
+                conn, params=(mobile, first, last, BASE_CURRENCY)
+            )
+        if len(foreign):
+            rates = get_rates()
+            summary.unconverted = unconverted_counts(foreign['currency'], rates)
+            foreign = foreign[rates.convertible(foreign['currency'])]
+            foreign = foreign.assign(amount=rates.to_base(foreign['amount'], foreign['currency'], foreign['date']))
+            converted = foreign.groupby(['date', 'category'])['amount'].agg(['sum', 'count'])
+            cells = pd.DataFrame(cells, columns=['date', 'category', 'sum', 'count']).set_index(['date', 'category'])
+            cells = cells.add(converted, fill_value=0).astype('int64')
+            cells = [(day, category, int(total), int(count)) for (day, category), total, count in cells.itertuples()]
+        # Everything else rolls up from the category x day cells
+        for day, category, total, count in cells:
+            summary.day_category_totals.setdefault(day, {})[category] = total
+            summary.day_category_counts.setdefault(day, {})[category] = count
+            summary.category_totals[category] = summary.category_totals.get(category, 0) + total
+            summary.category_counts[category] = summary.category_counts.get(category, 0) + count
+            summary.day_counts[day] = summary.day_counts.get(day, 0) + count
+        summary.total = sum(summary.category_totals.values())
+        summary.count = sum(summary.category_counts.values())
+        summary.first_date = min(summary.day_counts, default=None)
+        summary.last_date = max(summary.day_counts, default=None)
+        return summary
+
+# ============================================
+# BACKEND SELECTION AND MIGRATION
+# ============================================
+
+def open_storage(kind=None, **options):
+    """Create the storage backend named by kind (default: $EXPENSE_STORAGE or "csv")"""
+    kind = kind or os.environ.get('EXPENSE_STORAGE', 'csv')
+    if kind == 'csv':
+        options.setdefault('root', os.environ.get('EXPENSE_DATA_DIR', '.'))
+        return CSVStorage(**options)
+    if kind == 'sqlite':
+        options.setdefault('path', os.environ.get('EXPENSE_DB', DEFAULT_DB_FILE))
+        return SQLiteStorage(**options)
+    raise ValueError(f"Unknown storage backend: {kind!r}")
+
+def migrate_csv_to_sqlite(source, target, progress=None):
+    """
+    Bulk-load every user in a CSV layout into a SQLite backend
+    Each user is copied in a single transaction and replaces whatever the
+    database already held for that user, so the migration can be re-run
+    Returns the number of users copied
+    """
+    users = source.list_users()
+    with target.connection() as conn:
+        for count, user in enumerate(users, start=1):
+            mobile = user['mobile']
+            salaries = source.load_salary_history(mobile)
+            expenses = source.load_expenses(mobile)
+
+            conn.execute("BEGIN")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO users (mobile, password, name, created_at) VALUES (?, ?, ?, ?)",
+                    [user[column] for column in USER_COLUMNS]
+                )
+                conn.execute("DELETE FROM salaries WHERE mobile = ?", (mobile,))
+                conn.execute("DELETE FROM expenses WHERE mobile = ?", (mobile,))
+                conn.executemany(
+                    "INSERT INTO salaries (mobile, salary, date) VALUES (?, ?, ?)",
+                    ((mobile, float(salary), str(date)) for salary, date in salaries[SALARY_COLUMNS].itertuples(index=False))
+                )
+                conn.executemany(
+                    "INSERT INTO expenses (mobile, date, category, amount, note, currency) VALUES (?, ?, ?, ?, ?, ?)",
+                    zip(
+                        [mobile] * len(expenses),
+                        expenses['Date'].dt.strftime('%Y-%m-%d'),
+                        expenses['Category'].astype(str),
+                        from_minor(expenses['Amount']).tolist(),
+                        expenses['Note'],
+                        expenses['Currency']
+                    )
+                )
+                # Invalidate the cached summaries of every period, old and new
+                conn.execute("UPDATE period_versions SET version = version + 1 WHERE mobile = ?", (mobile,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO period_versions (mobile, period, version) VALUES (?, ?, 1)",
+                    [(mobile, period) for period in target._periods(conn, mobile)]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if progress:
+                progress(count, len(users), mobile)
+    return len(users)
+
+def verify_summaries(store):
+    """
+    Rebuild every user's summary both ways - the backend's bulk aggregation
+    and a row-by-row replay of the incremental updates - and compare them
+    Returns the list of mobiles whose summaries disagree
+    """
+    mismatched = []
+    for user in store.list_users():
+        mobile = user['mobile']
+        replayed = ExpenseSummary()
+        expenses = in_base_currency(store.load_expenses(mobile))
+        for date, category, amount in zip(expenses['Date'], expenses['Category'], expenses['Amount']):
+            replayed.add(date, category, amount)
+        rebuilt = ExpenseSummary()
+        for period in store.expense_periods(mobile):
+            rebuilt.merge(store.build_summary(mobile, period))
+        if not rebuilt.matches(replayed):
+            mismatched.append(mobile)
+    return mismatched
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home Expense Tracker storage tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help="bulk-load existing CSV files into SQLite")
+    migrate.add_argument('--csv-dir', default=os.environ.get('EXPENSE_DATA_DIR', '.'), help="data root holding users.csv")
+    migrate.add_argument('--db', default=os.environ.get('EXPENSE_DB', DEFAULT_DB_FILE), help="SQLite database to fill")
+    commands.add_parser('verify-summaries', help="check the summary aggregates of every user against a full rebuild")
+    compact = commands.add_parser('compact', help="fold deleted-expense tombstones back into the CSV files")
+    compact.add_argument('--csv-dir', default=os.environ.get('EXPENSE_DATA_DIR', '.'), help="data root holding users.csv")
+    shard = commands.add_parser(
+        'shard', help="move flat layout files into the per-user directories (safe while the app runs)"
+    )
+    shard.add_argument('--csv-dir', default=os.environ.get('EXPENSE_DATA_DIR', '.'), help="data root holding users.csv")
+    args = parser.parse_args(argv)
+
+    if args.command == 'migrate':
+        source = CSVStorage(args.csv_dir)
+        target = SQLiteStorage(args.db)
+        count = migrate_csv_to_sqlite(
+            source, target,
+            progress=lambda done, total, mobile: print(f"[{done}/{total}] {mobile}", file=sys.stderr)
+        )
+        print(f"Migrated {count} users into {args.db}")
+    elif args.command == 'verify-summaries':
+        mismatched = verify_summaries(open_storage())
+        for mobile in mismatched:
+            print(f"Summary mismatch: {mobile}")
+        print(f"{len(mismatched)} mismatched summaries")
+        return 1 if mismatched else 0
+    elif args.command == 'compact':
+        store = CSVStorage(args.csv_dir)
+        dropped = sum(store.compact_expenses(user['mobile']) for user in store.list_users())
+        print(f"Removed {dropped} deleted expenses")
+    elif args.command == 'shard':
+        store = CSVStorage(args.csv_dir)
+        moved, conflicts = store.shard_all(
+            progress=lambda done, total, mobile: print(f"\r[{done}/{total}] {mobile}", end='', file=sys.stderr)
+        )
+        print(file=sys.stderr)
+        for mobile, names in conflicts.items():
+            names = ', '.join(get_user_filename(mobile, name) for name in names)
+            print(f"Left in place, {store.user_directory(mobile)} already has them: {names}")
+        print(f"Moved the files of {moved} users")
+        return 1 if conflicts else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Materialized per-user expense summary
+
+ExpenseSummary holds the figures shown in the Financial Summary, Expense
+Analysis and Expense Insights sections (total, per-category sums and counts,
+first/last date, number of transactions) and a category x day cube of sums
+behind the trend charts. Storage backends keep one per user and month and
+update it as expenses are added or deleted, so rendering the dashboard never
+has to scan the raw rows; multi-month views merge the monthly summaries, and
+rollup() turns the cube into weekly or monthly series. Amounts are integer
+minor units of the base currency (see schema.py and currency.py); expenses
+in a currency that has no rate are counted apart, in unconverted.
+"""
+
+from datetime import date as Date, timedelta
+
+from currency import in_base_currency, unconverted_counts
+from schema import day_key
+
+# Time grains of rollup()
+GRAINS = ['day', 'week', 'month']
+
+
+class ExpenseSummary:
+    """Running aggregates over one user's expenses"""
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.category_totals = {}
+        self.category_counts = {}
+        # Number of expenses per day, used to keep first/last date correct on delete
+        self.day_counts = {}
+        # Category x day cube: day -> {category: sum}, and the matching counts
+        self.day_category_totals = {}
+        self.day_category_counts = {}
+        self.first_date = None
+        self.last_date = None
+        # Currency -> number of expenses left out of the figures for want of an exchange rate
+        self.unconverted = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """Full rebuild from an expense DataFrame (one pass per aggregate)"""
+        summary = cls()
+        if df.empty:
+            return summary
+        if 'Currency' in df.columns:
+            summary.unconverted = unconverted_counts(df['Currency'])
+        df = in_base_currency(df)
+        if df.empty:
+            return summary
+        by_category = df['Amount'].groupby(df['Category'], observed=True).agg(['sum', 'count'])
+        summary.total = int(df['Amount'].sum())
+        summary.count = len(df)
+        summary.category_totals = {str(category): int(total) for category, total in by_category['sum'].items()}
+        summary.category_counts = {str(category): int(count) for category, count in by_category['count'].items()}
+        # Format only the distinct days, not every row
+        summary.day_counts = {day_key(day): int(count) for day, count in df['Date'].value_counts().items()}
+        cells = df['Amount'].groupby([df['Date'], df['Category']], observed=True).agg(['sum', 'count'])
+        for (day, category), total, count in zip(cells.index, cells['sum'], cells['count']):
+            day = day_key(day)
+            summary.day_category_totals.setdefault(day, {})[str(category)] = int(total)
+            summary.day_category_counts.setdefault(day, {})[str(category)] = int(count)
+        summary.first_date = min(summary.day_counts)
+        summary.last_date = max(summary.day_counts)
+        return summary
+
+    def add(self, date, category, amount):
+        """Account for one new expense (amount in base-currency minor units)"""
+        date, category, amount = day_key(date), str(category), int(amount)
+        self.total += amount
+        self.count += 1
+        self.category_totals[category] = self.category_totals.get(category, 0) + amount
+        self.category_counts[category] = self.category_counts.get(category, 0) + 1
+        self.day_counts[date] = self.day_counts.get(date, 0) + 1
+        totals = self.day_category_totals.setdefault(date, {})
+        counts = self.day_category_counts.setdefault(date, {})
+        totals[category] = totals.get(category, 0) + amount
+        counts[category] = counts.get(category, 0) + 1
+        if self.first_date is None or date < self.first_date:
+            self.first_date = date
+        if self.last_date is None or date > self.last_date:
+            self.last_date = date
+
+    def remove(self, date, category, amount):
+        """Account for one deleted expense (amount in base-currency minor units)"""
+        date, category, amount = day_key(date), str(category), int(amount)
+        self.total -= amount
+        self.count -= 1
+        self.category_counts[category] -= 1
+        if self.category_counts[category] == 0:
+            del self.category_counts[category]
+            del self.category_totals[category]
+        else:
+            self.category_totals[category] -= amount
+
+        totals, counts = self.day_category_totals[date], self.day_category_counts[date]
+        counts[category] -= 1
+        if counts[category] == 0:
+            del counts[category]
+            del totals[category]
+        else:
+            totals[category] -= amount
+
+        self.day_counts[date] -= 1
+        if self.day_counts[date] == 0:
+            del self.day_counts[date]
+            del self.day_category_totals[date]
+            del self.day_category_counts[date]
+            # Only deleting the last expense of the first/last day needs a
+            # search, and that is over distinct days rather than expenses
+            if date == self.first_date:
+                self.first_date = min(self.day_counts, default=None)
+            if date == self.last_date:
+                self.last_date = max(self.day_counts, default=None)
+
+    def clear(self):
+        """Forget every expense"""
+        self.__init__()
+
+    def copy(self):
+        """Return an independent copy"""
+        copied = ExpenseSummary()
+        copied.merge(self)
+        return copied
+
+    def merge(self, other):
+        """Add the figures of another summary (e.g. of another period) to this one"""
+        self.total += other.total
+        self.count += other.count
+        for category, total in other.category_totals.items():
+            self.category_totals[category] = self.category_totals.get(category, 0) + total
+        for category, count in other.category_counts.items():
+            self.category_counts[category] = self.category_counts.get(category, 0) + count
+        for day, count in other.day_counts.items():
+            self.day_counts[day] = self.day_counts.get(day, 0) + count
+        for mine, theirs in ((self.day_category_totals, other.day_category_totals),
+                             (self.day_category_counts, other.day_category_counts)):
+            for day, cells in theirs.items():
+                merged = mine.setdefault(day, {})
+                for category, value in cells.items():
+                    merged[category] = merged.get(category, 0) + value
+        if other.first_date is not None and (self.first_date is None or other.first_date < self.first_date):
+            self.first_date = other.first_date
+        if other.last_date is not None and (self.last_date is None or other.last_date > self.last_date):
+            self.last_date = other.last_date
+        for code, count in other.unconverted.items():
+            self.unconverted[code] = self.unconverted.get(code, 0) + count
+
+    def snapshot(self):
+        """Return a point-in-time copy of the figures as a dict"""
+        return {
+            'total': self.total,
+            'count': self.count,
+            'category_totals': dict(self.category_totals),
+            'category_counts': dict(self.category_counts),
+            'first_date': self.first_date,
+            'last_date': self.last_date,
+            'unconverted': dict(self.unconverted),
+        }
+
+    def matches(self, other):
+        """Compare the figures with another summary (amounts are integers, so exactly)"""
+        return (
+            (self.total, self.count, self.category_totals, self.category_counts, self.day_counts,
+             self.day_category_totals, self.day_category_counts)
+            == (other.total, other.count, other.category_totals, other.category_counts, other.day_counts,
+                other.day_category_totals, other.day_category_counts)
+        )
+
+
+def bucket_key(day, grain):
+    """The bucket of an ISO day at a grain: the day itself, its week's Monday, or its month ("YYYY-MM")"""
+    if grain == 'day':
+        return day
+    if grain == 'week':
+        parsed = Date.fromisoformat(day)
+        return (parsed - timedelta(days=parsed.weekday())).isoformat()
+    if grain == 'month':
+        return day[:7]
+    raise ValueError(f"Unknown grain: {grain!r}")
+
+
+def rollup(day_category_totals, grain):
+    """
+    Roll the category x day cube up to a coarser grain (see GRAINS)
+    Returns {bucket: {category: sum}}; the work depends on the number of
+    distinct days, not on the number of expenses
+    """
+    buckets = {}
+    for day, cells in day_category_totals.items():
+        bucket = buckets.setdefault(bucket_key(day, grain), {})
+        for category, total in cells.items():
+            bucket[category] = bucket.get(category, 0) + total
+    return buckets